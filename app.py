@@ -2,107 +2,2351 @@ import os
 import uuid
 import base64
 import json
+import time
+import hashlib
+import math
+import random
+import itertools
+import sqlite3
+import threading
+import contextlib
+import asyncio
+import re
+import multiprocessing
 import concurrent.futures
+from collections import OrderedDict, deque
 import markdown as md
-from flask import Flask, render_template, request, jsonify, send_from_directory, url_for
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+from xml.etree import ElementTree
+from flask import Flask, Response, stream_with_context, render_template, request, jsonify, send_file, redirect
 import requests
+import httpx
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, PageBreak
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, PageBreak, Preformatted, Table, TableStyle
+from reportlab.platypus.flowables import HRFlowable
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_JUSTIFY
 from reportlab.lib.utils import ImageReader
 from io import BytesIO
+from urllib.parse import urlparse, quote
+from html import unescape as html_unescape
+from xml.sax.saxutils import escape as xml_escape
 from PIL import Image as PILImage
+from pydantic import BaseModel, ValidationError
 
 load_dotenv()
 
 app = Flask(__name__)
 app.config['STATIC_OUTPUT'] = os.path.join(app.root_path, 'static', 'output')
 os.makedirs(app.config['STATIC_OUTPUT'], exist_ok=True)
+app.config['CACHE_DIR'] = os.path.join(app.instance_path, 'cache')
+os.makedirs(app.config['CACHE_DIR'], exist_ok=True)
+app.config['PDF_OUTPUT'] = os.path.join(app.instance_path, 'pdfs')
+os.makedirs(app.config['PDF_OUTPUT'], exist_ok=True)
+app.config['PDF_IMAGE_CACHE'] = os.path.join(app.config['CACHE_DIR'], 'pdf_images')
+os.makedirs(app.config['PDF_IMAGE_CACHE'], exist_ok=True)
 
 # Environment-configured models / keys
 GOOGLE_API_KEY = os.getenv('GEMINI_API_KEY')
 GEMINI_TEXT_MODEL = os.getenv('GEMINI_TEXT_MODEL', 'gemini-2.5-flash')
 GEMINI_IMAGE_MODEL = os.getenv('GEMINI_IMAGE_MODEL', "gemini-2.5-flash-image")
+# Cheaper, lower-latency model for the short extraction / rewrite calls (see GEMINI_ROUTE_DEFAULTS)
+GEMINI_FAST_MODEL = os.getenv('GEMINI_FAST_MODEL', 'gemini-2.5-flash-lite')
 ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')
+# 'live' calls the real APIs; 'fake' uses the offline backends in fake_providers.py
+GEMINI_PROVIDER = os.getenv('GEMINI_PROVIDER', 'live')
+MUSIC_PROVIDER = os.getenv('MUSIC_PROVIDER', 'live')
 
-def call_gemini_text(prompt, system=None):
-	"""Call Google Gemini text API via google.genai library."""
+# Shared Gemini HTTP connection pool
+GEMINI_POOL_MAX_CONNECTIONS = int(os.getenv('GEMINI_POOL_MAX_CONNECTIONS', '32'))
+GEMINI_POOL_MAX_KEEPALIVE = int(os.getenv('GEMINI_POOL_MAX_KEEPALIVE', '16'))
+GEMINI_POOL_KEEPALIVE_EXPIRY = float(os.getenv('GEMINI_POOL_KEEPALIVE_EXPIRY', '120'))
+GEMINI_WARMUP = os.getenv('GEMINI_WARMUP', '1') == '1'
+
+# Shared worker pool for deadline-bound agent calls
+DEADLINE_POOL_WORKERS = int(os.getenv('DEADLINE_POOL_WORKERS', '32'))
+
+# Server-side story asset jobs
+STORY_JOB_TTL = int(os.getenv('STORY_JOB_TTL', '3600'))
+# Stored stories (and their asset references) outlive the job; default matches the media lifetime
+STORY_MAX_AGE_DAYS = float(os.getenv('STORY_MAX_AGE_DAYS', os.getenv('OUTPUT_MAX_AGE_DAYS', '30')))
+
+# Seconds after which an abandoned image-render claim file is ignored
+IMAGE_CLAIM_STALE = int(os.getenv('IMAGE_CLAIM_STALE', '180'))
+
+# Responsive image variants written next to each generated image
+IMAGE_VARIANT_WIDTHS = [int(w) for w in os.getenv('IMAGE_VARIANT_WIDTHS', '320,640,1000').split(',') if w.strip()]
+IMAGE_WEBP_QUALITY = int(os.getenv('IMAGE_WEBP_QUALITY', '80'))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '82'))
+
+# Pre-sized PDF images (background blend + hero scene)
+PDF_IMAGE_DPI = int(os.getenv('PDF_IMAGE_DPI', '150'))
+PDF_IMAGE_CACHE_ENTRIES = int(os.getenv('PDF_IMAGE_CACHE_ENTRIES', '64'))
+PDF_IMAGE_CACHE_QUOTA_BYTES = int(os.getenv('PDF_IMAGE_CACHE_QUOTA_BYTES', str(256 * 1024 ** 2)))
+PDF_IMAGE_CACHE_MAX_AGE_DAYS = float(os.getenv('PDF_IMAGE_CACHE_MAX_AGE_DAYS', '30'))
+PDF_BACKGROUND_OPACITY = 0.25  # 25% visible
+
+# Parsed Markdown documents (story, analogy, profiles) kept per process for HTML and PDF rendering
+MARKDOWN_CACHE_ENTRIES = int(os.getenv('MARKDOWN_CACHE_ENTRIES', '256'))
+
+# Off-request PDF rendering
+PDF_POOL_WORKERS = int(os.getenv('PDF_POOL_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+PDF_JOB_ID_RE = re.compile(r'[0-9a-f]{32}')
+PDF_FAILED_KEEP = 256  # recent failed render errors kept for /pdf_jobs/<id>
+PDF_OUTPUT_QUOTA_BYTES = int(os.getenv('PDF_OUTPUT_QUOTA_BYTES', str(512 * 1024 ** 2)))
+PDF_OUTPUT_MAX_AGE_DAYS = float(os.getenv('PDF_OUTPUT_MAX_AGE_DAYS', '7'))
+
+# Bounded store for generated images / audio in static/output
+OUTPUT_QUOTA_BYTES = int(os.getenv('OUTPUT_QUOTA_BYTES', str(2 * 1024 ** 3)))
+OUTPUT_MAX_AGE_DAYS = float(os.getenv('OUTPUT_MAX_AGE_DAYS', '30'))
+OUTPUT_COMPACT_INTERVAL = int(os.getenv('OUTPUT_COMPACT_INTERVAL', '600'))
+
+# Generated media never changes once written, so it may be cached for a year
+MEDIA_MAX_AGE = int(os.getenv('MEDIA_MAX_AGE', str(365 * 24 * 3600)))
+
+# Response cache for repeatable Gemini text prompts
+TEXT_CACHE_ENABLED = os.getenv('TEXT_CACHE_ENABLED', '1') == '1'
+TEXT_CACHE_MEMORY_ENTRIES = int(os.getenv('TEXT_CACHE_MEMORY_ENTRIES', '512'))
+TEXT_CACHE_DISK_MAX_BYTES = int(os.getenv('TEXT_CACHE_DISK_MAX_BYTES', str(64 * 1024 * 1024)))
+# Seconds to keep a cached answer, per call site; call sites not listed are never cached
+TEXT_CACHE_TTLS = {
+	'detector': 7 * 24 * 3600,
+	'questions': 24 * 3600,
+	'hero_name': 24 * 3600
+}
+
+# Model tier and timeout budget (seconds) per text call site; override one with
+# GEMINI_ROUTE_<PURPOSE>=<tier or model name>[:<seconds>], e.g. GEMINI_ROUTE_ANALOGY=fast:20
+GEMINI_ROUTE_DEFAULTS = {
+	'detector': ('fast', 15),
+	'hero_name': ('fast', 30),
+	'music_prompt': ('fast', 20),
+	'questions': ('standard', 60),
+	'character': ('standard', 60),
+	'world': ('standard', 60),
+	'story': ('standard', 60),
+	'visual_prompt': ('standard', 80),
+	'hero_prompt': ('standard', 60),
+	'analogy': ('standard', 30)
+}
+
+# Story context reuse for the follow-up calls (visual prompts, analogy): 'provider' registers the
+# character, world and story as Gemini cached content, 'local' re-sends them as a prompt prefix
+STORY_CONTEXT_CACHE = os.getenv('STORY_CONTEXT_CACHE', 'provider')
+STORY_CONTEXT_TTL = int(os.getenv('STORY_CONTEXT_TTL', '900'))
+
+# Start the background image and BGM while the user is still on the builder page
+# (once the world / character are final); unclaimed results are dropped after the TTL
+SPECULATIVE_ASSETS = os.getenv('SPECULATIVE_ASSETS', '1') == '1'
+SPECULATION_TTL = int(os.getenv('SPECULATION_TTL', '900'))
+
+# Admission control per provider: <PROVIDER>_CONCURRENCY, <PROVIDER>_RPM and <PROVIDER>_QUEUE
+# (GEMINI_TEXT_*, GEMINI_IMAGE_*, ELEVENLABS_*) override the defaults in provider_gates.
+# Callers without a deadline give up waiting for admission after this many seconds.
+PROVIDER_MAX_WAIT = float(os.getenv('PROVIDER_MAX_WAIT', '30'))
+# How often a waiting coroutine re-checks its provider gate (seconds)
+GATE_ASYNC_POLL = float(os.getenv('GATE_ASYNC_POLL', '0.05'))
+
+# Retries of transient provider failures (429/5xx/connection drops) with jittered exponential backoff
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '8'))
+# Don't retry when less than this many seconds would be left before the deadline
+RETRY_MIN_REMAINING = float(os.getenv('RETRY_MIN_REMAINING', '2'))
+# Each first attempt earns RATIO retries, banked up to RESERVE
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.2'))
+RETRY_BUDGET_RESERVE = float(os.getenv('RETRY_BUDGET_RESERVE', '10'))
+
+# Short text calls that may send a second, hedged request once they pass their p95 latency
+HEDGE_PURPOSES = {p.strip() for p in os.getenv('HEDGE_PURPOSES', 'hero_name,detector').split(',') if p.strip()}
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', '3'))
+
+# Upper bounds (seconds) of the /metrics latency histogram buckets
+METRICS_LATENCY_BUCKETS = [float(b) for b in os.getenv('METRICS_LATENCY_BUCKETS', '0.05,0.1,0.25,0.5,1,2.5,5,10,20,30,60,120').split(',')]
+
+
+# ----------------------
+# Shared Gemini client
+# ----------------------
+_genai_client = None
+_genai_client_lock = threading.Lock()
+_conn_stats = {'requests': 0, 'new_connections': 0, 'tls_handshakes': 0}
+_conn_stats_lock = threading.Lock()
+_conn_local = threading.local()
+
+
+def _trace_connection_event(event_name, info):
+	"""httpcore trace hook: count fresh TCP connects and TLS handshakes."""
+	if event_name == 'connection.connect_tcp.complete':
+		key = 'new_connections'
+	elif event_name == 'connection.start_tls.complete':
+		key = 'tls_handshakes'
+	else:
+		return
+	with _conn_stats_lock:
+		_conn_stats[key] += 1
+	usage = getattr(_conn_local, 'usage', None)
+	if usage is not None:
+		usage[key] += 1
+
+
+def _on_gemini_request(request):
+	with _conn_stats_lock:
+		_conn_stats['requests'] += 1
+	usage = getattr(_conn_local, 'usage', None)
+	if usage is not None:
+		usage['requests'] += 1
+	request.extensions['trace'] = _trace_connection_event
+
+
+def get_genai_client():
+	"""Return the process-wide Gemini client, creating it on first use.
+	The client is thread-safe and keeps its HTTP connections alive, so every
+	agent call reuses the same pool instead of paying a fresh TLS handshake.
+	"""
+	global _genai_client
+	if _genai_client is None:
+		with _genai_client_lock:
+			if _genai_client is None and GEMINI_PROVIDER == 'fake':
+				import fake_providers
+				_genai_client = fake_providers.FakeGenaiClient()
+			elif _genai_client is None:
+				limits = httpx.Limits(
+					max_connections=GEMINI_POOL_MAX_CONNECTIONS,
+					max_keepalive_connections=GEMINI_POOL_MAX_KEEPALIVE,
+					keepalive_expiry=GEMINI_POOL_KEEPALIVE_EXPIRY
+				)
+				http_options = types.HttpOptions(
+					client_args={
+						'limits': limits,
+						'event_hooks': {'request': [_on_gemini_request]}
+					},
+					# Same pool sizing for client.aio, used by the ASGI entry point (asgi.py)
+					async_client_args={'limits': limits}
+				)
+				_genai_client = genai.Client(api_key=GOOGLE_API_KEY, http_options=http_options)
+	return _genai_client
+
+
+def _reset_genai_client():
+	# Pooled sockets must not be shared across a fork (e.g. gunicorn --preload)
+	global _genai_client, _genai_client_lock
+	_genai_client = None
+	_genai_client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_genai_client)
+
+
+def genai_connection_stats():
+	"""Snapshot of process-wide Gemini request / connection counters."""
+	with _conn_stats_lock:
+		stats = dict(_conn_stats)
+	stats['reused'] = max(0, stats['requests'] - stats['new_connections'])
+	return stats
+
+
+@contextlib.contextmanager
+def gemini_connection_usage(label):
+	"""Count the requests, new connections and TLS handshakes this thread makes per call site
+	(`label`); /metrics reports them as hero_gemini_call_*_total."""
+	usage = {'requests': 0, 'new_connections': 0, 'tls_handshakes': 0}
+	previous = getattr(_conn_local, 'usage', None)
+	_conn_local.usage = usage
 	try:
-		client = genai.Client(api_key=GOOGLE_API_KEY)
-		response = client.models.generate_content(
-			model=GEMINI_TEXT_MODEL,
-			contents=prompt
-		)
-		text = response.text if response else ''
+		yield usage
+	finally:
+		_conn_local.usage = previous
+		for key, value in usage.items():
+			if value:
+				metrics.inc(f'hero_gemini_call_{key}_total', value, call=label)
+
+
+def warm_up_genai_client():
+	"""Open the first pooled connection in the background so the first user doesn't pay for it."""
+	if not GOOGLE_API_KEY or not GEMINI_WARMUP or GEMINI_PROVIDER == 'fake':
+		return
+	def _warm():
+		try:
+			with gemini_connection_usage('Gemini warm-up'):
+				get_genai_client().models.get(model=GEMINI_TEXT_MODEL)
+		except Exception as e:
+			print(f"[WARNING] Gemini warm-up failed: {e}")
+	threading.Thread(target=_warm, name='gemini-warmup', daemon=True).start()
+
+
+# ----------------------
+# Metrics
+# ----------------------
+class MetricsRegistry:
+	"""Process-local counters, gauges and histograms rendered in the Prometheus text format.
+	A series is (name, sorted label pairs); recording one value is a dict update under a
+	single lock, cheap enough to leave on. Collectors add point-in-time values from other
+	components (executor, caches, artifact store) only when /metrics is scraped.
+	"""
+
+	def __init__(self, buckets):
+		self.buckets = tuple(sorted(buckets))
+		self._lock = threading.Lock()
+		self._meta = {}
+		self._values = {}
+		self._histograms = {}
+		self._collectors = []
+
+	def describe(self, name, kind, help_text):
+		self._meta[name] = (kind, help_text)
+
+	def add_collector(self, collect):
+		"""collect() yields (name, kind, help, labels, value) tuples at scrape time."""
+		self._collectors.append(collect)
+
+	def inc(self, name, amount=1, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + amount
+
+	def observe(self, name, value, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			series = self._histograms.get(key)
+			if series is None:
+				# per-bucket counts, then sum and count
+				series = self._histograms[key] = [0] * (len(self.buckets) + 2)
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					series[i] += 1
+					break
+			series[-2] += value
+			series[-1] += 1
+
+	def drain(self):
+		"""Return and reset counters and histograms (not gauges), for shipping out of a pool worker."""
+		with self._lock:
+			counters = {k: v for k, v in self._values.items() if self._meta.get(k[0], ('counter',))[0] == 'counter'}
+			for key in counters:
+				del self._values[key]
+			histograms, self._histograms = self._histograms, {}
+		return {'counters': counters, 'histograms': histograms}
+
+	def merge(self, state):
+		"""Add a drain() snapshot from another process into this registry."""
+		with self._lock:
+			for key, value in state['counters'].items():
+				self._values[key] = self._values.get(key, 0) + value
+			for key, series in state['histograms'].items():
+				mine = self._histograms.setdefault(key, [0] * len(series))
+				for i, value in enumerate(series):
+					mine[i] += value
+
+	@staticmethod
+	def _labels(pairs, extra=None):
+		pairs = list(pairs) + ([extra] if extra else [])
+		if not pairs:
+			return ''
+		escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+		return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+	def render(self):
+		with self._lock:
+			values = dict(self._values)
+			histograms = {k: list(v) for k, v in self._histograms.items()}
+		meta = dict(self._meta)
+		for collect in self._collectors:
+			try:
+				for name, kind, help_text, labels, value in collect():
+					meta.setdefault(name, (kind, help_text))
+					values[(name, tuple(sorted(labels.items())))] = value
+			except Exception as e:
+				print(f"[WARNING] Metrics collector failed: {e}")
+
+		series_by_name = {}
+		for (name, labels), value in values.items():
+			series_by_name.setdefault(name, []).append((labels, value))
+		for (name, labels), series in histograms.items():
+			series_by_name.setdefault(name, []).append((labels, series))
+
+		lines = []
+		for name in sorted(series_by_name):
+			kind, help_text = meta.get(name, ('untyped', ''))
+			lines.append(f"# HELP {name} {help_text}")
+			lines.append(f"# TYPE {name} {kind}")
+			for labels, value in sorted(series_by_name[name], key=lambda s: s[0]):
+				if kind != 'histogram':
+					lines.append(f"{name}{self._labels(labels)} {value}")
+					continue
+				cumulative = 0
+				for bound, count in zip(self.buckets, value):
+					cumulative += count
+					lines.append(f"{name}_bucket{self._labels(labels, ('le', bound))} {cumulative}")
+				lines.append(f"{name}_bucket{self._labels(labels, ('le', '+Inf'))} {value[-1]}")
+				lines.append(f"{name}_sum{self._labels(labels)} {value[-2]}")
+				lines.append(f"{name}_count{self._labels(labels)} {value[-1]}")
+		return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(METRICS_LATENCY_BUCKETS)
+metrics.describe('hero_stage_duration_seconds', 'histogram', 'Latency of each pipeline stage (Gemini/ElevenLabs calls, image processing, PDF builds).')
+metrics.describe('hero_stage_in_flight', 'gauge', 'Pipeline stage calls currently running.')
+metrics.describe('hero_stage_calls_total', 'counter', 'Finished pipeline stage calls by outcome (ok, timeout, error, cancelled).')
+metrics.describe('hero_stage_bytes_total', 'counter', 'Bytes sent to or received/written by each pipeline stage.')
+metrics.describe('hero_gemini_call_requests_total', 'counter', 'Gemini HTTP requests by call site.')
+metrics.describe('hero_gemini_call_new_connections_total', 'counter', 'Gemini HTTP connections opened by call site.')
+metrics.describe('hero_gemini_call_tls_handshakes_total', 'counter', 'Gemini TLS handshakes by call site.')
+metrics.describe('hero_stream_first_chunk_seconds', 'histogram', 'Time until the first streamed chunk of a Gemini response.')
+
+
+def is_timeout_error(exc):
+	"""True for deadline, HTTP client and gateway timeouts, as opposed to other failures."""
+	if isinstance(exc, (TimeoutError, concurrent.futures.TimeoutError, httpx.TimeoutException, requests.Timeout)):
+		return True
+	return getattr(exc, 'code', None) in (408, 504)
+
+
+def record_stage(stage, purpose, seconds, outcome):
+	metrics.observe('hero_stage_duration_seconds', seconds, stage=stage, purpose=purpose)
+	metrics.inc('hero_stage_calls_total', stage=stage, purpose=purpose, outcome=outcome)
+
+
+def record_route(route, seconds, outcome):
+	labels = {'route': route['purpose'], 'tier': route['tier'], 'model': route['model']}
+	metrics.observe('hero_route_duration_seconds', seconds, **labels)
+	metrics.inc('hero_route_calls_total', outcome=outcome, **labels)
+
+
+class StageSpan:
+	"""Handle yielded by track_stage() for attaching byte counts to the running stage."""
+
+	def __init__(self, stage, purpose):
+		self.stage = stage
+		self.purpose = purpose
+
+	def add_bytes(self, amount, direction='received'):
+		if amount:
+			metrics.inc('hero_stage_bytes_total', amount, stage=self.stage, purpose=self.purpose, direction=direction)
+
+
+@contextlib.contextmanager
+def track_stage(stage, purpose=None, route=None):
+	"""Time one pipeline stage: in-flight gauge, latency histogram and an outcome counter
+	that tells timeouts apart from other errors. Exceptions propagate unchanged.
+	Gemini text stages also pass their model route (text_route()) for the per-route series.
+	"""
+	span = StageSpan(stage, purpose or stage)
+	metrics.inc('hero_stage_in_flight', stage=span.stage, purpose=span.purpose)
+	started = time.perf_counter()
+	outcome = 'ok'
+	try:
+		yield span
+	except (GeneratorExit, asyncio.CancelledError):
+		# A streaming client went away mid-response, or a losing hedge was cancelled
+		outcome = 'cancelled'
+		raise
+	except BaseException as e:
+		outcome = 'timeout' if is_timeout_error(e) else 'error'
+		raise
+	finally:
+		metrics.inc('hero_stage_in_flight', -1, stage=span.stage, purpose=span.purpose)
+		elapsed = time.perf_counter() - started
+		record_stage(span.stage, span.purpose, elapsed, outcome)
+		if route is not None:
+			record_route(route, elapsed, outcome)
+
+
+def _component_stats():
+	"""Scrape-time view of the connection pool, worker pool, caches, artifact and story stores."""
+	for key, value in genai_connection_stats().items():
+		yield f'hero_gemini_{key}_total', 'counter', f'Gemini HTTP {key.replace("_", " ")} since start.', {}, value
+	for key, value in deadline_executor.stats().items():
+		kind = 'counter' if key.endswith('_total') else 'gauge'
+		yield f'hero_executor_{key}', kind, f'Deadline worker pool {key.replace("_", " ")}.', {}, value
+	for purpose, counts in text_cache.stats().items():
+		for key, value in counts.items():
+			yield f'hero_text_cache_{key}_total', 'counter', f'Gemini text cache {key.replace("_", " ")}.', {'purpose': purpose}, value
+	for key, value in artifact_store.stats().items():
+		kind = 'counter' if key.endswith('_total') else 'gauge'
+		yield f'hero_artifacts_{key}', kind, f'Generated-media store {key.replace("_", " ")}.', {}, value
+	for cache, sweeper in (('pdf_images', pdf_image_files), ('pdfs', pdf_files)):
+		for key, value in sweeper.stats().items():
+			kind = 'counter' if key.endswith('_total') else 'gauge'
+			yield f'hero_file_cache_{key}', kind, f'Swept file cache {key.replace("_", " ")}.', {'cache': cache}, value
+	yield 'hero_stories_stored', 'gauge', 'Stories held in the story store.', {}, story_store.stats()['stories']
+	for backend, value in story_contexts.stats().items():
+		yield 'hero_story_contexts_live', 'gauge', 'Story contexts currently registered.', {'backend': backend}, value
+	for key, value in markdown_documents.stats().items():
+		kind = 'counter' if key.endswith('_total') else 'gauge'
+		yield f'hero_markdown_cache_{key}', kind, f'Parsed Markdown document cache {key.replace("_", " ")}.', {}, value
+	for key, value in speculative_assets.stats().items():
+		yield f'hero_speculation_{key}', 'gauge', f'Speculative asset {key} currently held.', {}, value
+
+
+metrics.add_collector(_component_stats)
+
+
+# ----------------------
+# Provider admission control
+# ----------------------
+class ProviderBusy(Exception):
+	"""Raised instead of queueing a provider call that can't be admitted in time; maps to HTTP 429."""
+
+	def __init__(self, provider, retry_after, reason):
+		super().__init__(f"{provider} is busy ({reason}); retry in {retry_after}s")
+		self.provider = provider
+		self.retry_after = retry_after
+		self.reason = reason
+
+
+class ProviderGate:
+	"""Admission control in front of one upstream provider.
+
+	A call needs a concurrency slot and a token from a requests-per-minute bucket.
+	Callers that can't get both at once wait in a bounded queue; once the queue is
+	full, or when the caller's deadline would pass before a token frees up, the
+	call is rejected right away with ProviderBusy instead of holding a worker.
+	"""
+
+	def __init__(self, name, max_concurrency, rpm, max_queue, max_wait):
+		self.name = name
+		self.max_concurrency = max_concurrency
+		self.rate = rpm / 60.0
+		self.burst = max(1.0, min(float(max_concurrency), self.rate * 60))
+		self.max_queue = max_queue
+		self.max_wait = max_wait
+		self._cond = threading.Condition()
+		self._tokens = self.burst
+		self._refilled = time.monotonic()
+		self._active = 0
+		self._waiting = 0
+		self._avg_hold = 1.0
+
+	def _refill(self, now):
+		self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+		self._refilled = now
+
+	def _token_wait(self, position=1):
+		# Seconds until the bucket holds `position` tokens
+		missing = position - self._tokens
+		return missing / self.rate if missing > 0 and self.rate > 0 else 0.0
+
+	def _retry_after(self):
+		drain = self._avg_hold * (self._waiting + 1) / self.max_concurrency
+		return max(1, int(math.ceil(max(drain, self._token_wait(self._waiting + 1)))))
+
+	def _reject(self, reason):
+		metrics.inc('hero_provider_rejected_total', provider=self.name, reason=reason)
+		raise ProviderBusy(self.name, self._retry_after(), reason)
+
+	def check(self):
+		"""Fail fast (ProviderBusy) if a new call would be turned away by a full queue."""
+		with self._cond:
+			self._refill(time.monotonic())
+			if self._waiting >= self.max_queue and (self._active >= self.max_concurrency or self._tokens < 1):
+				self._reject('queue_full')
+
+	def _ready(self, now):
+		self._refill(now)
+		return self._active < self.max_concurrency and self._tokens >= 1
+
+	def _take(self, queued):
+		self._tokens -= 1
+		self._active += 1
+		started = time.monotonic()
+		metrics.observe('hero_provider_wait_seconds', started - queued, provider=self.name)
+		return started
+
+	def _release(self, started):
+		with self._cond:
+			self._active -= 1
+			self._avg_hold = 0.8 * self._avg_hold + 0.2 * (time.monotonic() - started)
+			# Wake every waiter: one woken alone may reject on its deadline and lose the wakeup
+			self._cond.notify_all()
+
+	def _check_deadline(self, now, deadline):
+		"""Reject when the call would miss its deadline before it could even start; else seconds to wait."""
+		left = deadline - now
+		if left <= 0 or self._token_wait() > left:
+			self._reject('deadline')
+		return min(left, self._token_wait() or left)
+
+	@contextlib.contextmanager
+	def admit(self):
+		"""Hold a slot and a token for the duration of one provider call."""
+		deadline = deadline_executor.current_deadline()
+		queued = time.monotonic()
+		if deadline is None:
+			deadline = queued + self.max_wait
+		with self._cond:
+			if not self._ready(queued) and self._waiting >= self.max_queue:
+				self._reject('queue_full')
+			self._waiting += 1
+			try:
+				while not self._ready(time.monotonic()):
+					self._cond.wait(self._check_deadline(time.monotonic(), deadline))
+			finally:
+				self._waiting -= 1
+			started = self._take(queued)
+		try:
+			yield
+		finally:
+			self._release(started)
+
+	@contextlib.asynccontextmanager
+	async def admit_async(self, deadline=None):
+		"""admit() for coroutines: polls with asyncio.sleep instead of blocking the event loop.
+		`deadline` is a time.monotonic() value; coroutines have no thread-local deadline.
+		"""
+		queued = time.monotonic()
+		if deadline is None:
+			deadline = queued + self.max_wait
+		with self._cond:
+			if self._ready(queued):
+				started = self._take(queued)
+			elif self._waiting >= self.max_queue:
+				self._reject('queue_full')
+			else:
+				started = None
+				self._waiting += 1
+		if started is None:
+			try:
+				while started is None:
+					with self._cond:
+						pause = self._check_deadline(time.monotonic(), deadline)
+					await asyncio.sleep(min(max(pause, 0.01), GATE_ASYNC_POLL))
+					with self._cond:
+						if self._ready(time.monotonic()):
+							started = self._take(queued)
+			finally:
+				with self._cond:
+					self._waiting -= 1
+		try:
+			yield
+		finally:
+			self._release(started)
+
+	def has_headroom(self, reserve=1):
+		"""True when a call could start right now and still leave `reserve` slots and tokens free."""
+		with self._cond:
+			self._refill(time.monotonic())
+			return self._waiting == 0 and self._active + reserve < self.max_concurrency and self._tokens >= 1 + reserve
+
+	def stats(self):
+		with self._cond:
+			self._refill(time.monotonic())
+			return {'active': self._active, 'waiting': self._waiting, 'tokens': round(self._tokens, 2)}
+
+
+def _provider_gate(name, concurrency, rpm, queue):
+	prefix = f"{name.upper()}_"
+	return ProviderGate(
+		name,
+		int(os.getenv(prefix + 'CONCURRENCY', str(concurrency))),
+		float(os.getenv(prefix + 'RPM', str(rpm))),
+		int(os.getenv(prefix + 'QUEUE', str(queue))),
+		PROVIDER_MAX_WAIT
+	)
+
+
+provider_gates = {
+	'gemini_text': _provider_gate('gemini_text', 16, 600, 64),
+	'gemini_image': _provider_gate('gemini_image', 4, 60, 16),
+	'elevenlabs': _provider_gate('elevenlabs', 2, 20, 8)
+}
+metrics.describe('hero_provider_wait_seconds', 'histogram', 'Time a provider call waited for admission.')
+metrics.describe('hero_provider_rejected_total', 'counter', 'Provider calls rejected by admission control (queue_full, deadline).')
+
+
+def _provider_gate_stats():
+	for name, gate in provider_gates.items():
+		for key, value in gate.stats().items():
+			yield f'hero_provider_{key}', 'gauge', f'Admission control {key} per provider.', {'provider': name}, value
+
+
+metrics.add_collector(_provider_gate_stats)
+
+
+@app.errorhandler(ProviderBusy)
+def provider_busy(e):
+	if not request.is_json and request.accept_mimetypes.best == 'text/html':
+		# A browser form post (/builder): show a page that can resubmit it, not raw JSON
+		response = app.make_response(render_template('busy.html', retry_after=e.retry_after,
+			action=request.path, fields=list(request.form.items(multi=True))))
+	else:
+		response = jsonify({'error': str(e), 'provider': e.provider, 'retry_after': e.retry_after})
+	response.status_code = 429
+	response.headers['Retry-After'] = str(e.retry_after)
+	return response
+
+
+# ----------------------
+# Retries and hedging
+# ----------------------
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class UpstreamHTTPError(RuntimeError):
+	"""Non-success HTTP status from a provider we call with plain requests (ElevenLabs)."""
+
+	def __init__(self, provider, code, body):
+		super().__init__(f"{provider} error {code}: {body}")
+		self.code = code
+
+
+class WorkCancelled(RuntimeError):
+	"""Raised inside background work whose result is no longer wanted (a superseded speculation)."""
+
+
+def is_retryable_error(exc):
+	"""Transient provider failures (429, 5xx, dropped connections) are worth another attempt;
+	bad requests, local rejections and our own deadlines are not.
+	"""
+	if isinstance(exc, (ProviderBusy, TimeoutError)):
+		return False
+	code = getattr(exc, 'code', None)
+	if isinstance(code, int):
+		return code in RETRYABLE_STATUS
+	return isinstance(exc, (httpx.TransportError, requests.ConnectionError, requests.Timeout))
+
+
+class RetryBudget:
+	"""Caps retries at a fraction of first attempts so an outage can't multiply traffic."""
+
+	def __init__(self, ratio, reserve):
+		self.ratio = ratio
+		self.reserve = reserve
+		self._tokens = reserve
+		self._lock = threading.Lock()
+
+	def deposit(self):
+		with self._lock:
+			self._tokens = min(self.reserve, self._tokens + self.ratio)
+
+	def withdraw(self):
+		with self._lock:
+			if self._tokens < 1:
+				return False
+			self._tokens -= 1
+			return True
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_RESERVE)
+metrics.describe('hero_provider_retries_total', 'counter', 'Provider call retries by outcome (retried, budget, deadline, exhausted).')
+metrics.describe('hero_hedged_requests_total', 'counter', 'Hedged text calls by outcome (fired, won, skipped).')
+
+
+def next_retry_delay(error, attempt_number, remaining, provider, purpose=None):
+	"""Seconds to back off before retrying after `error`, or None when it should be raised.
+	Gives up on non-transient errors, at RETRY_MAX_ATTEMPTS, when the retry budget is
+	spent, or when the backoff would leave less than RETRY_MIN_REMAINING before the deadline.
+	"""
+	if not is_retryable_error(error):
+		return None
+	labels = {'provider': provider, 'purpose': purpose or provider}
+	if attempt_number >= RETRY_MAX_ATTEMPTS:
+		metrics.inc('hero_provider_retries_total', outcome='exhausted', **labels)
+		return None
+	delay = _backoff_rng.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt_number - 1)))
+	if remaining is not None and remaining < delay + RETRY_MIN_REMAINING:
+		metrics.inc('hero_provider_retries_total', outcome='deadline', **labels)
+		return None
+	if not retry_budget.withdraw():
+		metrics.inc('hero_provider_retries_total', outcome='budget', **labels)
+		return None
+	metrics.inc('hero_provider_retries_total', outcome='retried', **labels)
+	print(f"[WARNING] {provider} ({labels['purpose']}) attempt {attempt_number} failed: {error}; retrying in {delay:.2f}s")
+	return delay
+
+
+_backoff_rng = random.Random()
+
+
+def with_retries(attempt, provider, purpose=None, deadline=None, deposit=True):
+	"""Call attempt() and retry transient failures with full-jitter exponential backoff,
+	within the deadline (explicit, else the current thread's); see next_retry_delay().
+	Pass deposit=False when the caller already paid into the retry budget for this logical call.
+	"""
+	if deposit:
+		retry_budget.deposit()
+	for n in itertools.count(1):
+		try:
+			return attempt()
+		except Exception as e:
+			remaining = deadline_executor.remaining() if deadline is None else deadline - time.monotonic()
+			delay = next_retry_delay(e, n, remaining, provider, purpose)
+			if delay is None:
+				raise
+			time.sleep(delay)
+
+
+class LatencyWindow:
+	"""Recent successful call latencies per purpose, for picking the hedge delay."""
+
+	def __init__(self, size):
+		self.size = size
+		self._samples = {}
+		self._lock = threading.Lock()
+
+	def observe(self, purpose, seconds):
+		with self._lock:
+			window = self._samples.get(purpose)
+			if window is None:
+				window = self._samples[purpose] = deque(maxlen=self.size)
+			window.append(seconds)
+
+	def percentile(self, purpose, pct):
+		with self._lock:
+			window = sorted(self._samples.get(purpose, ()))
+		if len(window) < HEDGE_MIN_SAMPLES:
+			return None
+		return window[min(len(window) - 1, int(len(window) * pct / 100))]
+
+
+latency_window = LatencyWindow(200)
+
+
+def _gate_idle(provider):
+	gate = provider_gates[provider].stats()
+	return gate['waiting'] == 0 and gate['active'] < provider_gates[provider].max_concurrency
+
+
+def hedged_call(fn, provider, purpose, timeout=30):
+	"""Run fn() and, if it hasn't answered by the purpose's p95 latency, fire a second
+	copy and return whichever succeeds first. Only request threads hedge: under a deadline
+	(a pool worker or a timed call) fn() runs inline, as every nested call does. The hedge
+	only goes out while the worker pool and the provider gate both have idle capacity; the
+	loser is abandoned.
+	"""
+	def _timed():
+		started = time.monotonic()
+		result = fn()
+		latency_window.observe(purpose, time.monotonic() - started)
+		return result
+
+	if deadline_executor.current_deadline() is not None or deadline_executor.in_worker() or not _gate_idle(provider):
+		return _timed()
+	first = deadline_executor.submit_if_idle(_timed, timeout=timeout)
+	if first is None:
+		return _timed()
+	deadline = deadline_executor._deadline_for(timeout)
+	delay = latency_window.percentile(purpose, 95) or HEDGE_DEFAULT_DELAY
+	futures = [first]
+	done, _ = concurrent.futures.wait(futures, timeout=delay)
+	if not done:
+		second = deadline_executor.submit_if_idle(_timed, timeout=timeout) if _gate_idle(provider) else None
+		if second is not None:
+			metrics.inc('hero_hedged_requests_total', purpose=purpose, outcome='fired')
+			futures.append(second)
+		else:
+			metrics.inc('hero_hedged_requests_total', purpose=purpose, outcome='skipped')
+
+	pending = set(futures)
+	error = None
+	while pending:
+		left = None if deadline is None else max(0.0, deadline - time.monotonic())
+		done, pending = concurrent.futures.wait(pending, timeout=left, return_when=concurrent.futures.FIRST_COMPLETED)
+		if not done:
+			break
+		for future in done:
+			if future.exception() is None:
+				if len(futures) > 1 and future is futures[1]:
+					metrics.inc('hero_hedged_requests_total', purpose=purpose, outcome='won')
+				for other in pending:
+					deadline_executor.abandon(other)
+				return future.result()
+			error = error or future.exception()
+	for other in pending:
+		deadline_executor.abandon(other)
+	raise error or TimeoutError(f"{purpose} timed out after {timeout} seconds")
+
+
+def open_sqlite(path, *ddl):
+	"""Open a WAL-mode SQLite connection shared by this process's threads and apply its DDL."""
+	conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+	conn.execute('PRAGMA journal_mode=WAL')
+	for statement in ddl:
+		conn.execute(statement)
+	conn.commit()
+	return conn
+
+
+# ----------------------
+# Artifact store
+# ----------------------
+class ArtifactStore:
+	"""Bounded home for generated images and audio under STATIC_OUTPUT.
+	Files live in hash-sharded subdirectories (ab/cd/<name>) and a SQLite index
+	maps each name to its path, size and last access, so a lookup never lists a
+	directory. compact() deletes files older than max_age, then the least
+	recently used ones until the store fits its byte quota.
+	"""
+
+	TOUCH_INTERVAL = 60  # seconds between last_access updates for one file
+
+	def __init__(self, root, db_path, quota_bytes, max_age):
+		self.root = root
+		self.db_path = db_path
+		self.quota_bytes = quota_bytes
+		self.max_age = max_age
+		self.reclaimed_total = 0
+		self._lock = threading.Lock()
+		self._wake = threading.Event()
+		self._conn = None
+		self._conn_pid = None
+
+	def _db(self):
+		if self._conn is None or self._conn_pid != os.getpid():
+			self._conn = open_sqlite(
+				self.db_path,
+				'CREATE TABLE IF NOT EXISTS artifacts ('
+				' name TEXT PRIMARY KEY, relpath TEXT NOT NULL, size INTEGER NOT NULL,'
+				' created REAL NOT NULL, last_access REAL NOT NULL, etag TEXT)',
+				'CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts (last_access)'
+			)
+			columns = [row[1] for row in self._conn.execute('PRAGMA table_info(artifacts)')]
+			if 'etag' not in columns:
+				self._conn.execute('ALTER TABLE artifacts ADD COLUMN etag TEXT')
+				self._conn.commit()
+			self._conn_pid = os.getpid()
+		return self._conn
+
+	@staticmethod
+	def relpath(name):
+		shard = hashlib.sha256(name.encode('utf-8')).hexdigest()
+		return f"{shard[:2]}/{shard[2:4]}/{name}"
+
+	def path_for(self, name):
+		"""Where a new artifact called `name` should be written (its shard directory is created)."""
+		path = os.path.join(self.root, self.relpath(os.path.basename(name)))
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		return path
+
+	@staticmethod
+	def content_hash(path):
+		digest = hashlib.sha256()
+		with open(path, 'rb') as f:
+			for block in iter(lambda: f.read(1024 * 1024), b''):
+				digest.update(block)
+		return digest.hexdigest()
+
+	def register(self, name):
+		"""Index a file just written at path_for(name); returns its path.
+		Artifacts never change once registered, so their content hash doubles as a strong ETag.
+		"""
+		name = os.path.basename(name)
+		path = os.path.join(self.root, self.relpath(name))
+		etag = self.content_hash(path)
+		now = time.time()
+		with self._lock:
+			db = self._db()
+			db.execute(
+				'INSERT OR REPLACE INTO artifacts (name, relpath, size, created, last_access, etag) VALUES (?, ?, ?, ?, ?, ?)',
+				(name, self.relpath(name), os.path.getsize(path), now, now, etag)
+			)
+			db.commit()
+			over_quota = db.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0] > self.quota_bytes
+		if over_quota:
+			self._wake.set()
+		return path
+
+	def entry(self, name):
+		"""{'path', 'etag', 'size'} of a stored artifact, or None. Counts as an access for LRU eviction."""
+		name = os.path.basename(name)
+		now = time.time()
+		with self._lock:
+			db = self._db()
+			row = db.execute('SELECT relpath, last_access, etag, size FROM artifacts WHERE name = ?', (name,)).fetchone()
+			if row is None:
+				return None
+			relpath, last_access, etag, size = row
+			path = os.path.join(self.root, relpath)
+			if not os.path.exists(path):
+				db.execute('DELETE FROM artifacts WHERE name = ? AND relpath = ?', (name, relpath))
+				db.commit()
+				return None
+			if etag is not None and now - last_access > self.TOUCH_INTERVAL:
+				db.execute('UPDATE artifacts SET last_access = ? WHERE name = ?', (now, name))
+				db.commit()
+		if etag is not None:
+			return {'path': path, 'etag': etag, 'size': size}
+
+		# Adopted legacy file: hash it once, outside the lock so other lookups aren't held up
+		try:
+			digest = self.content_hash(path)
+		except FileNotFoundError:
+			return None
+		with self._lock:
+			db = self._db()
+			# Check-and-set: keep whichever hash landed first; the row may also have been
+			# replaced or evicted while we were reading the file
+			db.execute(
+				'UPDATE artifacts SET etag = ?, last_access = ? WHERE name = ? AND relpath = ? AND etag IS NULL',
+				(digest, now, name, relpath)
+			)
+			db.commit()
+			row = db.execute('SELECT relpath, etag, size FROM artifacts WHERE name = ?', (name,)).fetchone()
+		if row is None or row[1] is None:
+			return None
+		return {'path': os.path.join(self.root, row[0]), 'etag': row[1], 'size': row[2]}
+
+	def lookup(self, name):
+		"""Path of a stored artifact, or None."""
+		found = self.entry(name)
+		return found['path'] if found else None
+
+	def adopt_legacy_files(self):
+		"""Index files left in the old flat layout once, so their URLs keep working."""
+		with self._lock:
+			db = self._db()
+			if db.execute('SELECT 1 FROM artifacts LIMIT 1').fetchone() is not None:
+				return
+			rows = []
+			for entry in os.scandir(self.root):
+				if entry.is_file() and not entry.name.startswith('.'):
+					st = entry.stat()
+					rows.append((entry.name, entry.name, st.st_size, st.st_mtime, st.st_mtime))
+			db.executemany('INSERT OR IGNORE INTO artifacts (name, relpath, size, created, last_access) VALUES (?, ?, ?, ?, ?)', rows)
+			db.commit()
+
+	def compact(self):
+		"""Evict expired, then least-recently-used artifacts until under quota; returns bytes reclaimed."""
+		now = time.time()
+		with self._lock:
+			db = self._db()
+			victims = db.execute('SELECT name, relpath, size FROM artifacts WHERE created < ?', (now - self.max_age,)).fetchall()
+			total = db.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts WHERE created >= ?', (now - self.max_age,)).fetchone()[0]
+			if total > self.quota_bytes:
+				for row in db.execute('SELECT name, relpath, size FROM artifacts WHERE created >= ? ORDER BY last_access', (now - self.max_age,)):
+					if total <= self.quota_bytes:
+						break
+					victims.append(row)
+					total -= row[2]
+			reclaimed = 0
+			for name, relpath, size in victims:
+				try:
+					os.remove(os.path.join(self.root, relpath))
+					reclaimed += size
+				except FileNotFoundError:
+					pass
+			db.executemany('DELETE FROM artifacts WHERE name = ?', [(v[0],) for v in victims])
+			db.commit()
+			self.reclaimed_total += reclaimed
+		if victims:
+			print(f"[DEBUG] Artifact store compaction removed {len(victims)} file(s), reclaimed {reclaimed // 1024} KB")
+		return reclaimed
+
+	def start_compactor(self, interval, also=()):
+		"""Run compact() every `interval` seconds (or sooner once a write pushes us over quota).
+		`also` are further sweepers (DirectorySweeper) run on the same schedule.
+		"""
+		def _loop():
+			while True:
+				self._wake.wait(interval)
+				self._wake.clear()
+				for sweep in (self.compact, *(s.sweep for s in also)):
+					try:
+						sweep()
+					except Exception as e:
+						print(f"[WARNING] Artifact store compaction failed: {e}")
+		threading.Thread(target=_loop, name='artifact-compactor', daemon=True).start()
+
+	def stats(self):
+		with self._lock:
+			count, total = self._db().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts').fetchone()
+		return {'files': count, 'bytes': total, 'quota_bytes': self.quota_bytes, 'reclaimed_bytes_total': self.reclaimed_total}
+
+
+artifact_store = ArtifactStore(
+	app.config['STATIC_OUTPUT'],
+	os.path.join(app.instance_path, 'artifacts.sqlite3'),
+	OUTPUT_QUOTA_BYTES,
+	OUTPUT_MAX_AGE_DAYS * 24 * 3600
+)
+
+
+class DirectorySweeper:
+	"""Age + size bound for an unindexed file cache directory (prepared PDF images, PDFs).
+	Files are rebuilt on demand, so a sweep simply deletes: expired files first, then the
+	least recently used (by mtime; touch() on reuse) until under quota.
+	In-flight `.tmp` files are left alone unless they are past max_age.
+	"""
+
+	def __init__(self, root, quota_bytes, max_age_seconds):
+		self.root = root
+		self.quota_bytes = quota_bytes
+		self.max_age = max_age_seconds
+		self.reclaimed_total = 0
+
+	@staticmethod
+	def touch(path):
+		try:
+			os.utime(path)
+		except OSError:
+			pass
+
+	def _files(self):
+		files = []
+		for entry in os.scandir(self.root):
+			try:
+				if entry.is_file():
+					st = entry.stat()
+					files.append((st.st_mtime, st.st_size, entry.name))
+			except FileNotFoundError:
+				continue
+		return files
+
+	def sweep(self):
+		"""Delete expired, then least-recently-used files until under quota; returns bytes reclaimed."""
+		cutoff = time.time() - self.max_age
+		files = sorted(self._files())
+		victims = [f for f in files if f[0] < cutoff]
+		kept = [f for f in files if f[0] >= cutoff and not f[2].endswith('.tmp')]
+		total = sum(f[1] for f in kept)
+		for f in kept:
+			if total <= self.quota_bytes:
+				break
+			victims.append(f)
+			total -= f[1]
+		reclaimed = 0
+		for _, size, name in victims:
+			try:
+				os.remove(os.path.join(self.root, name))
+				reclaimed += size
+			except FileNotFoundError:
+				pass
+		self.reclaimed_total += reclaimed
+		if victims:
+			print(f"[DEBUG] Swept {len(victims)} file(s) from {self.root}, reclaimed {reclaimed // 1024} KB")
+		return reclaimed
+
+	def stats(self):
+		files = self._files()
+		return {'files': len(files), 'bytes': sum(f[1] for f in files), 'quota_bytes': self.quota_bytes,
+			'reclaimed_bytes_total': self.reclaimed_total}
+
+
+pdf_image_files = DirectorySweeper(
+	app.config['PDF_IMAGE_CACHE'],
+	PDF_IMAGE_CACHE_QUOTA_BYTES,
+	PDF_IMAGE_CACHE_MAX_AGE_DAYS * 24 * 3600
+)
+# A swept PDF is simply re-rendered by the next /generate_pdf for it
+pdf_files = DirectorySweeper(
+	app.config['PDF_OUTPUT'],
+	PDF_OUTPUT_QUOTA_BYTES,
+	PDF_OUTPUT_MAX_AGE_DAYS * 24 * 3600
+)
+
+
+# ----------------------
+# Model routing
+# ----------------------
+GEMINI_MODEL_TIERS = {'fast': GEMINI_FAST_MODEL, 'standard': GEMINI_TEXT_MODEL}
+
+
+def _model_route(purpose, tier, timeout):
+	"""Resolve one GEMINI_ROUTE_DEFAULTS entry against its GEMINI_ROUTE_<PURPOSE> override."""
+	name, _, budget = os.getenv(f"GEMINI_ROUTE_{purpose.upper()}", '').partition(':')
+	name = name.strip() or tier
+	return {
+		'purpose': purpose,
+		'tier': name if name in GEMINI_MODEL_TIERS else 'custom',
+		'model': GEMINI_MODEL_TIERS.get(name, name),
+		'timeout': float(budget or timeout)
+	}
+
+
+gemini_routes = {purpose: _model_route(purpose, tier, timeout) for purpose, (tier, timeout) in GEMINI_ROUTE_DEFAULTS.items()}
+
+
+def text_route(purpose):
+	"""{'purpose', 'tier', 'model', 'timeout'} for a text call site; unlisted ones use the standard model."""
+	route = gemini_routes.get(purpose)
+	if route is None:
+		route = {'purpose': purpose or 'other', 'tier': 'standard', 'model': GEMINI_TEXT_MODEL, 'timeout': 120.0}
+	return route
+
+
+def route_deadline(route):
+	"""time.monotonic() deadline for one routed call: its budget from now, or the caller's if sooner."""
+	deadline = time.monotonic() + route['timeout']
+	parent = deadline_executor.current_deadline()
+	return deadline if parent is None else min(deadline, parent)
+
+
+def _route_stats():
+	for route in gemini_routes.values():
+		labels = {'route': route['purpose'], 'tier': route['tier'], 'model': route['model']}
+		yield 'hero_route_budget_seconds', 'gauge', 'Timeout budget of each Gemini text route.', labels, route['timeout']
+
+
+metrics.add_collector(_route_stats)
+metrics.describe('hero_route_duration_seconds', 'histogram', 'Latency of Gemini text calls per route (call site), tier and model.')
+metrics.describe('hero_route_calls_total', 'counter', 'Finished Gemini text calls per route, tier and model by outcome.')
+
+
+# ----------------------
+# Gemini text response cache
+# ----------------------
+class TextResponseCache:
+	"""Two-tier cache for Gemini text answers: an in-memory LRU in front of SQLite.
+	Keys hash the model, system text and whitespace-normalized prompt. Every entry
+	carries its own expiry so each call site picks its TTL, and the disk tier is
+	trimmed least-recently-used first once it grows past max_bytes.
+	The memory-tier lock is never held across SQLite I/O: disk reads run on per-thread
+	WAL reader connections, and the last_access updates of disk hits are batched.
+	"""
+
+	PRUNE_EVERY = 50
+	TOUCH_BATCH = 64  # disk hits whose last_access is written in one transaction
+
+	def __init__(self, db_path, memory_entries, max_bytes):
+		self.db_path = db_path
+		self.memory_entries = memory_entries
+		self.max_bytes = max_bytes
+		self._memory = OrderedDict()  # key -> (expires_at, value, latency)
+		self._lock = threading.Lock()  # memory tier, stats and pending touches
+		self._db_lock = threading.Lock()  # the shared writer connection
+		self._readers = threading.local()
+		self._conn = None
+		self._conn_pid = None
+		self._puts = 0
+		self._touches = {}
+		self._stats = {}
+
+	@staticmethod
+	def make_key(model, prompt, system=None):
+		normalized = ' '.join(str(prompt).split())
+		raw = f"{model}\x00{system or ''}\x00{normalized}"
+		return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+	def _db(self):
+		# One writer connection per process; sqlite3 connections must not cross a fork
+		if self._conn is None or self._conn_pid != os.getpid():
+			self._conn = open_sqlite(
+				self.db_path,
+				'CREATE TABLE IF NOT EXISTS responses ('
+				' key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL,'
+				' last_access REAL NOT NULL, latency REAL NOT NULL DEFAULT 0)'
+			)
+			self._conn_pid = os.getpid()
+		return self._conn
+
+	def _reader(self):
+		# WAL readers don't wait for the writer or each other, so each thread reads on its own connection
+		conn = getattr(self._readers, 'conn', None)
+		if conn is None or self._readers.pid != os.getpid():
+			with self._db_lock:
+				self._db()  # creates the table on first use
+			conn = sqlite3.connect(self.db_path, timeout=5)
+			self._readers.conn, self._readers.pid = conn, os.getpid()
+		return conn
+
+	def _count(self, purpose, field, amount=1):
+		bucket = self._stats.setdefault(purpose or 'default', {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'saved_seconds': 0.0})
+		bucket[field] += amount
+
+	def get(self, key, purpose=None):
+		now = time.time()
+		with self._lock:
+			entry = self._memory.get(key)
+			if entry is not None and entry[0] > now:
+				self._memory.move_to_end(key)
+				self._count(purpose, 'memory_hits')
+				self._count(purpose, 'saved_seconds', entry[2])
+				return entry[1]
+			self._memory.pop(key, None)
+		try:
+			row = self._reader().execute(
+				'SELECT value, expires_at, latency FROM responses WHERE key = ? AND expires_at > ?', (key, now)
+			).fetchone()
+		except sqlite3.Error as e:
+			print(f"[WARNING] Text cache read failed: {e}")
+			row = None
+		with self._lock:
+			if row is None:
+				self._count(purpose, 'misses')
+				return None
+			value, expires_at, latency = row
+			self._remember(key, (expires_at, value, latency))
+			self._count(purpose, 'disk_hits')
+			self._count(purpose, 'saved_seconds', latency)
+			self._touches[key] = now
+			flush = len(self._touches) >= self.TOUCH_BATCH
+		if flush:
+			self._flush_touches()
+		return value
+
+	def _flush_touches(self):
+		"""Write the batched last_access updates of disk hits in one transaction."""
+		with self._lock:
+			touches, self._touches = self._touches, {}
+		if not touches:
+			return
+		with self._db_lock:
+			try:
+				db = self._db()
+				db.executemany('UPDATE responses SET last_access = ? WHERE key = ?', [(at, key) for key, at in touches.items()])
+				db.commit()
+			except sqlite3.Error as e:
+				print(f"[WARNING] Text cache write failed: {e}")
+
+	def _remember(self, key, entry):
+		self._memory[key] = entry
+		self._memory.move_to_end(key)
+		while len(self._memory) > self.memory_entries:
+			self._memory.popitem(last=False)
+
+	def put(self, key, value, ttl, latency=0.0, purpose=None):
+		now = time.time()
+		with self._lock:
+			self._remember(key, (now + ttl, value, latency))
+			self._count(purpose, 'stores')
+			self._puts += 1
+			prune = self._puts % self.PRUNE_EVERY == 0
+		if prune:
+			# Pruning goes by last_access, so write the pending touches first
+			self._flush_touches()
+		with self._db_lock:
+			try:
+				self._db().execute(
+					'INSERT OR REPLACE INTO responses (key, value, expires_at, last_access, latency) VALUES (?, ?, ?, ?, ?)',
+					(key, value, now + ttl, now, latency)
+				)
+				self._db().commit()
+				if prune:
+					self._prune(now)
+			except sqlite3.Error as e:
+				print(f"[WARNING] Text cache write failed: {e}")
+
+	def _prune(self, now):
+		db = self._db()
+		db.execute('DELETE FROM responses WHERE expires_at <= ?', (now,))
+		total = db.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM responses').fetchone()[0]
+		if total > self.max_bytes:
+			excess = total - self.max_bytes
+			freed = 0
+			victims = []
+			for key, size in db.execute('SELECT key, LENGTH(value) FROM responses ORDER BY last_access'):
+				if freed >= excess:
+					break
+				victims.append((key,))
+				freed += size
+			db.executemany('DELETE FROM responses WHERE key = ?', victims)
+		db.commit()
+
+	def stats(self):
+		with self._lock:
+			return {purpose: dict(counts) for purpose, counts in self._stats.items()}
+
+
+text_cache = TextResponseCache(
+	os.path.join(app.config['CACHE_DIR'], 'text_responses.sqlite3'),
+	TEXT_CACHE_MEMORY_ENTRIES,
+	TEXT_CACHE_DISK_MAX_BYTES
+)
+
+
+def call_gemini_text(prompt, system=None, purpose=None, context=None):
+	"""Call Google Gemini text API via google.genai library.
+	`purpose` names the call site; sites listed in TEXT_CACHE_TTLS are served from the response cache.
+	`context` is a StoryContext the prompt refers to (see StoryContextCache).
+	The model and timeout budget come from the purpose's route (text_route()).
+	"""
+	route = text_route(purpose)
+	model = route['model']
+	ttl = TEXT_CACHE_TTLS.get(purpose) if TEXT_CACHE_ENABLED else None
+	cache_key = TextResponseCache.make_key(model, prompt, f"context:{context.digest}" if context else system) if ttl else None
+	if cache_key:
+		cached = text_cache.get(cache_key, purpose)
+		if cached is not None:
+			return {'raw': cached, 'cached': True}
+
+	def _attempt():
+		with provider_gates['gemini_text'].admit(), track_stage('gemini_text', purpose, route) as stage, \
+				gemini_connection_usage('Gemini text'):
+			contents, fields = context.request(prompt) if context else (prompt, {})
+			stage.add_bytes(sum(len(part.encode('utf-8')) for part in (contents if isinstance(contents, list) else [contents])), 'sent')
+			try:
+				response = get_genai_client().models.generate_content(
+					model=model,
+					contents=contents,
+					config=_gemini_request_config(deadline=deadline, **fields)
+				)
+			except Exception as e:
+				if not fields or getattr(e, 'code', None) not in (400, 403, 404):
+					raise
+				# The provider dropped the cached context early: send the text with this request instead
+				print(f"[WARNING] Story context cache rejected ({e}); sending it inline")
+				story_contexts.invalidate(context)
+				response = get_genai_client().models.generate_content(
+					model=model,
+					contents=[context.text, prompt],
+					config=_gemini_request_config(deadline=deadline)
+				)
+			text = response.text if response else ''
+			stage.add_bytes(len((text or '').encode('utf-8')))
+			return text
+
+	try:
+		started = time.monotonic()
+		deadline = route_deadline(route)
+		if context is not None:
+			context = story_contexts.on_model(context, model)
+		if purpose in HEDGE_PURPOSES:
+			# One deposit for the logical call, however many copies the hedge sends
+			retry_budget.deposit()
+			text = hedged_call(lambda: with_retries(_attempt, 'gemini_text', purpose, deadline, deposit=False), 'gemini_text', purpose,
+				timeout=deadline - started)
+		else:
+			text = with_retries(_attempt, 'gemini_text', purpose, deadline)
+		if cache_key and text and text.strip():
+			text_cache.put(cache_key, text, ttl, time.monotonic() - started, purpose)
 		return {'raw': text}
+	except ProviderBusy:
+		raise
 	except Exception as e:
 		print(f'Gemini text error: {e}')
-		return {'raw': f'Error: {str(e)}'}
+		return {'raw': f'Error: {str(e)}', 'error': str(e)}
+
+
+# ----------------------
+# Structured output
+# ----------------------
+class BuilderQuestion(BaseModel):
+	number: int
+	question: str
+	example: str
+
+
+class BuilderQuestionSet(BaseModel):
+	character_questions: list[BuilderQuestion]
+	world_questions: list[BuilderQuestion]
+
+
+class CharacterProfile(BaseModel):
+	name: str
+	profile: str
+	key_traits: list[str]
+
+
+class WorldProfile(BaseModel):
+	name: str
+	genre: str
+	setting: str
+	key_traits: list[str]
+
+
+def call_gemini_structured(prompt, schema, purpose=None):
+	"""Call Gemini with schema-constrained JSON output and return a validated `schema` instance.
+	Shares the text response cache (keyed per schema). Raises ValueError or
+	ValidationError when the answer doesn't match the schema.
+	"""
+	route = text_route(purpose)
+	ttl = TEXT_CACHE_TTLS.get(purpose) if TEXT_CACHE_ENABLED else None
+	cache_key = TextResponseCache.make_key(route['model'], prompt, f'schema:{schema.__name__}') if ttl else None
+	if cache_key:
+		cached = text_cache.get(cache_key, purpose)
+		if cached is not None:
+			try:
+				return schema.model_validate_json(cached)
+			except ValidationError:
+				print(f"[WARNING] Discarding cached {schema.__name__} that no longer validates")
+
+	def _attempt():
+		with provider_gates['gemini_text'].admit(), track_stage('gemini_structured', purpose, route) as stage, \
+				gemini_connection_usage('Gemini structured'):
+			stage.add_bytes(len(prompt.encode('utf-8')), 'sent')
+			response = get_genai_client().models.generate_content(
+				model=route['model'],
+				contents=prompt,
+				config=_gemini_request_config(deadline=deadline, response_mime_type='application/json', response_schema=schema)
+			)
+			stage.add_bytes(len((response.text or '').encode('utf-8')))
+			return response
+
+	started = time.monotonic()
+	deadline = route_deadline(route)
+	response = with_retries(_attempt, 'gemini_text', purpose, deadline)
+	# Fast path: the SDK already parsed the constrained JSON into the schema
+	parsed = response.parsed if isinstance(response.parsed, schema) else None
+	if parsed is None:
+		if not response.text:
+			raise ValueError(f"Empty {schema.__name__} response from Gemini")
+		parsed = schema.model_validate_json(response.text)
+	if cache_key:
+		text_cache.put(cache_key, parsed.model_dump_json(), ttl, time.monotonic() - started, purpose)
+	return parsed
+
+
+# ----------------------
+# Story contexts
+# ----------------------
+def story_context_text(character, world, story):
+	"""The shared material every follow-up prompt refers to as 'provided above'."""
+	return (
+		"Reference material for the requests that follow: a hero, their world and a story about them."
+		f"\n\nCharacter:\n{character}\n\nWorld:\n{world}\n\nStory:\n{story}\n"
+	)
+
+
+class StoryContext:
+	"""One story's context on one model: a provider cache name, or just the text to prefix."""
+
+	def __init__(self, story_id, model, text, expires, cache_name=None):
+		self.story_id = story_id
+		self.model = model
+		self.text = text
+		self.digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+		self.expires = expires
+		self.cache_name = cache_name
+
+	def request(self, prompt):
+		"""(contents, extra GenerateContentConfig fields) for a prompt that refers to this context."""
+		if self.cache_name:
+			return prompt, {'cached_content': self.cache_name}
+		return [self.text, prompt], {}
+
+
+class StoryContextCache:
+	"""Registers a story's character, world and text once per (story, model) so the image-prompt
+	and analogy calls don't each pay to re-send and re-prefill them. In 'provider' mode the text
+	becomes Gemini cached content with a TTL; 'local' mode (and any story the provider refuses,
+	e.g. below its minimum cacheable size) falls back to sending it as a prompt prefix, which
+	also stands in for the provider in tests. Entries expire a little before the provider TTL
+	and are swept on access; provider caches left behind expire on their own.
+	"""
+
+	EXPIRY_MARGIN = 30  # seconds; never hand out a cache name the provider is about to drop
+
+	def __init__(self, mode, ttl):
+		self.mode = mode
+		self.ttl = ttl
+		self._entries = {}
+		self._creating = {}
+		self._lock = threading.Lock()
+
+	def _sweep(self, now):
+		for key in [k for k, v in self._entries.items() if v.expires <= now]:
+			del self._entries[key]
+			self._creating.pop(key, None)
+
+	def get(self, story_id, character, world, story, model=None):
+		"""The StoryContext for story_id, creating it on first use (concurrent callers share one)."""
+		return self._get(story_id, model or GEMINI_TEXT_MODEL, story_context_text(character, world, story))
+
+	def on_model(self, context, model):
+		"""The same story's context for another model; cached content only works with its own."""
+		if context.model == model:
+			return context
+		return self._get(context.story_id, model, context.text)
+
+	def _get(self, story_id, model, text):
+		key = (story_id, model)
+		now = time.monotonic()
+		with self._lock:
+			self._sweep(now)
+			entry = self._entries.get(key)
+			if entry is not None:
+				metrics.inc('hero_story_contexts_total', backend='provider' if entry.cache_name else 'local', outcome='reused')
+				return entry
+			key_lock = self._creating.setdefault(key, threading.Lock())
+		with key_lock:
+			with self._lock:
+				entry = self._entries.get(key)
+			if entry is None:
+				entry = self._create(story_id, model, text)
+				with self._lock:
+					self._entries[key] = entry
+			else:
+				metrics.inc('hero_story_contexts_total', backend='provider' if entry.cache_name else 'local', outcome='reused')
+		return entry
+
+	def _create(self, story_id, model, text):
+		expires = time.monotonic() + self.ttl - self.EXPIRY_MARGIN
+		if self.mode == 'provider':
+			try:
+				with provider_gates['gemini_text'].admit(), track_stage('gemini_cache', 'story_context') as stage:
+					stage.add_bytes(len(text.encode('utf-8')), 'sent')
+					cache = get_genai_client().caches.create(
+						model=model,
+						config=types.CreateCachedContentConfig(
+							contents=[text],
+							ttl=f"{self.ttl}s",
+							display_name=f"story-{story_id}"
+						)
+					)
+				metrics.inc('hero_story_contexts_total', backend='provider', outcome='created')
+				return StoryContext(story_id, model, text, expires, cache.name)
+			except ProviderBusy:
+				raise
+			except Exception as e:
+				print(f"[WARNING] Could not cache story context, sending it inline: {e}")
+				metrics.inc('hero_story_contexts_total', backend='local', outcome='fallback')
+				return StoryContext(story_id, model, text, expires)
+		metrics.inc('hero_story_contexts_total', backend='local', outcome='created')
+		return StoryContext(story_id, model, text, expires)
+
+	def invalidate(self, context):
+		"""Drop a context the provider no longer recognises; its next use sends the text inline."""
+		with self._lock:
+			for key in [k for k, v in self._entries.items() if v is context]:
+				self._entries[key] = StoryContext(context.story_id, context.model, context.text, context.expires)
+
+	def stats(self):
+		with self._lock:
+			self._sweep(time.monotonic())
+			provider = sum(1 for v in self._entries.values() if v.cache_name)
+		return {'provider': provider, 'local': len(self._entries) - provider}
+
+
+story_contexts = StoryContextCache(STORY_CONTEXT_CACHE, STORY_CONTEXT_TTL)
+metrics.describe('hero_story_contexts_total', 'counter', 'Story context lookups by backend (provider, local) and outcome (created, reused, fallback).')
+
+
+def story_context(story_id, character, world, story):
+	"""story_contexts.get() for a job stage or endpoint, or None (prompts then carry the texts)."""
+	if not story_id or STORY_CONTEXT_CACHE == 'off':
+		return None
+	try:
+		return story_contexts.get(story_id, character, world, story)
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		print(f"[WARNING] Story context unavailable: {e}")
+		return None
+
+
+def image_content_key(prompt, model=None):
+    """Content address of a generated image: hash of the image model plus the exact prompt."""
+    raw = f"{model or GEMINI_IMAGE_MODEL}\x00{prompt}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _wait_for_image_claim(out_path, claim_path):
+    """Block while another request renders the same prompt; True once its file exists."""
+    while os.path.exists(claim_path):
+        if os.path.exists(out_path):
+            return True
+        try:
+            if time.time() - os.path.getmtime(claim_path) > IMAGE_CLAIM_STALE:
+                # The claiming request died mid-render; let this one take over
+                os.remove(claim_path)
+                return False
+        except FileNotFoundError:
+            break
+        remaining = deadline_executor.remaining()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError("Timed out waiting for an identical image render")
+        time.sleep(0.25)
+    return os.path.exists(out_path)
+
+
+def claim_image_render(prompt, prefix='image'):
+    """Find or claim the stored image for a prompt.
+    Returns (path, None) when it already exists, else (None, (filename, out_path, claim_path)):
+    the caller now owns the claim file and must render, then release_image_claim().
+    """
+    filename = f"{prefix}_{image_content_key(prompt)[:32]}.png"
+    stored = artifact_store.lookup(filename)
+    if stored:
+        print(f"[DEBUG] Reusing stored image for identical prompt: {filename}")
+        return stored, None
+    out_path = artifact_store.path_for(filename)
+    claim_path = out_path + '.lock'
+    while True:
+        if os.path.exists(out_path):
+            # Rendered by a concurrent request (or indexed-but-not-yet-registered)
+            return artifact_store.register(filename), None
+        try:
+            os.close(os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            if _wait_for_image_claim(out_path, claim_path):
+                continue
+    if os.path.exists(out_path):
+        release_image_claim(claim_path)
+        return artifact_store.register(filename), None
+    return None, (filename, out_path, claim_path)
+
+
+def release_image_claim(claim_path):
+    try:
+        os.remove(claim_path)
+    except FileNotFoundError:
+        pass
+
+
+def save_image_response(response, out_path, stage=None):
+    """Write the first image of a Gemini response to out_path atomically."""
+    # --- FIXED IMAGE EXTRACTION (matches official docs) ---
+    image_obj = None
+    for part in response.parts:
+        if part.inline_data is not None:
+            image_obj = part.as_image()
+            break  # first image only
+
+    if image_obj is None:
+        raise ValueError("No image returned from Gemini.")
+
+    # Save it under a temporary name, then publish atomically
+    tmp_path = f"{out_path[:-len('.png')]}.{uuid.uuid4().hex[:8]}.tmp.png"
+    try:
+        image_obj.save(tmp_path)
+        if stage is not None:
+            stage.add_bytes(os.path.getsize(tmp_path))
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def call_gemini_image(prompt, prefix='image'):
+    """Call Gemini image generation via google.genai library.
+    Images are stored under a hash of model + prompt, so an identical prompt is
+    served from disk instantly. A claim file makes concurrent identical requests
+    (in any worker process) wait for a single render, and the file is written
+    atomically so readers never see a partial image.
+    """
+    stored, claim = claim_image_render(prompt, prefix)
+    if stored:
+        return stored
+    filename, out_path, claim_path = claim
+    try:
+        def _render():
+            with provider_gates['gemini_image'].admit(), track_stage('gemini_image', prefix) as stage:
+                with gemini_connection_usage('Gemini image'):
+                    response = get_genai_client().models.generate_content(
+                        model=GEMINI_IMAGE_MODEL,
+                        contents=[prompt],
+                        config=_gemini_request_config()
+                    )
+                save_image_response(response, out_path, stage)
+
+        with_retries(_render, 'gemini_image', prefix)
+        return artifact_store.register(filename)
+
+    except Exception as e:
+        print(f"Gemini image error: {e}")
+        raise
+    finally:
+        release_image_claim(claim_path)
+
+# ----------------------
+# Image variants
+# ----------------------
+IMAGE_VARIANT_FORMATS = [('webp', 'WEBP', IMAGE_WEBP_QUALITY), ('jpeg', 'JPEG', IMAGE_JPEG_QUALITY)]
+
+
+def _save_atomic(img, out_path, pil_format, **params):
+	tmp_path = f"{out_path}.{uuid.uuid4().hex[:8]}.tmp"
+	try:
+		img.save(tmp_path, format=pil_format, **params)
+		os.replace(tmp_path, out_path)
+	finally:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+
+
+def build_image_variants(src_path):
+	"""Write WebP and JPEG copies of a generated image at IMAGE_VARIANT_WIDTHS plus a tiny
+	blurred placeholder, and return a manifest the page can turn into srcset/<picture>.
+	Variants are named after the (content-addressed) source, so existing ones are reused.
+	The original stays untouched for the PDF path.
+	"""
+	stem, _ = os.path.splitext(os.path.basename(src_path))
+	original_bytes = os.path.getsize(src_path)
+	with track_stage('image_processing', 'variants') as stage, PILImage.open(src_path) as img:
+		img.load()
+		width, height = img.size
+		rgb = img.convert('RGB') if img.mode != 'RGB' else img
+		manifest = {
+			'original': {'url': output_url(src_path), 'width': width, 'height': height, 'bytes': original_bytes},
+			'webp': [],
+			'jpeg': []
+		}
+		widths = sorted({w for w in IMAGE_VARIANT_WIDTHS if w < width} | {min(width, max(IMAGE_VARIANT_WIDTHS or [width]))})
+		for target_width in widths:
+			target_height = max(1, round(height * target_width / width))
+			resized = None
+			for key, pil_format, quality in IMAGE_VARIANT_FORMATS:
+				variant_name = f"{stem}_w{target_width}.{'jpg' if key == 'jpeg' else key}"
+				variant_path = artifact_store.lookup(variant_name)
+				if variant_path is None:
+					if resized is None:
+						resized = rgb.resize((target_width, target_height), PILImage.LANCZOS, reducing_gap=3.0)
+					_save_atomic(resized, artifact_store.path_for(variant_name), pil_format, quality=quality, optimize=True)
+					variant_path = artifact_store.register(variant_name)
+					stage.add_bytes(os.path.getsize(variant_path), 'written')
+				manifest[key].append({
+					'width': target_width,
+					'url': output_url(variant_path),
+					'bytes': os.path.getsize(variant_path)
+				})
+
+		thumb = rgb.resize((24, max(1, round(height * 24 / width))), PILImage.BILINEAR)
+		buf = BytesIO()
+		thumb.save(buf, format='JPEG', quality=40)
+		manifest['placeholder'] = 'data:image/jpeg;base64,' + base64.b64encode(buf.getvalue()).decode('ascii')
+
+	for key, _, _ in IMAGE_VARIANT_FORMATS:
+		manifest[f'{key}_srcset'] = ', '.join(f"{v['url']} {v['width']}w" for v in manifest[key])
+	largest_webp = manifest['webp'][-1]['bytes'] if manifest['webp'] else original_bytes
+	saved = 100 - round(100 * largest_webp / original_bytes) if original_bytes else 0
+	print(f"[DEBUG] Image variants for {stem}: original {original_bytes // 1024} KB -> "
+		f"largest WebP {largest_webp // 1024} KB ({saved}% lighter)")
+	return manifest
+
+
+# ----------------------
+# PDF image preparation
+# ----------------------
+def resolve_static_image(ref):
+	"""Map an image URL or path sent by the client to a file under static/ (or the artifact store).
+	Absolute URLs pointing back at this app are resolved from disk as well; returns
+	None for anything that isn't one of our static files (including path traversal).
+	"""
+	path = urlparse(ref).path if ref.startswith(('http://', 'https://')) else ref
+	path = '/' + path.lstrip('/')
+	if path.startswith('/media/'):
+		return artifact_store.lookup(path[len('/media/'):])
+	static_prefix = app.static_url_path.rstrip('/') + '/'
+	if not path.startswith(static_prefix):
+		return None
+	path = path[len(static_prefix):]
+	static_root = os.path.realpath(app.static_folder)
+	local_path = os.path.realpath(os.path.join(static_root, path))
+	if not local_path.startswith(static_root + os.sep) or not os.path.isfile(local_path):
+		return None
+	return local_path
+
+
+class PreparedImageCache:
+	"""JPEG bytes of PDF-ready images, kept in a small memory LRU and on disk.
+	Entries are keyed by the source file's identity (path, size, mtime) plus how it
+	was prepared, so repeat exports of a story skip PIL entirely.
+	"""
+
+	def __init__(self, cache_dir, memory_entries):
+		self.cache_dir = cache_dir
+		self.memory_entries = memory_entries
+		self._memory = OrderedDict()
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def make_key(*parts):
+		return hashlib.sha256('|'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+	def get_or_build(self, key, build):
+		with self._lock:
+			if key in self._memory:
+				self._memory.move_to_end(key)
+				return self._memory[key]
+		disk_path = os.path.join(self.cache_dir, f"{key}.jpg")
+		if os.path.exists(disk_path):
+			with open(disk_path, 'rb') as f:
+				data = f.read()
+			DirectorySweeper.touch(disk_path)
+		else:
+			data = build()
+			tmp_path = f"{disk_path}.{uuid.uuid4().hex[:8]}.tmp"
+			with open(tmp_path, 'wb') as f:
+				f.write(data)
+			os.replace(tmp_path, disk_path)
+		with self._lock:
+			self._memory[key] = data
+			while len(self._memory) > self.memory_entries:
+				self._memory.popitem(last=False)
+		return data
+
+
+pdf_image_cache = PreparedImageCache(app.config['PDF_IMAGE_CACHE'], PDF_IMAGE_CACHE_ENTRIES)
+
+
+def _open_pdf_source(ref):
+	"""Return (identity, opener) for an image reference; only true remote URLs go over HTTP."""
+	local_path = resolve_static_image(ref)
+	if local_path:
+		st = os.stat(local_path)
+		return (local_path, st.st_size, st.st_mtime_ns), lambda: PILImage.open(local_path)
+	if ref.startswith(('http://', 'https://')):
+		content = requests.get(ref, timeout=5).content
+		return (hashlib.sha256(content).hexdigest(),), lambda: PILImage.open(BytesIO(content))
+	raise FileNotFoundError(f"Image not found: {ref}")
+
+
+def _fit_jpeg(opener, size, opacity=None):
+	with track_stage('image_processing', 'pdf_background' if opacity is not None else 'pdf_hero') as stage:
+		with opener() as img:
+			img.draft('RGB', size)  # cheap JPEG-only downscale while decoding
+			rgb = img.convert('RGB')
+		# Downscale first so the blend runs at page resolution, not the source's
+		rgb = rgb.resize(size, PILImage.LANCZOS, reducing_gap=3.0)
+		if opacity is not None:
+			# Blend onto white at low opacity (more reliable than relying on alpha channel in ReportLab)
+			white_bg = PILImage.new('RGB', size, (255, 255, 255))
+			rgb = PILImage.blend(white_bg, rgb, opacity)
+		buf = BytesIO()
+		rgb.save(buf, format='JPEG', quality=85, optimize=True)
+		stage.add_bytes(buf.tell(), 'written')
+		return buf.getvalue()
+
+
+def prepare_pdf_background(ref, opacity=PDF_BACKGROUND_OPACITY):
+	"""JPEG bytes of the background blended onto white, already at letter-page resolution."""
+	page_px = (int(letter[0] / 72 * PDF_IMAGE_DPI), int(letter[1] / 72 * PDF_IMAGE_DPI))
+	identity, opener = _open_pdf_source(ref)
+	key = PreparedImageCache.make_key('background', *identity, opacity, page_px)
+	return pdf_image_cache.get_or_build(key, lambda: _fit_jpeg(opener, page_px, opacity))
+
+
+def prepare_pdf_hero(ref, width_in=5, height_in=3):
+	"""JPEG bytes of the hero scene sized for its inline slot in the PDF."""
+	slot_px = (int(width_in * PDF_IMAGE_DPI), int(height_in * PDF_IMAGE_DPI))
+	identity, opener = _open_pdf_source(ref)
+	key = PreparedImageCache.make_key('hero', *identity, slot_px)
+	return pdf_image_cache.get_or_build(key, lambda: _fit_jpeg(opener, slot_px))
+
+
+# ----------------------
+# Markdown documents
+# ----------------------
+class _KeepTree(Treeprocessor):
+	"""Runs after every other tree processor and leaves the finished tree on the parser."""
+
+	def run(self, root):
+		self.md.document_tree = root
+
+
+class _KeepTreeExtension(Extension):
+	def extendMarkdown(self, md_instance):
+		md_instance.treeprocessors.register(_KeepTree(md_instance), 'keep_tree', -100)
+
+
+class MarkdownDocument:
+	"""One parse of a Markdown text: its element tree, the HTML serialized from that tree and
+	the raw-HTML blocks (e.g. fenced code) the tree refers to by placeholder."""
+
+	def __init__(self, tree, html, stash):
+		self.tree = tree
+		self.html = html
+		self.stash = stash
+
+
+class MarkdownDocumentCache:
+	"""Parsed MarkdownDocuments in a memory LRU keyed by the text's content hash, so a story or
+	analogy is parsed once however often its HTML is served or its PDF rebuilt. Each thread
+	reuses one Markdown parser (they aren't thread-safe) instead of constructing one per call.
+	"""
+
+	EXTENSIONS = ['fenced_code', 'tables', 'nl2br']
+
+	def __init__(self, memory_entries):
+		self.memory_entries = memory_entries
+		self.hits = 0
+		self.misses = 0
+		self._memory = OrderedDict()
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+	def _parser(self):
+		parser = getattr(self._local, 'parser', None)
+		if parser is None:
+			parser = self._local.parser = md.Markdown(extensions=self.EXTENSIONS + [_KeepTreeExtension()])
+		return parser
+
+	def parse(self, text):
+		parser = self._parser().reset()
+		if not text.strip():
+			# convert() returns early on blank input without running the tree processors
+			return MarkdownDocument(ElementTree.Element(parser.doc_tag), '', [])
+		html = parser.convert(text)
+		return MarkdownDocument(parser.document_tree, html, list(parser.htmlStash.rawHtmlBlocks))
+
+	def get(self, text, cache=True):
+		"""The MarkdownDocument for `text`; cache=False parses without storing (e.g. a story still streaming)."""
+		if not cache:
+			return self.parse(text)
+		key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+		with self._lock:
+			if key in self._memory:
+				self._memory.move_to_end(key)
+				self.hits += 1
+				return self._memory[key]
+			self.misses += 1
+		document = self.parse(text)
+		with self._lock:
+			self._memory[key] = document
+			while len(self._memory) > self.memory_entries:
+				self._memory.popitem(last=False)
+		return document
+
+	def stats(self):
+		with self._lock:
+			return {'entries': len(self._memory), 'hits_total': self.hits, 'misses_total': self.misses}
+
+
+markdown_documents = MarkdownDocumentCache(MARKDOWN_CACHE_ENTRIES)
+
+
+def render_markdown_html(text, cache=True):
+	"""Render agent Markdown to HTML for the client, falling back to preformatted text."""
+	try:
+		return markdown_documents.get(text or '', cache).html
+	except Exception:
+		return '<pre>' + (text or '') + '</pre>'
+
+
+class MarkdownBlockStream:
+	"""Renders streamed Markdown one completed block at a time, so a story stream does O(n)
+	rendering work instead of re-rendering everything received so far on every chunk.
+	A block ends at a blank line outside a code fence; the block still being written is
+	kept as the raw tail for the client to show as text until it completes.
+	"""
+
+	_FENCE = re.compile(r'^\s*(```|~~~)')
+
+	def __init__(self):
+		self.tail = ''
+
+	def feed(self, delta):
+		"""Add a delta; returns the HTML of the blocks it completed ('' if none)."""
+		self.tail += delta
+		cut = self._last_boundary()
+		if cut is None:
+			return ''
+		done, self.tail = self.tail[:cut], self.tail[cut:]
+		return render_markdown_html(done, cache=False)
+
+	def _last_boundary(self):
+		cut = None
+		in_fence = False
+		offset = 0
+		lines = self.tail.split('\n')
+		# The last line may still be growing, so it can't close a block yet
+		for line in lines[:-1]:
+			offset += len(line) + 1
+			if self._FENCE.match(line):
+				in_fence = not in_fence
+			elif not in_fence and not line.strip() and self.tail[:offset].strip():
+				cut = offset
+		return cut
+
 
+# Markers Python-Markdown leaves in the tree: stashed raw HTML, backslash escapes and '&' in entities
+_STASH_PLACEHOLDER = re.compile(r'\x02wzxhzdk:(\d+)\x03')
+_ESCAPED_CHAR = re.compile(r'\x02(\d+)\x03')
+_AMP_SUBSTITUTE = '\x02amp\x03'
 
-def call_gemini_image(prompt, filename):
-    """Call Gemini image generation via google.genai library."""
-    out_path = os.path.join(app.config['STATIC_OUTPUT'], filename)
-    try:
-        client = genai.Client(api_key=GOOGLE_API_KEY)
-        response = client.models.generate_content(
-            model=GEMINI_IMAGE_MODEL,
-            contents=[prompt]
-        )
 
-        # --- FIXED IMAGE EXTRACTION (matches official docs) ---
-        image_obj = None
-        for part in response.parts:
-            if part.inline_data is not None:
-                image_obj = part.as_image()
-                break  # first image only
+def _pdf_text(text, stash):
+	"""Escaped ReportLab text for a tree string: stashed raw HTML becomes its plain text."""
+	if not text:
+		return ''
+	text = _STASH_PLACEHOLDER.sub(lambda m: re.sub(r'<[^>]+>', '', stash[int(m.group(1))]) if int(m.group(1)) < len(stash) else '', text)
+	text = _ESCAPED_CHAR.sub(lambda m: chr(int(m.group(1))), text).replace(_AMP_SUBSTITUTE, '&')
+	return xml_escape(html_unescape(text))
 
-        if image_obj is None:
-            raise ValueError("No image returned from Gemini.")
 
-        # Save it
-        image_obj.save(out_path)
+def _inline_markup(el, stash):
+	"""ReportLab paragraph markup for an element's inline content."""
+	parts = [_pdf_text(el.text, stash)]
+	for child in el:
+		inner = _inline_markup(child, stash)
+		if child.tag in ('strong', 'b'):
+			parts.append(f"<b>{inner}</b>")
+		elif child.tag in ('em', 'i'):
+			parts.append(f"<i>{inner}</i>")
+		elif child.tag == 'code':
+			parts.append(f'<font face="Courier">{inner}</font>')
+		elif child.tag == 'a' and child.get('href'):
+			parts.append(f'<link href="{xml_escape(child.get("href"), {chr(34): "&quot;"})}"><u>{inner}</u></link>')
+		elif child.tag == 'br':
+			parts.append('<br/>')
+		elif child.tag in ('p', 'ul', 'ol', 'li') and inner:
+			# Block content nested in a list item: keep it on its own line
+			parts.append(f"<br/>{inner}" if ''.join(parts).strip() else inner)
+		else:
+			parts.append(inner)
+		parts.append(_pdf_text(child.tail, stash))
+	return ''.join(parts)
 
-        return out_path
 
-    except Exception as e:
-        print(f"Gemini image error: {e}")
-        raise
+def _block_flowables(el, stash, styles, out):
+	body, heading, code = styles
+	tag = el.tag
+	if tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+		out.append(Paragraph(_inline_markup(el, stash), heading))
+	elif tag == 'p':
+		placeholder = _STASH_PLACEHOLDER.fullmatch((el.text or '').strip()) if len(el) == 0 else None
+		if placeholder:
+			# A fenced code block (or other raw HTML block) keeps its line breaks
+			out.append(Preformatted(html_unescape(re.sub(r'<[^>]+>', '', stash[int(placeholder.group(1))])).strip('\n'), code))
+		else:
+			out.append(Paragraph(_inline_markup(el, stash), body))
+	elif tag in ('ul', 'ol'):
+		for n, item in enumerate(el.findall('li'), 1):
+			bullet = f"{n}." if tag == 'ol' else '\u2022'
+			out.append(Paragraph(_inline_markup(item, stash), body, bulletText=bullet))
+	elif tag == 'blockquote':
+		quoted = ParagraphStyle(f"{body.name}Quote", parent=body, leftIndent=body.leftIndent + 18, textColor=colors.HexColor("#555555"))
+		for child in el:
+			_block_flowables(child, stash, (quoted, heading, code), out)
+	elif tag == 'pre':
+		out.append(Preformatted(''.join(el.itertext()).strip('\n'), code))
+	elif tag == 'hr':
+		out.append(HRFlowable(width='100%', color=colors.HexColor("#cccccc"), spaceBefore=6, spaceAfter=6))
+	elif tag == 'table':
+		rows = [[Paragraph(_inline_markup(cell, stash), body) for cell in row] for row in el.iter('tr')]
+		if rows:
+			table = Table(rows, repeatRows=1 if el.find('thead') is not None else 0)
+			table.setStyle(TableStyle([('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor("#cccccc")), ('VALIGN', (0, 0), (-1, -1), 'TOP')]))
+			out.append(table)
+	elif len(el):
+		for child in el:
+			_block_flowables(child, stash, styles, out)
+	elif el.text and el.text.strip():
+		out.append(Paragraph(_pdf_text(el.text, stash), body))
+
+
+def markdown_flowables(text, body_style, heading_style):
+	"""ReportLab flowables for a Markdown text, built from the same cached parse as its HTML,
+	so bold, italics, lists and headings survive into the PDF."""
+	document = markdown_documents.get(text or '')
+	code_style = ParagraphStyle(f"{body_style.name}Code", parent=body_style, fontName='Courier', fontSize=body_style.fontSize - 1, alignment=TA_LEFT)
+	flowables = []
+	for el in document.tree:
+		_block_flowables(el, document.stash, (body_style, heading_style, code_style), flowables)
+	return flowables
+
+
+# ----------------------
+# Background music
+# ----------------------
+class BgmStream:
+	"""One BGM track while ElevenLabs is still composing it. Upstream chunks are appended to
+	<file>.part as they arrive and every /stream_bgm/<id> listener reads that file behind the
+	writer, so playback starts with the first chunk and late joiners simply start from the
+	top. Once complete the .part file becomes a registered artifact and the stream URL
+	redirects to its immutable /media URL.
+	"""
+
+	KEEP = 600  # seconds a stream stays addressable after it was opened
+
+	def __init__(self, filename):
+		self.id = uuid.uuid4().hex
+		self.filename = filename
+		self.path = artifact_store.path_for(filename)
+		self.part_path = self.path + '.part'
+		self.created = time.time()
+		self.size = 0
+		self.attempt = 0
+		self.done = False
+		self.error = None
+		self._file = None
+		self._cond = threading.Condition()
+
+	def begin(self):
+		"""(Re)start the track: a retried compose replaces whatever an earlier attempt wrote."""
+		with self._cond:
+			if self._file:
+				self._file.close()
+			self._file = open(self.part_path, 'wb')
+			self.size = 0
+			self.attempt += 1
+			self._cond.notify_all()
+
+	def write(self, chunk):
+		# Flush before publishing the new size, so readers never see bytes that aren't on disk
+		self._file.write(chunk)
+		self._file.flush()
+		with self._cond:
+			self.size += len(chunk)
+			self._cond.notify_all()
+
+	def finish(self):
+		"""Move the finished track into the artifact store; returns its path."""
+		with self._cond:
+			self._file.close()
+			self._file = None
+			os.replace(self.part_path, self.path)
+		path = artifact_store.register(self.filename)
+		with self._cond:
+			self.done = True
+			self._cond.notify_all()
+		return path
+
+	def fail(self, error):
+		with self._cond:
+			if self._file:
+				self._file.close()
+				self._file = None
+			self.error = str(error)
+			self.done = True
+			self._cond.notify_all()
+		try:
+			os.remove(self.part_path)
+		except FileNotFoundError:
+			pass
+
+	def open_reader(self):
+		"""(file, attempt) for a new listener, or None once the track is complete or failed.
+		Opened under the lock, so finish() can't rename the .part file in between."""
+		with self._cond:
+			if self.done or self.attempt == 0:
+				return None
+			return open(self.part_path, 'rb'), self.attempt
+
+	def wait(self, offset, attempt, timeout):
+		"""Block until more than `offset` bytes exist, the track ends or restarts; returns (size, attempt, done)."""
+		with self._cond:
+			self._cond.wait_for(lambda: self.size > offset or self.done or self.attempt != attempt, timeout=timeout)
+			return self.size, self.attempt, self.done
+
+	def iter_chunks(self, f, attempt, chunk_size=64 * 1024, idle_timeout=30):
+		"""Yield the track from the start as it is written, given an open_reader() pair; a
+		listener that joined before a retry restarted the track is cut off rather than
+		spliced onto the new attempt."""
+		offset = 0
+		try:
+			while True:
+				size, current, _ = self.wait(offset, attempt, idle_timeout)
+				if current != attempt:
+					return
+				if size > offset:
+					data = f.read(min(size - offset, chunk_size))
+					offset += len(data)
+					yield data
+				else:
+					# Complete (or failed), or nothing new for idle_timeout seconds
+					return
+		finally:
+			f.close()
+
+
+_bgm_streams = {}
+_bgm_streams_lock = threading.Lock()
+
+
+def register_bgm_stream(filename):
+	"""Create a BgmStream, make it visible to /stream_bgm and drop ones older than BgmStream.KEEP."""
+	stream = BgmStream(filename)
+	cutoff = time.time() - BgmStream.KEEP
+	with _bgm_streams_lock:
+		for stream_id in [k for k, v in _bgm_streams.items() if v.created < cutoff]:
+			del _bgm_streams[stream_id]
+		_bgm_streams[stream.id] = stream
+	return stream
+
+
+def get_bgm_stream(stream_id):
+	with _bgm_streams_lock:
+		return _bgm_streams.get(stream_id)
 
-def generate_bgm_instrumental(world_description, character_description, filename):
+
+def bgm_stream_url(stream):
+	return f"/stream_bgm/{stream.id}"
+
+
+def start_bgm_stream(world, character, timeout=60):
+	"""Compose a track on the deadline pool and return (future, stream) as soon as audio starts
+	flowing; stream is None when the work ended (or failed) before getting that far, or when
+	no audio arrived within `timeout` (the future is then abandoned)."""
+	started = threading.Event()
+	opened = []
+
+	def _on_stream(stream):
+		opened.append(stream)
+		started.set()
+
+	future = deadline_executor.submit(build_bgm_result, world, character, timeout, on_stream=_on_stream, timeout=timeout)
+	future.add_done_callback(lambda _: started.set())
+	if not started.wait(timeout):
+		# Pool saturated or stalled before the first chunk: don't hold the request thread
+		deadline_executor.abandon(future)
+	return future, (opened[0] if opened else None)
+
+
+def post_music_request(url, headers, body, timeout):
+	"""POST to the ElevenLabs music endpoint (or its offline fake) and return the streamed response."""
+	if MUSIC_PROVIDER == 'fake':
+		import fake_providers
+		return fake_providers.post_music(url, headers=headers, json=body, stream=True, timeout=timeout)
+	return requests.post(url, headers=headers, json=body, stream=True, timeout=timeout)
+
+
+def music_prompt_request(world_description, character_description):
+	"""Gemini prompt that writes the ElevenLabs music prompt for a story."""
+	return f'''You are a music-prompt writer for ElevenLabs Music generation. 
+		Given a fantasy/sci-fi world description and a character description, write ONE single music prompt string.
+
+		Requirements:
+		- Make it usable directly as a generation prompt (no analysis, no bullet points, no extra commentary).
+		- Include: genre/style + mood + instrumentation + production/texture adjectives.
+		- Suggest light structure in plain language (e.g., “slow build → heroic lift → calm resolve”), but keep it short.
+		- Optional: include tempo (BPM) and key only if you are confident; otherwise omit.
+		- Avoid copyrighted references or named existing songs.
+		- Keep it 1–3 sentences, dense but readable, with strong descriptive nouns/adjectives.
+
+		Inputs:
+		World: {world_description}
+		Character: {character_description}
+
+		Output:
+		Return only the final music prompt string.
+	'''.strip()
+
+
+def fallback_music_prompt(world_description, character_description):
+	"""Music prompt used when Gemini didn't produce one."""
+	return (
+		f"Instrumental cinematic fantasy theme for a hero's adventure. "
+		f"World: {world_description}. "
+		f"Character: {character_description}. "
+		f"Tone: emotional, adventurous, atmospheric, warm, slightly whimsical. "
+		f"Focus on orchestral textures, light percussion, gentle strings."
+	)
+
+
+def elevenlabs_music_request(music_prompt):
+	"""(url, headers, body) of the ElevenLabs compose request for a music prompt."""
+	url = "https://api.elevenlabs.io/v1/music"
+	headers = {
+		"xi-api-key": ELEVENLABS_API_KEY,
+		"Content-Type": "application/json"
+	}
+	body = {
+		# Use the correct field names from ElevenLabs docs
+		"prompt": music_prompt,          # You can’t use both "prompt" + "text"
+		"music_length_ms": 60000,        # 60 seconds in ms
+		"output_format": "mp3_44100_128",
+		"force_instrumental": True       # Ensures no vocals
+	}
+	return url, headers, body
+
+
+def generate_bgm_instrumental(world_description, character_description, filename, on_stream=None, cancel=None):
 	"""
 	Generate ~30 seconds of instrumental background music using ElevenLabs.
 	Music is based on the worldbuilding and tone of the story.
+	The track is tee-streamed through a BgmStream; on_stream(stream) is called once the
+	first attempt starts receiving audio, so a player can start on /stream_bgm/<id>.
+	Setting the `cancel` event stops the composition at its next chunk (WorkCancelled).
 	"""
-	out_path = os.path.join(app.config['STATIC_OUTPUT'], filename)
+	def _check_cancel():
+		if cancel is not None and cancel.is_set():
+			raise WorkCancelled('BGM no longer wanted')
+
+	stream = register_bgm_stream(filename)
 	try:
 		# ---- Ask Gemini to craft a concise music-generation prompt -----
-		prompt_req = f'''You are a music-prompt writer for ElevenLabs Music generation. 
-			Given a fantasy/sci-fi world description and a character description, write ONE single music prompt string.
-
-			Requirements:
-			- Make it usable directly as a generation prompt (no analysis, no bullet points, no extra commentary).
-			- Include: genre/style + mood + instrumentation + production/texture adjectives.
-			- Suggest light structure in plain language (e.g., “slow build → heroic lift → calm resolve”), but keep it short.
-			- Optional: include tempo (BPM) and key only if you are confident; otherwise omit.
-			- Avoid copyrighted references or named existing songs.
-			- Keep it 1–3 sentences, dense but readable, with strong descriptive nouns/adjectives.
-
-			Inputs:
-			World: {world_description}
-			Character: {character_description}
-
-			Output:
-			Return only the final music prompt string.
-		'''.strip()
+		prompt_req = music_prompt_request(world_description, character_description)
 		try:
-			gem = run_with_timeout(lambda: call_gemini_text(prompt_req), timeout=20)
+			gem = run_with_timeout(lambda: call_gemini_text(prompt_req, purpose='music_prompt'), timeout=text_route('music_prompt')['timeout'])
 			music_prompt = (gem.get('raw') if isinstance(gem, dict) else str(gem)) or ''
 			music_prompt = music_prompt.strip()
 			print(f"[DEBUG] Gemini BGM raw response (truncated): {music_prompt[:400]}")
@@ -112,174 +2356,894 @@ def generate_bgm_instrumental(world_description, character_description, filename
 
 		# Fallback prompt if Gemini didn't produce one
 		if not music_prompt:
-			music_prompt = (
-				f"Instrumental cinematic fantasy theme for a hero's adventure. "
-				f"World: {world_description}. "
-				f"Character: {character_description}. "
-				f"Tone: emotional, adventurous, atmospheric, warm, slightly whimsical. "
-				f"Focus on orchestral textures, light percussion, gentle strings."
-			)
+			music_prompt = fallback_music_prompt(world_description, character_description)
 		print(f"[DEBUG] Music prompt used (truncated): {music_prompt[:400]}")
 
-		# ---- ElevenLabs compose endpoint --------------------------------
-		url = "https://api.elevenlabs.io/v1/music"
-		headers = {
-			"xi-api-key": ELEVENLABS_API_KEY,
-			"Content-Type": "application/json"
-		}
+		# ---- ElevenLabs compose endpoint (stream audio chunks) ----------
+		url, headers, body = elevenlabs_music_request(music_prompt)
 
-		body = {
-			# Use the correct field names from ElevenLabs docs
-			"prompt": music_prompt,          # You can’t use both "prompt" + "text"
-			"music_length_ms": 60000,        # 60 seconds in ms
-			"output_format": "mp3_44100_128",
-			"force_instrumental": True       # Ensures no vocals
-		}
+		def _compose():
+			_check_cancel()
+			with provider_gates['elevenlabs'].admit(), track_stage('elevenlabs', 'music') as stage:
+				stage.add_bytes(len(json.dumps(body).encode('utf-8')), 'sent')
+				resp = post_music_request(url, headers, body, timeout=request_timeout(90))
 
-		# ---- POST request (stream audio chunks) -------------------------
-		resp = requests.post(url, headers=headers, json=body, stream=True, timeout=90)
+				with contextlib.closing(resp):
+					if resp.status_code != 200:
+						raise UpstreamHTTPError('ElevenLabs', resp.status_code, resp.text)
+					stream.begin()
+					if on_stream and stream.attempt == 1:
+						on_stream(stream)
+					for chunk in resp.iter_content(chunk_size=8192):
+						# Closing the response drops the upstream connection, ending the paid render
+						_check_cancel()
+						if chunk:
+							stream.write(chunk)
+							stage.add_bytes(len(chunk))
 
-		if resp.status_code == 200:
-			with open(out_path, "wb") as f:
-				for chunk in resp.iter_content(chunk_size=8192):
-					if chunk:
-						f.write(chunk)
-			return out_path, music_prompt
-		else:
-			raise RuntimeError(f"ElevenLabs error {resp.status_code}: {resp.text}")
+		with_retries(_compose, 'elevenlabs', 'music')
+		return stream.finish(), music_prompt
 
 	except Exception as e:
 		print(f"BGM generation error: {e}")
+		stream.fail(e)
 		raise
 
 
 # ----------------------
 # Helpers for agent workflow
 # ----------------------
-def run_with_timeout(fn, *args, timeout=80, **kwargs):
-	"""Run function in a separate thread and raise TimeoutError if it exceeds timeout seconds."""
-	with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
-		future = ex.submit(fn, *args, **kwargs)
+class DeadlineExecutor:
+	"""Bounded, process-wide thread pool whose callers return at their deadline.
+
+	A task that misses its deadline is never waited for: it is cancelled if it
+	has not started yet, otherwise it is left to finish in the background and
+	counted as abandoned. Calls made from inside a pool worker run inline under
+	the tighter of the two deadlines, so nested timeouts never queue behind a
+	saturated pool. Provider calls read `remaining()` to bound their own I/O.
+	"""
+
+	def __init__(self, max_workers):
+		self.max_workers = max_workers
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._pool = self._new_pool()
+		self._queued = 0
+		self._running = 0
+		self._abandoned = 0
+		self._abandoned_total = 0
+
+	def _new_pool(self):
+		return concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='deadline')
+
+	def reset_after_fork(self):
+		# Worker threads don't survive a fork; start over with an empty pool
+		self._lock = threading.Lock()
+		self._pool = self._new_pool()
+		self._queued = self._running = self._abandoned = 0
+
+	def current_deadline(self):
+		return getattr(self._local, 'deadline', None)
+
+	def remaining(self):
+		"""Seconds left before the current thread's deadline, or None if unbounded."""
+		deadline = self.current_deadline()
+		return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+	def in_worker(self):
+		return getattr(self._local, 'in_worker', False)
+
+	def _deadline_for(self, timeout):
+		deadline = time.monotonic() + timeout if timeout is not None else None
+		parent = self.current_deadline()
+		if parent is not None and (deadline is None or parent < deadline):
+			deadline = parent
+		return deadline
+
+	def _run(self, fn, deadline, args, kwargs):
+		with self._lock:
+			self._queued -= 1
+			self._running += 1
+		self._local.in_worker = True
+		self._local.deadline = deadline
+		try:
+			if deadline is not None and time.monotonic() >= deadline:
+				raise TimeoutError(f"{_fn_name(fn)} expired before it started")
+			return fn(*args, **kwargs)
+		finally:
+			self._local.in_worker = False
+			self._local.deadline = None
+			with self._lock:
+				self._running -= 1
+
+	def _run_inline(self, fn, deadline, timeout, args, kwargs):
+		previous = self.current_deadline()
+		self._local.deadline = deadline
+		try:
+			if deadline is not None and time.monotonic() >= deadline:
+				raise TimeoutError(f"{_fn_name(fn)} timed out after {timeout} seconds")
+			result = fn(*args, **kwargs)
+		finally:
+			self._local.deadline = previous
+		if deadline is not None and time.monotonic() > deadline:
+			raise TimeoutError(f"{_fn_name(fn)} timed out after {timeout} seconds")
+		return result
+
+	def submit(self, fn, *args, timeout=None, **kwargs):
+		"""Schedule fn on the pool under an optional deadline and return its future."""
+		deadline = self._deadline_for(timeout)
+		with self._lock:
+			self._queued += 1
+		return self._pool.submit(self._run, fn, deadline, args, kwargs)
+
+	def submit_if_idle(self, fn, *args, timeout=None, **kwargs):
+		"""submit() only when a worker is free to start fn at once; None otherwise.
+		Capacity is checked and claimed under one lock, so concurrent callers can't overfill the pool."""
+		deadline = self._deadline_for(timeout)
+		with self._lock:
+			if self._running + self._queued >= self.max_workers:
+				return None
+			self._queued += 1
+		return self._pool.submit(self._run, fn, deadline, args, kwargs)
+
+	def abandon(self, future):
+		"""Stop waiting for a future: cancel it if queued, otherwise let it run out unobserved."""
+		if future.cancel():
+			with self._lock:
+				self._queued -= 1
+			return
+		with self._lock:
+			self._abandoned += 1
+			self._abandoned_total += 1
+		def _settled(_):
+			with self._lock:
+				self._abandoned -= 1
+		future.add_done_callback(_settled)
+
+	def run(self, fn, *args, timeout=80, **kwargs):
+		deadline = self._deadline_for(timeout)
+		if self.in_worker():
+			return self._run_inline(fn, deadline, timeout, args, kwargs)
+		future = self.submit(fn, *args, timeout=timeout, **kwargs)
+		if deadline is None:
+			return future.result()
 		try:
-			return future.result(timeout=timeout)
+			return future.result(timeout=max(0.0, deadline - time.monotonic()))
 		except concurrent.futures.TimeoutError:
-			raise TimeoutError(f"{fn.__name__} timed out after {timeout} seconds")
-		except Exception:
-			# Re-raise underlying exception for caller to handle
-			raise
+			if future.done():
+				# The function itself raised TimeoutError; surface it unchanged
+				raise
+			self.abandon(future)
+			raise TimeoutError(f"{_fn_name(fn)} timed out after {timeout} seconds")
 
+	def stats(self):
+		with self._lock:
+			return {
+				'max_workers': self.max_workers,
+				'queue_depth': self._queued,
+				'running': self._running,
+				'abandoned': self._abandoned,
+				'abandoned_total': self._abandoned_total
+			}
 
-def generate_story_text(character, world, timeout=60):
-	prompt = (
+
+def _fn_name(fn):
+	return getattr(fn, '__name__', fn.__class__.__name__)
+
+
+deadline_executor = DeadlineExecutor(DEADLINE_POOL_WORKERS)
+os.register_at_fork(after_in_child=deadline_executor.reset_after_fork)
+
+
+def run_with_timeout(fn, *args, timeout=80, **kwargs):
+	"""Run function on the shared deadline pool and raise TimeoutError once timeout seconds pass.
+	Returns at the deadline even if fn is still running; nested calls inherit the outer deadline.
+	"""
+	return deadline_executor.run(fn, *args, timeout=timeout, **kwargs)
+
+
+def request_timeout(default):
+	"""Per-request I/O timeout in seconds, clipped to the current thread's deadline."""
+	remaining = deadline_executor.remaining()
+	if remaining is None:
+		return default
+	return max(1.0, min(default, remaining))
+
+
+def _gemini_request_config(default_timeout=120, deadline=None, **fields):
+	"""Per-call GenerateContentConfig that stops the HTTP request at the call's deadline
+	(a time.monotonic() value; else the current thread's deadline, if any).
+	"""
+	if deadline is not None:
+		timeout_ms = int(max(1.0, deadline - time.monotonic()) * 1000)
+		fields['http_options'] = types.HttpOptions(timeout=timeout_ms)
+	elif deadline_executor.remaining() is not None:
+		timeout_ms = int(request_timeout(default_timeout) * 1000)
+		fields['http_options'] = types.HttpOptions(timeout=timeout_ms)
+	return types.GenerateContentConfig(**fields) if fields else None
+
+
+def output_url(path):
+	"""Public /media URL of a generated file; safe to call from job workers outside a request."""
+	return f"/media/{os.path.basename(path)}"
+
+
+def sse_event(kind, data, event_id=None):
+	"""Format one Server-Sent Events frame carrying a JSON payload."""
+	frame = f"id: {event_id}\n" if event_id is not None else ''
+	return frame + f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+
+
+def story_prompt(character, world):
+	return (
 		"Write an engaging ~800-word short story about an adventure of this hero in the world."
 		" The story should have a clear beginning, middle, climax and end, with detailed descriptions and emotional depth."
 		" Use cinematic, slightly whimsical style. Focus on deep philosophical ideas tied to the human condition."
 		" Respond in Markdown. Use bold and italics if necessary, but don't overuse subheadings (the story shouldn't have them)."
 		f"\n\nCharacter:\n{character}\n\nWorld:\n{world}\n"
 	)
+
+
+def generate_story_text(character, world, timeout=None):
+	prompt = story_prompt(character, world)
 	def _call():
-		resp = call_gemini_text(prompt)
+		resp = call_gemini_text(prompt, purpose='story')
 		return resp.get('raw', '')
-	return run_with_timeout(_call, timeout=timeout)
+	return run_with_timeout(_call, timeout=timeout or text_route('story')['timeout'])
+
+
+def stream_story_text(character, world, timeout=None):
+	"""Yield Markdown chunks of the story as Gemini produces them.
+	Raises TimeoutError if the whole stream takes longer than timeout seconds (default: the story route's budget).
+	"""
+	route = text_route('story')
+	timeout = timeout or route['timeout']
+	started = time.monotonic()
+	deadline = started + timeout
+	with track_stage('gemini_stream', 'story', route) as stage, gemini_connection_usage('Gemini story stream'):
+		prompt = story_prompt(character, world)
+		stage.add_bytes(len(prompt.encode('utf-8')), 'sent')
+
+		def _open():
+			# The request is only sent on first iteration, so pull the first chunk here:
+			# failures before any text has reached the client can still be retried.
+			# Each attempt takes its own gate slot and gives it back if it fails, so
+			# the backoff between retries doesn't hold one.
+			gate = contextlib.ExitStack()
+			gate.enter_context(provider_gates['gemini_text'].admit())
+			try:
+				left = max(1.0, deadline - time.monotonic())
+				stream = iter(get_genai_client().models.generate_content_stream(
+					model=route['model'],
+					contents=prompt,
+					config=types.GenerateContentConfig(http_options=types.HttpOptions(timeout=int(left * 1000)))
+				))
+				return gate, stream, next(stream, None)
+			except BaseException:
+				gate.close()
+				raise
 
+		gate, stream, first_chunk = with_retries(_open, 'gemini_text', 'story', deadline=deadline)
+		with gate:
+			first = True
+			for chunk in itertools.chain([first_chunk] if first_chunk is not None else [], stream):
+				if time.monotonic() > deadline:
+					raise TimeoutError(f"story stream timed out after {timeout} seconds")
+				if chunk.text:
+					if first:
+						metrics.observe('hero_stream_first_chunk_seconds', time.monotonic() - started, purpose='story')
+						first = False
+					stage.add_bytes(len(chunk.text.encode('utf-8')))
+					yield chunk.text
 
-def extract_hero_name(character, timeout=30):
+
+def hero_name_prompt(character):
+	return f"Extract just the character's name from this description: {character}. Output only the name, nothing else."
+
+
+def extract_hero_name(character, timeout=None):
+	"""The hero's name, or '' on failure. Without a timeout the call runs on this thread under
+	its route deadline, so from a request thread it can be hedged (see hedged_call)."""
 	def _call():
-		resp = call_gemini_text(f"Extract just the character's name from this description: {character}. Output only the name, nothing else.")
-		return resp.get('raw', '').strip()
+		resp = call_gemini_text(hero_name_prompt(character), purpose='hero_name')
+		return '' if resp.get('error') else resp.get('raw', '').strip()
 	try:
+		if timeout is None:
+			return _call()
 		return run_with_timeout(_call, timeout=timeout)
+	except ProviderBusy:
+		raise
 	except Exception:
 		return ''
 
 
-def generate_visual_prompt_and_image(world_text, story_text, prefix, timeout=80):
+def visual_prompt_request(world_text, story_text, in_context=False):
+	"""With in_context the world and story come from the StoryContext rather than the prompt."""
+	source = 'the world description and the story provided above' if in_context else 'the world description and the story excerpt below'
+	prompt = (
+		f"Extract the cinematic setting details from {source},"
+		" then produce ONE concise visual prompt suitable for a Studio Ghibli-style illustration."
+		" Include atmosphere, colors, landmarks, lighting, and mood; avoid mentioning specific copyrighted characters."
+		" Output only the final visual prompt in one paragraph."
+	)
+	if in_context:
+		return prompt
+	return prompt + f"\n\nWorld description:\n{world_text}\n\nStory excerpt:\n{(story_text)}\n\n"
+
+
+def generate_visual_prompt_and_image(world_text, story_text, prefix, timeout=None, context=None):
 	"""Return (prompt_text, image_url_or_None).
 	The Gemini prompt will be asked to extract the story setting from the story
 	and world description and produce a single visual prompt suitable for a
 	Studio Ghibli-style illustration.
 	"""
 	try:
-		prompt_req = (
-			"Extract the cinematic setting details from the world description and the story excerpt below,"
-			" then produce ONE concise visual prompt suitable for a Studio Ghibli-style illustration."
-			" Include atmosphere, colors, landmarks, lighting, and mood; avoid mentioning specific copyrighted characters."
-			" Output only the final visual prompt in one paragraph."
-			f"\n\nWorld description:\n{world_text}\n\nStory excerpt:\n{(story_text)}\n\n"
-		)
+		prompt_req = visual_prompt_request(world_text, story_text, in_context=context is not None)
 		def _gen_prompt():
-			resp = call_gemini_text(prompt_req)
+			resp = call_gemini_text(prompt_req, purpose='visual_prompt', context=context)
 			raw = resp.get('raw', '')
 			print(f"[DEBUG] Gemini visual raw response (truncated): {raw[:400]}")
 			return raw.strip()
 
-		visual_prompt = run_with_timeout(_gen_prompt, timeout=timeout)
-		if not visual_prompt:
-			print('[DEBUG] Visual prompt empty')
-			return None, None
+		visual_prompt = run_with_timeout(_gen_prompt, timeout=timeout or text_route('visual_prompt')['timeout'])
+		if not visual_prompt:
+			print('[DEBUG] Visual prompt empty')
+			return None, None
+
+		print(f"[DEBUG] Visual prompt generated: {visual_prompt[:300]}")
+
+		# generate image (may raise)
+		print(f"[DEBUG] Calling image generator with prompt (truncated): {visual_prompt[:200]}")
+		img_path = run_with_timeout(lambda: call_gemini_image(visual_prompt, prefix), timeout=60)
+		img_url = output_url(img_path)
+		print(f"[DEBUG] Image saved to: {img_path}")
+		return visual_prompt, img_url
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		print(f"[WARNING] Visual generation failed: {e}")
+		return None, None
+
+
+def hero_prompt_request(character, story_excerpt, in_context=False):
+	if in_context:
+		return (
+			"Generate a detailed visual description prompt for a Studio Ghibli-style cinematic scene illustration."
+			" Depict a dramatic moment from the story provided above with the hero in action, showing their unique"
+			" features and abilities as described in the character profile. Output only the visual prompt."
+		)
+	return (
+		f"Generate a detailed visual description prompt for a Studio Ghibli-style cinematic scene illustration."
+		f" Depict a dramatic moment of the hero in action, showing unique features and abilities."
+		f" Character: {character}. Story excerpt: {story_excerpt}. Output only the visual prompt."
+	)
+
+
+def generate_hero_scene_and_image(character, story_excerpt, timeout=None, context=None):
+	try:
+		prompt_req = hero_prompt_request(character, story_excerpt, in_context=context is not None)
+		def _gen():
+			resp = call_gemini_text(prompt_req, purpose='hero_prompt', context=context)
+			raw = resp.get('raw', '')
+			print(f"[DEBUG] Gemini hero-scene raw response (truncated): {raw[:400]}")
+			return raw.strip()
+
+		hero_prompt = run_with_timeout(_gen, timeout=timeout or text_route('hero_prompt')['timeout'])
+		if not hero_prompt:
+			return None, None
+		print(f"[DEBUG] Hero scene prompt generated: {hero_prompt[:300]}")
+		print(f"[DEBUG] Calling image generator for hero scene with prompt (truncated): {hero_prompt[:200]}")
+		img_path = run_with_timeout(lambda: call_gemini_image(hero_prompt, 'hero_scene'), timeout=60)
+		img_url = output_url(img_path)
+		print(f"[DEBUG] Hero image saved to: {img_path}")
+		return hero_prompt, img_url
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		print(f"[WARNING] Hero scene generation failed: {e}")
+		return None, None
+
+
+# Removed generate_bgm_wrapper; BGM generation now uses generate_bgm_instrumental directly
+
+
+def analogy_prompt(hero_name, story, in_context=False):
+	prompt = (
+		f"Extract the central theme of {'the hero story provided above' if in_context else 'this hero story'}."
+		" Then speak directly to the person who imagined this hero (the creator)."
+		" Suggest how this story's theme and the hero's journey can inspire them to embark on meaningful 'adventures' in real life."
+		" Be specific about life lessons and practical ways to embody the hero's spirit."
+		" Respond in Markdown. Use headings and bullet points where helpful."
+		" Keep the formatting condensed, no excessive newlines."
+		f"\n\nHero name: {hero_name}"
+	)
+	return prompt if in_context else prompt + f"\nStory:\n{story}"
+
+
+def generate_analogy_text(hero_name, story, timeout=None, context=None):
+	prompt = analogy_prompt(hero_name, story, in_context=context is not None)
+	def _call():
+		resp = call_gemini_text(prompt, purpose='analogy', context=context)
+		return resp.get('raw', '')
+	try:
+		return run_with_timeout(_call, timeout=timeout or text_route('analogy')['timeout'])
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		print(f"[WARNING] Analogy generation error: {e}")
+		return ''
+
+
+def build_image_result(itype, world, character, story_excerpt, context=None):
+	"""Generate a 'background' or 'hero' image; returns the /generate_image payload or None."""
+	if itype == 'background':
+		# Pass world, optional story excerpt (may be empty), and a prefix for filename
+		prompt, img_url = generate_visual_prompt_and_image(world, story_excerpt or '', 'background', context=context)
+	else:
+		prompt, img_url = generate_hero_scene_and_image(character, story_excerpt, context=context)
+	if not img_url:
+		return None
+	result = {'image_url': img_url, 'prompt': prompt}
+	try:
+		result['variants'] = build_image_variants(artifact_store.lookup(os.path.basename(img_url)))
+	except Exception as e:
+		# The original image is still usable on its own
+		print(f"[WARNING] Could not build image variants: {e}")
+	return result
+
+
+def build_bgm_result(world, character, timeout=60, on_stream=None, cancel=None):
+	"""Generate background music; returns the /generate_bgm payload."""
+	audio_file = f"bgm_{uuid.uuid4().hex[:8]}.mp3"
+	audio_path, prompt_used = run_with_timeout(lambda: generate_bgm_instrumental(world, character, audio_file, on_stream, cancel), timeout=timeout)
+	# Also return the audio filename so the client can request a server-side download
+	return {'audio_url': output_url(audio_path), 'prompt': prompt_used, 'audio_filename': os.path.basename(audio_path)}
+
+
+def build_analogy_result(hero_name, story, timeout=None, context=None):
+	"""Generate the real-life analogy; returns the /generate_analogy payload (Markdown and HTML)."""
+	analogy_md = generate_analogy_text(hero_name or 'the hero', story, timeout=timeout, context=context)
+	return {'analogy_md': analogy_md, 'analogy_html': render_markdown_html(analogy_md)}
+
+
+# ----------------------
+# Story store
+# ----------------------
+class StoryNotFound(LookupError):
+	"""A request named a story_id the store doesn't (or no longer) hold."""
+
+
+class StoryStore:
+	"""Everything produced for one story, kept in SQLite under its story_id: the character,
+	world and story text plus each asset stage's result (the same dicts /jobs reports).
+	Endpoints take the id instead of the payloads, and a refreshed page is rebuilt from
+	here without any upstream call. Stories older than max_age are pruned.
+	"""
+
+	ASSET_KEYS = ('hero_name', 'hero_image', 'background_image', 'bgm', 'analogy')
+	PRUNE_INTERVAL = 3600  # seconds between pruning passes
+
+	def __init__(self, db_path, max_age):
+		self.db_path = db_path
+		self.max_age = max_age
+		self._lock = threading.Lock()
+		self._conn = None
+		self._conn_pid = None
+		self._last_prune = 0.0
+
+	def _db(self):
+		if self._conn is None or self._conn_pid != os.getpid():
+			self._conn = open_sqlite(
+				self.db_path,
+				'CREATE TABLE IF NOT EXISTS stories ('
+				' id TEXT PRIMARY KEY, created REAL NOT NULL, updated REAL NOT NULL, job_id TEXT,'
+				' character TEXT, world TEXT, story TEXT, assets TEXT NOT NULL DEFAULT \'{}\')',
+				'CREATE INDEX IF NOT EXISTS stories_created ON stories (created)'
+			)
+			self._conn_pid = os.getpid()
+		return self._conn
+
+	def create(self, character, world, story):
+		"""Store a freshly written story; returns its new story_id."""
+		story_id = uuid.uuid4().hex
+		now = time.time()
+		with self._lock:
+			db = self._db()
+			db.execute(
+				'INSERT INTO stories (id, created, updated, character, world, story) VALUES (?, ?, ?, ?, ?, ?)',
+				(story_id, now, now, character, world, story)
+			)
+			if now - self._last_prune > self.PRUNE_INTERVAL:
+				self._last_prune = now
+				db.execute('DELETE FROM stories WHERE created < ?', (now - self.max_age,))
+			db.commit()
+		return story_id
+
+	def attach_job(self, story_id, job_id):
+		with self._lock:
+			db = self._db()
+			db.execute('UPDATE stories SET job_id = ? WHERE id = ?', (job_id, story_id))
+			db.commit()
+
+	def set_asset(self, story_id, key, value):
+		"""Record one asset stage's result (e.g. 'hero_image' -> its /generate_image payload)."""
+		with self._lock:
+			db = self._db()
+			row = db.execute('SELECT assets FROM stories WHERE id = ?', (story_id,)).fetchone()
+			if row is None:
+				return
+			assets = json.loads(row[0])
+			assets[key] = value
+			db.execute('UPDATE stories SET assets = ?, updated = ? WHERE id = ?', (json.dumps(assets), time.time(), story_id))
+			db.commit()
+
+	def get(self, story_id):
+		"""{'story_id', 'created', 'job_id', 'character', 'world', 'story', 'assets'}, or raise StoryNotFound."""
+		with self._lock:
+			row = self._db().execute(
+				'SELECT created, job_id, character, world, story, assets FROM stories WHERE id = ?', (str(story_id),)
+			).fetchone()
+		if row is None:
+			raise StoryNotFound(story_id)
+		created, job_id, character, world, story, assets = row
+		return {'story_id': story_id, 'created': created, 'job_id': job_id, 'character': character,
+			'world': world, 'story': story, 'assets': json.loads(assets)}
+
+	def stats(self):
+		with self._lock:
+			count = self._db().execute('SELECT COUNT(*) FROM stories').fetchone()[0]
+		return {'stories': count}
+
+
+story_store = StoryStore(os.path.join(app.instance_path, 'stories.sqlite3'), STORY_MAX_AGE_DAYS * 24 * 3600)
+
+
+def story_fields(data):
+	"""The request body with the character/world/story/hero name it refers to: merged in from the
+	store when it carries a story_id (raising StoryNotFound for unknown ids), otherwise as sent.
+	Other request fields (type, stream, ...) are kept, and so are asset fields the story lacks.
+	"""
+	if not data.get('story_id'):
+		return data
+	record = story_store.get(data['story_id'])
+	assets = record['assets']
+	stored = {
+		'story_id': record['story_id'],
+		'character': record['character'],
+		'world': record['world'],
+		'story': record['story'],
+		'hero_name': assets.get('hero_name') or '',
+		'analogy': (assets.get('analogy') or {}).get('analogy_md', ''),
+		# images[0] is the hero scene, images[1] the background, as the PDF expects
+		'images': [(assets.get(key) or {}).get('image_url') for key in ('hero_image', 'background_image')],
+		'story_excerpt': (record['story'] or '')[:300]
+	}
+	return {**data, **{k: v for k, v in stored.items() if (any(v) if isinstance(v, list) else v)}}
+
+
+def save_story_asset(data, key, value):
+	"""Remember a standalone endpoint's result on the story it was generated for, if any."""
+	if data.get('story_id') and value:
+		story_store.set_asset(data['story_id'], key, value)
+
+
+@app.errorhandler(StoryNotFound)
+def story_not_found(e):
+	return jsonify({'error': 'story not found'}), 404
+
+
+# ----------------------
+# Story asset jobs
+# ----------------------
+# (step name, result key, stage deadline in seconds) in display order
+STORY_JOB_STEPS = [
+	('Hero Name Extraction', 'hero_name', 35),
+	('Hero Scene Image', 'hero_image', 150),
+	('Background Image', 'background_image', 150),
+	('Background Music', 'bgm', 70),
+	('Real-life Inspiration', 'analogy', 35)
+]
+
+
+class StoryJob:
+	"""Server-side run of the post-story asset stages for one story.
+	Every state change is appended to an event log: SSE subscribers replay it
+	from their Last-Event-ID, pollers read the current snapshot. Results are
+	also saved on the job's story in the story store.
+	"""
+
+	def __init__(self, story_id=None):
+		self.id = uuid.uuid4().hex
+		self.story_id = story_id
+		self.created = time.time()
+		self.steps = [{'name': name, 'key': key, 'status': 'pending'} for name, key, _ in STORY_JOB_STEPS]
+		self.results = {}
+		self.events = []
+		self.finished = False
+		self._cond = threading.Condition()
+
+	def _append(self, event):
+		event['seq'] = len(self.events) + 1
+		self.events.append(event)
+		self._cond.notify_all()
+
+	def update(self, name, status, result=None, error=None):
+		if result is not None and self.story_id:
+			# Persist before announcing, so a reload after 'done' always finds the result
+			key = next(k for n, k, _ in STORY_JOB_STEPS if n == name)
+			story_store.set_asset(self.story_id, key, result)
+		with self._cond:
+			step = next(s for s in self.steps if s['name'] == name)
+			step['status'] = status
+			if result is not None:
+				self.results[step['key']] = result
+			event = {'step': name, 'key': step['key'], 'status': status, 'result': result}
+			if error:
+				event['error'] = error
+			self._append(event)
+			if not self.finished and all(s['status'] in ('complete', 'skipped') for s in self.steps):
+				self.finished = True
+				self._append({'done': True, 'results': dict(self.results)})
+
+	def progress(self, name, data):
+		"""Announce something a running stage can already offer (e.g. a BGM stream URL).
+		Unlike update() it doesn't touch the step's status or its stored result."""
+		with self._cond:
+			step = next(s for s in self.steps if s['name'] == name)
+			self._append({'step': name, 'key': step['key'], 'status': step['status'], 'progress': data})
+
+	def step_status(self, name):
+		with self._cond:
+			return next(s['status'] for s in self.steps if s['name'] == name)
+
+	def wait_events(self, after, timeout):
+		"""Return events with seq > after, blocking up to timeout seconds for new ones."""
+		with self._cond:
+			self._cond.wait_for(lambda: len(self.events) > after, timeout=timeout)
+			return self.events[after:]
+
+	def snapshot(self):
+		with self._cond:
+			return {
+				'job_id': self.id,
+				'steps': [dict(s) for s in self.steps],
+				'results': dict(self.results),
+				'done': self.finished
+			}
+
+
+_story_jobs = {}
+_story_jobs_lock = threading.Lock()
+
+
+def get_story_job(job_id):
+	with _story_jobs_lock:
+		return _story_jobs.get(job_id)
+
+
+def _run_job_stage(job, name, fn):
+	job.update(name, 'in-progress')
+	key = next(k for n, k, _ in STORY_JOB_STEPS if n == name)
+	try:
+		with track_stage('story_job', key):
+			result = fn()
+	except Exception as e:
+		print(f"[WARNING] {name} failed: {e}")
+		job.update(name, 'skipped', error=str(e))
+		return None
+	job.update(name, 'complete' if result else 'skipped', result=result or None)
+	return result
+
+
+def _skip_unstarted_stage(job, name, future):
+	"""Done-callback of a stage's future. A stage whose deadline passed while it was still
+	queued fails before _run_job_stage runs; mark it skipped so the job can still finish."""
+	error = 'cancelled' if future.cancelled() else future.exception()
+	if error is not None and job.step_status(name) == 'pending':
+		print(f"[WARNING] {name} never started: {error}")
+		job.update(name, 'skipped', error=str(error))
+
+
+def register_story_job(story_id=None):
+	"""Create a StoryJob, make it visible to /jobs and drop ones older than STORY_JOB_TTL."""
+	job = StoryJob(story_id)
+	if story_id:
+		story_store.attach_job(story_id, job.id)
+	cutoff = time.time() - STORY_JOB_TTL
+	with _story_jobs_lock:
+		for job_id in [k for k, v in _story_jobs.items() if v.created < cutoff]:
+			del _story_jobs[job_id]
+		_story_jobs[job.id] = job
+	return job
+
+
+def start_story_job(character, world, story, story_id=None, hero_name=None, session_key=None):
+	"""Run hero name, both images, BGM and analogy concurrently on the shared executor.
+	Only the analogy has a real dependency (the hero name), so it is chained to that stage;
+	when the caller already knows the name that stage completes without a model call.
+	The image-prompt and analogy stages share one StoryContext, created by whichever asks first.
+	The background image and BGM are taken over from the builder session's speculation if
+	one was started for this world and character.
+	"""
+	job = register_story_job(story_id)
+
+	timeouts = {key: timeout for _, key, timeout in STORY_JOB_STEPS}
+	story_excerpt = (story or '')[:300]
+
+	def _context():
+		return story_context(story_id, character, world, story)
+
+	def _submit(name, key, fn):
+		future = deadline_executor.submit(_run_job_stage, job, name, fn, timeout=timeouts[key])
+		future.add_done_callback(lambda f: _skip_unstarted_stage(job, name, f))
+		return future
+
+	def _start_analogy(name_future):
+		try:
+			hero_name = name_future.result()
+		except Exception:
+			hero_name = None
+		_submit('Real-life Inspiration', 'analogy', lambda: build_analogy_result(hero_name or 'the hero', story, context=_context()))
+
+	_submit('Hero Name Extraction', 'hero_name', lambda: hero_name or extract_hero_name(character) or None).add_done_callback(_start_analogy)
+	_submit('Hero Scene Image', 'hero_image', lambda: build_image_result('hero', world, character, story_excerpt, context=_context()))
+	_submit('Background Image', 'background_image', lambda: speculative_assets.take(session_key, 'background_image', world, character)
+		or build_image_result('background', world, character, '', context=_context()))
+	def _announce_stream(stream):
+		job.progress('Background Music', {'stream_url': bgm_stream_url(stream)})
+
+	_submit('Background Music', 'bgm', lambda: speculative_assets.take(session_key, 'bgm', world, character, on_stream=_announce_stream)
+		or build_bgm_result(world, character, on_stream=_announce_stream))
+	return job
+
+
+# ----------------------
+# Speculative assets
+# ----------------------
+class _StreamRelay:
+	"""Passes a speculative BGM's BgmStream to the story job that claims it, whether composing
+	started before or after the claim, so the page can still play the track while it streams."""
+
+	def __init__(self):
+		self.stream = None
+		self._listener = None
+		self._lock = threading.Lock()
+
+	def __call__(self, stream):
+		with self._lock:
+			self.stream = stream
+			listener = self._listener
+		if listener:
+			listener(stream)
+
+	def listen(self, listener):
+		with self._lock:
+			self._listener = listener
+			stream = self.stream
+		if stream:
+			listener(stream)
+
+
+class SpeculativeAssets:
+	"""Starts the background image and BGM while the user is still on the builder page. Both
+	only need the world (and, for the BGM, the character) text, which is final as soon as
+	/api/world and /api/character answer, so there is no reason to wait for the story.
+
+	Speculations are keyed by the builder's session key and asset, and remember a fingerprint
+	of the texts they were built from: the story job claims one whose texts still match and
+	otherwise generates the asset as before. One is only started when its providers have
+	headroom, so it never queues ahead of interactive calls. Regenerating the world or
+	character supersedes the old speculation, and sessions left unclaimed for
+	SPECULATION_TTL are dropped: one that hasn't started is cancelled, a BGM already
+	composing stops at its next chunk. Everything lives in this
+	process; a story request served by another worker simply generates its own assets.
+	"""
+
+	# asset key -> (providers that need headroom, builder inputs it is built from)
+	ASSETS = {
+		'background_image': (('gemini_text', 'gemini_image'), ('world',)),
+		'bgm': (('gemini_text', 'elevenlabs'), ('world', 'character'))
+	}
+
+	def __init__(self, enabled, ttl):
+		self.enabled = enabled
+		self.ttl = ttl
+		self._sessions = {}
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def fingerprint(*texts):
+		return hashlib.sha256('\0'.join(texts).encode('utf-8')).hexdigest()
 
-		print(f"[DEBUG] Visual prompt generated: {visual_prompt[:300]}")
+	def offer(self, session_key, **inputs):
+		"""Record a builder session's latest world / character text and start every asset it now allows."""
+		if not self.enabled or not session_key:
+			return
+		now = time.time()
+		timeouts = {key: timeout for _, key, timeout in STORY_JOB_STEPS}
+		with self._lock:
+			self._sweep(now)
+			session = self._sessions.setdefault(session_key, {'inputs': {}, 'assets': {}})
+			session['inputs'].update(inputs)
+			session['touched'] = now
+			for key, (providers, needs) in self.ASSETS.items():
+				if not all(session['inputs'].get(name) for name in needs):
+					continue
+				fingerprint = self.fingerprint(*(session['inputs'][name] for name in needs))
+				current = session['assets'].get(key)
+				if current and current[0] == fingerprint:
+					continue
+				if current:
+					self._drop(key, session['assets'].pop(key), 'superseded')
+				if not all(provider_gates[name].has_headroom() for name in providers):
+					metrics.inc('hero_speculations_total', asset=key, outcome='no_headroom')
+					continue
+				relay = _StreamRelay()
+				cancel = threading.Event()
+				future = deadline_executor.submit(self._build, key, dict(session['inputs']), relay, cancel, timeout=timeouts[key])
+				session['assets'][key] = (fingerprint, future, relay, cancel)
+				metrics.inc('hero_speculations_total', asset=key, outcome='started')
 
-		fname = f"{prefix}_{uuid.uuid4().hex[:8]}.png"
-		# generate image (may raise)
-		print(f"[DEBUG] Calling image generator with prompt (truncated): {visual_prompt[:200]}")
-		img_path = run_with_timeout(lambda: call_gemini_image(visual_prompt, fname), timeout=60)
-		img_url = url_for('static', filename=f'output/{os.path.basename(img_path)}')
-		print(f"[DEBUG] Image saved to: {img_path}")
-		return visual_prompt, img_url
-	except Exception as e:
-		print(f"[WARNING] Visual generation failed: {e}")
-		return None, None
+	def _build(self, key, inputs, relay, cancel):
+		with track_stage('speculation', key):
+			if key == 'background_image':
+				return build_image_result('background', inputs['world'], inputs.get('character', ''), '')
+			return build_bgm_result(inputs['world'], inputs['character'], on_stream=relay, cancel=cancel)
 
+	def claim(self, session_key, key, on_stream=None, **inputs):
+		"""Hand over the future of a speculation built from exactly these texts, or None.
+		on_stream(stream) is called with the BGM's BgmStream once it is (or if it already was) streaming."""
+		if not self.enabled or not session_key:
+			return None
+		needs = self.ASSETS[key][1]
+		with self._lock:
+			session = self._sessions.get(session_key)
+			entry = session['assets'].get(key) if session else None
+			if entry is None or entry[0] != self.fingerprint(*(inputs.get(name) or '' for name in needs)):
+				metrics.inc('hero_speculations_total', asset=key, outcome='missed')
+				return None
+			del session['assets'][key]
+			if not session['assets']:
+				del self._sessions[session_key]
+		metrics.inc('hero_speculations_total', asset=key, outcome='claimed')
+		if on_stream:
+			entry[2].listen(on_stream)
+		return entry[1]
 
-def generate_hero_scene_and_image(character, story_excerpt, timeout=60):
-	try:
-		prompt_req = (
-			f"Generate a detailed visual description prompt for a Studio Ghibli-style cinematic scene illustration."
-			f" Depict a dramatic moment of the hero in action, showing unique features and abilities."
-			f" Character: {character}. Story excerpt: {story_excerpt}. Output only the visual prompt."
-		)
-		def _gen():
-			resp = call_gemini_text(prompt_req)
-			raw = resp.get('raw', '')
-			print(f"[DEBUG] Gemini hero-scene raw response (truncated): {raw[:400]}")
-			return raw.strip()
+	def take(self, session_key, key, world, character, on_stream=None):
+		"""claim() and wait, within the current deadline, for the result; None if there is none
+		or it failed, so the caller falls back to generating the asset itself."""
+		future = self.claim(session_key, key, on_stream=on_stream, world=world, character=character)
+		if future is None:
+			return None
+		try:
+			return future.result(timeout=deadline_executor.remaining())
+		except Exception as e:
+			print(f"[WARNING] Speculative {key} unusable, generating it now: {e}")
+			return None
 
-		hero_prompt = run_with_timeout(_gen, timeout=timeout)
-		if not hero_prompt:
-			return None, None
-		print(f"[DEBUG] Hero scene prompt generated: {hero_prompt[:300]}")
-		fname = f"hero_scene_{uuid.uuid4().hex[:8]}.png"
-		print(f"[DEBUG] Calling image generator for hero scene with prompt (truncated): {hero_prompt[:200]}")
-		img_path = run_with_timeout(lambda: call_gemini_image(hero_prompt, fname), timeout=60)
-		img_url = url_for('static', filename=f'output/{os.path.basename(img_path)}')
-		print(f"[DEBUG] Hero image saved to: {img_path}")
-		return hero_prompt, img_url
-	except Exception as e:
-		print(f"[WARNING] Hero scene generation failed: {e}")
-		return None, None
+	def _drop(self, key, entry, outcome):
+		_, future, _, cancel = entry
+		cancel.set()
+		if not future.done():
+			deadline_executor.abandon(future)
+		metrics.inc('hero_speculations_total', asset=key, outcome=outcome)
 
+	def _sweep(self, now):
+		for session_key in [k for k, v in self._sessions.items() if v['touched'] < now - self.ttl]:
+			for key, entry in self._sessions.pop(session_key)['assets'].items():
+				self._drop(key, entry, 'expired')
 
-# Removed generate_bgm_wrapper; BGM generation now uses generate_bgm_instrumental directly
+	def stats(self):
+		with self._lock:
+			return {
+				'sessions': len(self._sessions),
+				'pending': sum(1 for v in self._sessions.values() for _, f, _, _ in v['assets'].values() if not f.done())
+			}
 
 
-def generate_analogy_text(hero_name, story, timeout=60):
-	prompt = (
-		"Extract the central theme of this hero story. Then speak directly to the person who imagined this hero (the creator)."
-		" Suggest how this story's theme and the hero's journey can inspire them to embark on meaningful 'adventures' in real life."
-		" Be specific about life lessons and practical ways to embody the hero's spirit."
-		" Respond in Markdown. Use headings and bullet points where helpful."
-		" Keep the formatting condensed, no excessive newlines."
-		f"\n\nHero name: {hero_name}\nStory:\n{story}"
-	)
-	def _call():
-		resp = call_gemini_text(prompt)
-		return resp.get('raw', '')
-	try:
-		return run_with_timeout(_call, timeout=timeout)
-	except Exception as e:
-		print(f"[WARNING] Analogy generation error: {e}")
-		return ''
+speculative_assets = SpeculativeAssets(SPECULATIVE_ASSETS, SPECULATION_TTL)
+metrics.describe('hero_speculations_total', 'counter', 'Speculative background image / BGM runs by outcome (started, no_headroom, claimed, missed, superseded, expired).')
 
 
 
@@ -289,30 +3253,70 @@ def index():
 	intro_md = ''' *V1.1 Demo*
 		* Open for testing & feedback
 		* Come up with your weirdest idea and answer some creative questions to build your own hero adventure story along with illustrations and a soundtrack!
-		⚠️ Whatever you do, please do NOT refresh the page! All progress will be lost.
+		⚠️ Please do NOT refresh the page while answering the questions, your answers will be lost. Once your story is written it is saved, and refreshing brings it back.
 		❗️ Finish all the questions on the character & world building page before proceeding. 
 		✅ The more specific the better (Story generation AI will NOT see the questions or suggestions.)
 		😵‍💫 Please be nice and don’t abuse it.
 		🤔 Currently mostly only compatible in English
 		❗️ If you don’t save the PDF (or use Ctrl/Cmd+P to save the entire page).
 		🎵 Unfortunately, the BGM generator ran out of credits...'''
-	try:
-		intro_html = md.markdown(intro_md, extensions=['fenced_code', 'tables', 'nl2br'])
-	except Exception:
-		intro_html = '<pre>' + intro_md + '</pre>'
+	intro_html = render_markdown_html(intro_md)
 	return render_template('index.html', intro_html=intro_html)
 
 
+def detect_topic(user_prompt):
+	"""Agent 1 (Story Detector): the fiction setting a hero prompt implies, 'fantasy' if unsure."""
+	guiding = "Infer the general type of fiction setting (e.g., fantasy, sci-fi, steampunk, etc.) from this user prompt. Respond with only the genre name."
+	combined = f"{guiding}\nUser: {user_prompt}"
+	detected_resp = call_gemini_text(combined, purpose='detector')
+	if detected_resp.get('error'):
+		return 'fantasy'
+	return detected_resp.get('raw', '').strip() or 'fantasy'
+
+
 @app.route('/builder', methods=['POST'])
 def builder():
-	# Agent 1: Story Detector
 	user_prompt = request.form.get('hero_prompt','').strip()
-	guiding = "Infer the general type of fiction setting (e.g., fantasy, sci-fi, steampunk, etc.) from this user prompt. Respond with only the genre name."
-	combined = f"{guiding}\nUser: {user_prompt}"
-	detected_resp = call_gemini_text(combined)
-	detected_topic = detected_resp.get('raw', '').strip() or 'fantasy'
-	detected = {'topic': detected_topic}
-	return render_template('builder.html', detected=detected, raw_prompt=user_prompt)
+	detected = {'topic': detect_topic(user_prompt)}
+	# Ties /api/character, /api/world and the story request together for speculative assets
+	session_key = uuid.uuid4().hex
+	return render_template('builder.html', detected=detected, raw_prompt=user_prompt, session_key=session_key)
+
+
+def questions_prompt(user_prompt, detected_topic):
+	# One schema-constrained call produces both columns of questions
+	return f"""Based on the user wanting to create a hero described as: "{user_prompt}"
+		In a {detected_topic} setting, generate two sets of questions.
+
+		character_questions: 4-5 basic and generic questions to help design a character. The questions should be no longer than a sentence, and the answer is expected to be very brief.
+		Make them cover: age, gender, appearance, powers, personality, fears, goals, quirks, backstory, etc.
+
+		world_questions: exactly 2-3 simple and generic world-building questions. The questions and expected answers should be no longer than a sentence.
+		Make them cover: mythology, creatures, history, magic/tech, culture, landmarks, etc.
+
+		For each question, provide:
+		1. number: its position in the set, starting at 1
+		2. question: the question itself
+		3. example: an inspirational example answer in parenthesis, (e.g. like this, including the e.g.)."""
+
+
+def questions_payload(question_set):
+	"""The /api/generate-questions response for a BuilderQuestionSet; raises ValueError if a column is empty."""
+	if not question_set.character_questions or not question_set.world_questions:
+		raise ValueError('model returned an empty question list')
+	# Renumber so the form field names are always unique
+	return {
+		'character_questions': [dict(q.model_dump(), number=n) for n, q in enumerate(question_set.character_questions, 1)],
+		'world_questions': [dict(q.model_dump(), number=n) for n, q in enumerate(question_set.world_questions, 1)]
+	}
+
+
+QUESTIONS_RETRY_AFTER = 5  # seconds the builder waits before asking again after a failure
+
+
+def questions_failed_payload(error):
+	"""The 503 /api/generate-questions body once every attempt failed; the builder offers a retry."""
+	return {'error': f"Could not generate questions: {error}", 'retry_after': QUESTIONS_RETRY_AFTER}
 
 
 @app.route('/api/generate-questions', methods=['POST'])
@@ -321,74 +3325,110 @@ def api_generate_questions():
 	data = request.json or {}
 	user_prompt = data.get('user_prompt', '')
 	detected_topic = data.get('detected_topic', 'fantasy')
-	
-	# Generate character questions
-	char_q_prompt = f"""Based on the user wanting to create a hero described as: "{user_prompt}"
-		In a {detected_topic} setting, generate 4-5 basic and generic questions to help design a character. The questions should be no longer than a sentence, and the answer is expected to be very brief.
-		For each question, provide:
-		1. The question (numbered)
-		2. An inspirational example answer in parenthesis, (e.g. like this, including the).
+	q_prompt = questions_prompt(user_prompt, detected_topic)
+
+	error = None
+	for attempt in range(2):
+		try:
+			payload = questions_payload(call_gemini_structured(q_prompt, BuilderQuestionSet, purpose='questions'))
+			print(f"[DEBUG] Final response: char={len(payload['character_questions'])}, world={len(payload['world_questions'])}")
+			return jsonify(payload)
+		except ProviderBusy:
+			raise
+		except Exception as e:
+			error = e
+			print(f"[ERROR] Question generation attempt {attempt + 1} failed: {e}")
 
-		Format as a JSON object like: {{"questions": [{{"number": 1, "question": "...", "example": "..."}}]}}
-		Make questions cover: age, gender, appearance, powers, personality, fears, goals, quirks, backstory, etc.
+	response = jsonify(questions_failed_payload(error))
+	response.status_code = 503
+	response.headers['Retry-After'] = str(QUESTIONS_RETRY_AFTER)
+	return response
 
-		IMPORTANT: Return ONLY valid JSON, no additional text before or after."""
-	
-	char_resp = call_gemini_text(char_q_prompt)
-	char_questions = []
+
+def answers_missing(answers):
+	return not answers or not any(str(v).strip() for v in answers.values())
+
+
+def character_prompt(answers):
+	prompt = (
+		'Create a complete character profile using these traits. name: a suitable name for the character;'
+		' profile: one paragraph describing them; key_traits: 3-5 short phrases for their defining traits.\n'
+	)
+	for k, v in answers.items():
+		prompt += f"{k}: {v}\n"
+	return prompt
+
+
+def world_prompt(answers, detected):
+	prompt = (
+		'Based on the world type: ' + str(detected.get('topic','unknown')) + ', build this world. name: a name for the world;'
+		' genre: its genre in a few words; setting: one paragraph describing the setting; key_traits: 3-5 short phrases'
+		' for its defining features.\n'
+	)
+	for k, v in answers.items():
+		prompt += f"{k}: {v}\n"
+	return prompt
+
+
+def character_payload(record):
+	"""The /api/character response for a CharacterProfile. 'character' is the text later prompts
+	see; 'hero_name' travels with it so the story job doesn't have to ask the model for it again.
+	"""
+	text = f"{record.name}\n\n{record.profile}"
+	if record.key_traits:
+		text += '\n\nKey traits: ' + ', '.join(record.key_traits)
+	return {'character': text, 'hero_name': record.name.strip(), 'character_record': record.model_dump()}
+
+
+def world_payload(record):
+	"""The /api/world response for a WorldProfile; 'world' is the text later prompts see."""
+	text = f"{record.name} ({record.genre})\n\n{record.setting}"
+	if record.key_traits:
+		text += '\n\nKey features: ' + ', '.join(record.key_traits)
+	return {'world': text, 'world_record': record.model_dump()}
+
+
+def prose_character_payload(resp):
+	"""The /api/character payload from a prose call_gemini_text() response: no hero_name,
+	and 'error' set if the call failed or came back empty."""
+	payload = {'character': resp.get('raw') or json.dumps(resp), 'hero_name': ''}
+	if resp.get('error') or not (resp.get('raw') or '').strip():
+		payload['error'] = resp.get('error') or 'empty response'
+	return payload
+
+
+def prose_world_payload(resp):
+	"""The /api/world payload from a prose call_gemini_text() response; see prose_character_payload()."""
+	payload = {'world': resp.get('raw') or json.dumps(resp)}
+	if resp.get('error') or not (resp.get('raw') or '').strip():
+		payload['error'] = resp.get('error') or 'empty response'
+	return payload
+
+
+def generate_character(answers):
+	"""The /api/character payload for a set of answers: a structured CharacterProfile, or prose
+	(with no hero_name) if the structured call fails. 'error' is set if the fallback failed too."""
+	prompt = character_prompt(answers)
 	try:
-		raw_text = char_resp.get('raw', '').strip()
-		print(f"[DEBUG] Raw character response: {raw_text[:200]}")
-		
-		# Try to extract JSON from the response
-		import re
-		json_match = re.search(r'\{.*\}', raw_text, re.DOTALL)
-		if json_match:
-			json_str = json_match.group(0)
-			char_data = json.loads(json_str)
-			char_questions = char_data.get('questions', [])
-			print(f"[DEBUG] Parsed {len(char_questions)} character questions")
-		else:
-			print("[ERROR] No JSON found in character response")
+		return character_payload(call_gemini_structured(prompt, CharacterProfile, purpose='character'))
+	except ProviderBusy:
+		raise
 	except Exception as e:
-		print(f"[ERROR] Failed to parse character questions: {e}")
-	
-	# Generate world building questions
-	world_q_prompt = f"""Based on a {detected_topic} world for the hero: "{user_prompt}"
-		Generate exactly 2-3 simple and generic world-building questions. The questions and expected answers should be no longer than a sentence.
-		For each question, provide:
-		1. The question (numbered)
-		2. An inspirational example answer in parenthesis, (e.g. like this, including the e.g.). 
+		# Fall back to prose; the story job then extracts the hero name itself
+		print(f"[WARNING] Structured character generation failed, falling back to text: {e}")
+	return prose_character_payload(call_gemini_text(prompt, purpose='character'))
 
-		Format as JSON like: {{"questions": [{{"number": 1, "question": "...", "example": "..."}}]}}
-		Make questions cover: mythology, creatures, history, magic/tech, culture, landmarks, etc.
 
-		IMPORTANT: Return ONLY valid JSON, no additional text before or after."""
-			
-	world_resp = call_gemini_text(world_q_prompt)
-	world_questions = []
+def generate_world(answers, detected):
+	"""The /api/world payload for a set of answers; same fallback as generate_character()."""
+	prompt = world_prompt(answers, detected)
 	try:
-		raw_text = world_resp.get('raw', '').strip()
-		print(f"[DEBUG] Raw world response: {raw_text[:200]}")
-		
-		# Try to extract JSON from the response
-		import re
-		json_match = re.search(r'\{.*\}', raw_text, re.DOTALL)
-		if json_match:
-			json_str = json_match.group(0)
-			world_data = json.loads(json_str)
-			world_questions = world_data.get('questions', [])
-			print(f"[DEBUG] Parsed {len(world_questions)} world questions")
-		else:
-			print("[ERROR] No JSON found in world response")
+		return world_payload(call_gemini_structured(prompt, WorldProfile, purpose='world'))
+	except ProviderBusy:
+		raise
 	except Exception as e:
-		print(f"[ERROR] Failed to parse world questions: {e}")
-	
-	print(f"[DEBUG] Final response: char={len(char_questions)}, world={len(world_questions)}")
-	return jsonify({
-		'character_questions': char_questions,
-		'world_questions': world_questions
-	})
+		print(f"[WARNING] Structured world generation failed, falling back to text: {e}")
+	return prose_world_payload(call_gemini_text(prompt, purpose='world'))
 
 
 @app.route('/api/character', methods=['POST'])
@@ -396,17 +3436,14 @@ def api_character():
 	data = request.json or {}
 	answers = data.get('answers', {})
 	# If no answers provided, return an error so frontend can prompt the user
-	if not answers or not any(str(v).strip() for v in answers.values()):
+	if answers_missing(answers):
 		return jsonify({'error': 'Please build the character before continuing!'}), 400
 
-	# Compose a prompt for Gemini
-	prompt = 'Create a paragraph describing a complete character profile using these traits, including giving the character a suitable name.\n'
-	for k, v in answers.items():
-		prompt += f"{k}: {v}\n"
-	resp = call_gemini_text(prompt)
-	# If Gemini returned a raw string, use it; otherwise serialize
-	character_text = resp.get('raw') or json.dumps(resp)
-	return jsonify({'character': character_text})
+	payload = generate_character(answers)
+	if 'error' not in payload:
+		# Never start paid renders from an error message
+		speculative_assets.offer(data.get('session_key'), character=payload['character'])
+	return jsonify(payload)
 
 
 @app.route('/api/world', methods=['POST'])
@@ -415,109 +3452,226 @@ def api_world():
 	answers = data.get('answers', {})
 	detected = data.get('detected', {})
 	# If no answers provided, inform the user to build the world first
-	if not answers or not any(str(v).strip() for v in answers.values()):
+	if answers_missing(answers):
 		return jsonify({'error': 'Please build the world before continuing!'}), 400
 
-	prompt = 'Based on the world type: ' + str(detected.get('topic','unknown')) + ', give the world a name and create a paragraph describe the setting of this world:\n'
-	for k, v in answers.items():
-		prompt += f"{k}: {v}\n"
-	resp = call_gemini_text(prompt)
-	world_text = resp.get('raw') or json.dumps(resp)
-	return jsonify({'world': world_text})
+	payload = generate_world(answers, detected)
+	if 'error' not in payload:
+		speculative_assets.offer(data.get('session_key'), world=payload['world'])
+	return jsonify(payload)
 
 
-@app.route('/generate_story', methods=['POST'])
-def generate_story():
-	data = request.json or {}
-	character = data.get('character', '')
-	world = data.get('world', '')
-
+def story_payload(character, world, story_md, start_job=None, story_id=None, hero_name=None, session_key=None):
+	"""Store a finished story, start its asset job (with start_story_job unless the caller
+	runs the stages some other way) and build the /generate_story response. The client keeps
+	only the story_id; every later request refers to the story by it. A hero_name from the
+	structured character record saves the job its name-extraction call, and the builder's
+	session_key lets it take over the speculative background image and BGM.
+	"""
+	story_id = story_id or story_store.create(character, world, story_md)
 	result = {
-		'story': None,
+		'story_id': story_id,
+		'story_url': f"/story/{story_id}",
 		'images': [],
 		'audio': None,
 		'analogy': None,
 		'error': None
 	}
 
+	# Hero name, images, BGM and the real-life analogy only need the story,
+	# character and world, so they run concurrently as a server-side job.
+	# The client follows its progress via /jobs/<id>/events (or polls /jobs/<id>).
+	job = (start_job or start_story_job)(character, world, story_md, story_id=story_id, hero_name=hero_name,
+		session_key=session_key)
+	result['job_id'] = job.id
+	result['events_url'] = f"/jobs/{job.id}/events"
+	result['status_url'] = f"/jobs/{job.id}"
+	result['steps'] = [{'name': 'Story Generation', 'status': 'complete'}] + job.snapshot()['steps']
+	result['hero_name'] = hero_name or ''
+
+	# Convert Markdown to HTML for client rendering
+	result['story_html'] = render_markdown_html(story_md)
+	result['analogy_html'] = render_markdown_html(result['analogy'])
+	return result
+
+
+def stored_story_payload(story_id):
+	"""The /stories/<id> view of a story: its HTML, every asset result so far and the step list.
+	While the asset job is still running the job URLs are included so the page can follow it;
+	stages of a job that no longer exists (e.g. lost to a restart) are reported as skipped.
+	"""
+	record = story_store.get(story_id)
+	job = get_story_job(record['job_id']) if record['job_id'] else None
+	snapshot = job.snapshot() if job else None
+	results = {key: value for key, value in record['assets'].items() if value}
+	if snapshot:
+		results.update(snapshot['results'])
+		steps = snapshot['steps']
+	else:
+		steps = [{'name': name, 'key': key, 'status': 'complete' if key in results else 'skipped'}
+			for name, key, _ in STORY_JOB_STEPS]
+	result = {
+		'story_id': story_id,
+		'story_url': f"/story/{story_id}",
+		'story_html': render_markdown_html(record['story']),
+		'hero_name': results.get('hero_name') or '',
+		'results': results,
+		'steps': [{'name': 'Story Generation', 'status': 'complete'}] + steps,
+		'done': snapshot['done'] if snapshot else True,
+		'error': None
+	}
+	if snapshot and not snapshot['done']:
+		result['job_id'] = job.id
+		result['events_url'] = f"/jobs/{job.id}/events"
+		result['status_url'] = f"/jobs/{job.id}"
+	return result
+
+
+@app.route('/generate_story', methods=['POST'])
+def generate_story():
+	data = request.json or {}
+	character = data.get('character', '')
+	world = data.get('world', '')
+	hero_name = (data.get('hero_name') or '').strip()
+
 	# Step 1: Generate Story (must succeed)
 	try:
-		story_md = generate_story_text(character, world, timeout=60)
+		story_md = generate_story_text(character, world)
 		if not story_md:
 			raise RuntimeError('Empty story from model')
-		result['story'] = story_md
 		print("[SUCCESS] Story generated (markdown)")
+	except ProviderBusy:
+		raise
 	except Exception as e:
 		print(f"[CRITICAL ERROR] Story generation failed: {e}")
+		result = {'story': None, 'images': [], 'audio': None, 'analogy': None}
 		result['error'] = f"Story generation failed: {str(e)}"
 		return jsonify(result), 500
 
-	# Hero name extraction moved to dedicated endpoint to reduce memory and allow
-	# the frontend to request it separately when ready.
-	hero_name = ''
-
-	# Note: Image and BGM generation moved to dedicated endpoints to reduce memory
-	# and allow the frontend to request them separately. They will be performed
-	# after returning the core story payload.
-
-	# Real-life analogy generation is deferred to a separate endpoint so the
-	# frontend can request it after images/audio or when the user wants it.
-	result['analogy'] = None
-
-	# Add progress tracking info
-	# Mark heavy tasks as pending so the frontend can request them individually
-	# Order updated: Hero Scene Image now appears before Background Image
-	result['steps'] = [
-		{'name': 'Story Generation', 'status': 'complete'},
-		{'name': 'Hero Name Extraction', 'status': 'pending'},
-		{'name': 'Hero Scene Image', 'status': 'pending'},
-		{'name': 'Background Image', 'status': 'pending'},
-		{'name': 'Background Music', 'status': 'pending'},
-		{'name': 'Real-life Inspiration', 'status': 'pending'}
-	]
-	result['character'] = character
-	result['world'] = world
-	result['hero_name'] = hero_name
+	return jsonify(story_payload(character, world, story_md, hero_name=hero_name, session_key=data.get('session_key')))
 
-	# Convert Markdown to HTML for client rendering
-	try:
-		result['story_html'] = md.markdown(result['story'] or '', extensions=['fenced_code', 'tables', 'nl2br'])
-	except Exception:
-		result['story_html'] = '<pre>' + (result['story'] or '') + '</pre>'
 
+
+def stream_chunk(blocks, delta):
+	"""The 'chunk' event payload for one streamed story delta."""
+	html = blocks.feed(delta)
+	return {'delta': delta, 'html': html, 'tail': blocks.tail} if html else {'delta': delta, 'html': ''}
+
+
+@app.route('/generate_story_stream', methods=['POST'])
+def generate_story_stream():
+	"""Stream the story as Server-Sent Events so the first words show up right away.
+	'chunk' events carry the Markdown delta and the HTML of any blocks it completed (each
+	block is rendered and sent once); when blocks were completed they also carry 'tail', the
+	unfinished Markdown after them. The final 'story' event carries the same payload as
+	/generate_story (and starts the asset job).
+	"""
+	data = request.json or {}
+	character = data.get('character', '')
+	world = data.get('world', '')
+	hero_name = (data.get('hero_name') or '').strip()
+	# Answer 429 now, while we can still set a status code, rather than mid-stream
+	provider_gates['gemini_text'].check()
+
+	def _stream():
+		parts = []
+		blocks = MarkdownBlockStream()
+		try:
+			for delta in stream_story_text(character, world):
+				parts.append(delta)
+				yield sse_event('chunk', stream_chunk(blocks, delta))
+			story_md = ''.join(parts)
+			if not story_md.strip():
+				raise RuntimeError('Empty story from model')
+			print("[SUCCESS] Story streamed (markdown)")
+		except ProviderBusy as e:
+			yield sse_event('error', {'error': str(e), 'retry_after': e.retry_after})
+			return
+		except Exception as e:
+			print(f"[CRITICAL ERROR] Story streaming failed: {e}")
+			yield sse_event('error', {'error': f"Story generation failed: {str(e)}"})
+			return
+		yield sse_event('story', story_payload(character, world, story_md, hero_name=hero_name, session_key=data.get('session_key')))
+
+	return Response(stream_with_context(_stream()), mimetype='text/event-stream',
+		headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/stories/<story_id>', methods=['GET'])
+def story_record(story_id):
+	"""A stored story with every asset finished so far; rebuilding a page from it costs no upstream call."""
+	return jsonify(stored_story_payload(story_id))
+
+
+@app.route('/story/<story_id>', methods=['GET'])
+def story_page(story_id):
+	"""Shareable / reloadable page for a finished story (filled in from /stories/<id>)."""
+	return render_template('story.html', story_id=story_id)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def story_job_status(job_id):
+	"""Polling view of a story job: per-step status plus every result so far."""
+	job = get_story_job(job_id)
+	if job is None:
+		return jsonify({'error': 'job not found'}), 404
+	return jsonify(job.snapshot())
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def story_job_events(job_id):
+	"""Server-Sent Events stream of a story job's step updates, resumable via Last-Event-ID."""
+	job = get_story_job(job_id)
+	if job is None:
+		return jsonify({'error': 'job not found'}), 404
 	try:
-		result['analogy_html'] = md.markdown(result['analogy'] or '', extensions=['fenced_code', 'tables', 'nl2br'])
-	except Exception:
-		result['analogy_html'] = '<pre>' + (result['analogy'] or '') + '</pre>'
+		after = int(request.headers.get('Last-Event-ID', 0))
+	except ValueError:
+		after = 0
 
-	return jsonify(result)
+	def _stream(after):
+		yield 'retry: 3000\n\n'
+		while True:
+			events = job.wait_events(after, timeout=15)
+			if not events:
+				if job.finished:
+					return
+				yield ': keep-alive\n\n'
+				continue
+			for event in events:
+				after = event['seq']
+				kind = 'done' if event.get('done') else 'step'
+				yield sse_event(kind, event, event_id=event['seq'])
+				if kind == 'done':
+					return
 
+	return Response(_stream(after), mimetype='text/event-stream',
+		headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/generate_image', methods=['POST'])
 def generate_image():
 	"""Generate either a background or hero scene image.
-	Expects JSON: { type: 'background'|'hero', world, character, story_excerpt }
+	Expects JSON: { type: 'background'|'hero', story_id } (or world, character, story_excerpt)
 	"""
-	data = request.json or {}
+	data = story_fields(request.json or {})
 	itype = data.get('type')
 	world = data.get('world', '')
 	character = data.get('character', '')
 	story_excerpt = data.get('story_excerpt', '')
 
+	if itype not in ('background', 'hero'):
+		return jsonify({'error': 'unknown image type'}), 400
 	try:
-		if itype == 'background':
-			# Pass world, optional story excerpt (may be empty), and a prefix for filename
-			prompt, img_url = generate_visual_prompt_and_image(world, story_excerpt or '', 'background')
-		elif itype == 'hero':
-			prompt, img_url = generate_hero_scene_and_image(character, story_excerpt)
-		else:
-			return jsonify({'error': 'unknown image type'}), 400
-
-		if img_url:
-			return jsonify({'image_url': img_url, 'prompt': prompt})
+		context = story_context(data.get('story_id'), character, world, data.get('story', ''))
+		payload = build_image_result(itype, world, character, story_excerpt, context=context)
+		if payload:
+			save_story_asset(data, 'hero_image' if itype == 'hero' else 'background_image', payload)
+			return jsonify(payload)
 		else:
 			return jsonify({'error': 'generation_failed'}), 500
+	except ProviderBusy:
+		raise
 	except Exception as e:
 		return jsonify({'error': str(e)}), 500
 
@@ -525,38 +3679,88 @@ def generate_image():
 @app.route('/generate_bgm', methods=['POST'])
 def generate_bgm():
 	"""Generate background music independently.
-	Expects JSON: { world, character, hero_name }
+	Expects JSON: { story_id } (or world, character)
 	"""
-	data = request.json or {}
+	data = story_fields(request.json or {})
 	world = data.get('world', '')
 	character = data.get('character', '')
 
 	try:
-		audio_file = f"bgm_{uuid.uuid4().hex[:8]}.mp3"
-		audio_path, prompt_used = run_with_timeout(lambda: generate_bgm_instrumental(world, character, audio_file), timeout=60)
-		audio_url = url_for('static', filename=f'output/{os.path.basename(audio_path)}')
-		# Also return the audio filename so the client can request a server-side download
-		return jsonify({'audio_url': audio_url, 'prompt': prompt_used, 'audio_filename': os.path.basename(audio_path)})
+		if data.get('stream'):
+			# Answer once the first audio arrives; stream_url plays it while it is still composing
+			future, stream = start_bgm_stream(world, character)
+			future.add_done_callback(lambda f: not f.cancelled() and f.exception() is None and save_story_asset(data, 'bgm', f.result()))
+			if stream is None:
+				if not future.done():
+					raise TimeoutError('BGM did not start streaming in time')
+				return jsonify(future.result())
+			return jsonify({'stream_url': bgm_stream_url(stream), 'audio_url': output_url(stream.path), 'audio_filename': stream.filename})
+		payload = build_bgm_result(world, character)
+		save_story_asset(data, 'bgm', payload)
+		return jsonify(payload)
+	except ProviderBusy:
+		raise
 	except Exception as e:
 		return jsonify({'error': str(e)}), 500
 
 
+@app.route('/stream_bgm/<stream_id>', methods=['GET'])
+def stream_bgm(stream_id):
+	"""Play a BGM track while it is still being composed. Partial audio is never cached;
+	once the track is complete this redirects to its immutable /media URL."""
+	stream = get_bgm_stream(stream_id)
+	if stream is None:
+		return jsonify({'error': 'stream not found'}), 404
+	opened = stream.open_reader()
+	if opened is None:
+		if stream.done and not stream.error:
+			return redirect(output_url(stream.path))
+		return jsonify({'error': stream.error or 'stream not started'}), 404
+	return Response(stream_with_context(stream.iter_chunks(*opened)), mimetype='audio/mpeg',
+		headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/extract_hero_name', methods=['POST'])
 def extract_hero_name_endpoint():
-	"""Return the hero name extracted from the character description."""
-	data = request.json or {}
+	"""Return the hero name extracted from the character description (or the story_id's character)."""
+	data = story_fields(request.json or {})
 	character = data.get('character', '')
 	if not character or not str(character).strip():
 		return jsonify({'error': 'No character description provided'}), 400
 	try:
 		# `extract_hero_name` already uses a timeout internally
 		name = extract_hero_name(character)
+		save_story_asset(data, 'hero_name', name)
 		name = name or 'the hero'
 		return jsonify({'hero_name': name})
+	except ProviderBusy:
+		raise
 	except Exception as e:
 		return jsonify({'error': str(e)}), 500
 
 
+def send_media(name, **send_kwargs):
+	"""Send a stored artifact with a content-hash ETag and immutable caching, or None if unknown.
+	send_file's conditional mode answers If-None-Match with 304 and Range with 206.
+	"""
+	found = artifact_store.entry(name)
+	if found is None:
+		return None
+	response = send_file(found['path'], conditional=True, etag=found['etag'], max_age=MEDIA_MAX_AGE, **send_kwargs)
+	response.cache_control.public = True
+	response.cache_control.immutable = True
+	return response
+
+
+@app.route('/media/<name>', methods=['GET'])
+def media(name):
+	"""Serve generated images and audio; artifacts never change, so browsers may cache them forever."""
+	response = send_media(name)
+	if response is None:
+		return jsonify({'error': 'file not found'}), 404
+	return response
+
+
 @app.route('/download_bgm', methods=['GET'])
 def download_bgm():
 	"""Serve a generated BGM file as an attachment to force download (same-origin).
@@ -567,41 +3771,41 @@ def download_bgm():
 		return jsonify({'error': 'file parameter required'}), 400
 	# sanitize and ensure it's a basename
 	fname = os.path.basename(fname)
-	file_path = os.path.join(app.config['STATIC_OUTPUT'], fname)
-	if not os.path.exists(file_path):
-		return jsonify({'error': 'file not found'}), 404
 	try:
-		return send_from_directory(app.config['STATIC_OUTPUT'], fname, as_attachment=True, download_name=fname)
+		response = send_media(fname, as_attachment=True, download_name=fname)
 	except Exception as e:
 		return jsonify({'error': str(e)}), 500
+	if response is None:
+		return jsonify({'error': 'file not found'}), 404
+	return response
 
 
 @app.route('/generate_analogy', methods=['POST'])
 def generate_analogy_endpoint():
-	"""Generate the real-life analogy based on hero name and story. Returns Markdown and HTML."""
-	data = request.json or {}
+	"""Generate the real-life analogy based on hero name and story (or a story_id). Returns Markdown and HTML."""
+	data = story_fields(request.json or {})
 	hero_name = data.get('hero_name', '')
 	story = data.get('story', '')
 	if not story or not str(story).strip():
 		return jsonify({'error': 'No story provided'}), 400
 	try:
-		analogy_md = generate_analogy_text(hero_name or 'the hero', story, timeout=30)
-		analogy_html = ''
-		try:
-			analogy_html = md.markdown(analogy_md or '', extensions=['fenced_code', 'tables', 'nl2br'])
-		except Exception:
-			analogy_html = '<pre>' + (analogy_md or '') + '</pre>'
-		return jsonify({'analogy_md': analogy_md, 'analogy_html': analogy_html})
+		context = story_context(data.get('story_id'), data.get('character', ''), data.get('world', ''), story)
+		payload = build_analogy_result(hero_name, story, context=context)
+		save_story_asset(data, 'analogy', payload)
+		return jsonify(payload)
+	except ProviderBusy:
+		raise
 	except Exception as e:
 		return jsonify({'error': str(e)}), 500
 
 
-@app.route('/generate_pdf', methods=['POST'])
-def generate_pdf():
-	"""Generate a beautifully formatted PDF of the story, character, world, and images."""
-	from flask import send_file
-	
-	data = request.json or {}
+# ----------------------
+# PDF export
+# ----------------------
+def render_pdf_document(data):
+	"""Lay out the story PDF and return its bytes.
+	CPU-bound (ReportLab + PIL), so it runs in the PDF process pool, not on a request thread.
+	"""
 	story = data.get('story', '')
 	character = data.get('character', '')
 	world = data.get('world', '')
@@ -611,158 +3815,287 @@ def generate_pdf():
 	# Use second image (world/background) for page background, not the hero image
 	bg_image_path = images[1] if images and len(images) > 1 else None
 	
-	try:
-		# Create PDF in memory
-		pdf_buffer = BytesIO()
-		doc = SimpleDocTemplate(pdf_buffer, pagesize=letter,
-			leftMargin=0.5*inch, rightMargin=0.5*inch,
-			topMargin=0.5*inch, bottomMargin=0.5*inch)
-		
-		# Custom styles with gradients simulated through colors
-		styles = getSampleStyleSheet()
-		
-		# Gradient-like title style
-		title_style = ParagraphStyle(
-			'CustomTitle',
-			parent=styles['Heading1'],
-			fontSize=28,
-			textColor=colors.HexColor("#f89945"),
-			spaceAfter=12,
-			alignment=TA_CENTER,
-			fontName='Helvetica-Bold'
-		)
-		
-		heading_style = ParagraphStyle(
-			'CustomHeading',
-			parent=styles['Heading2'],
-			fontSize=16,
-			textColor=colors.HexColor("#f6c35c"),
-			spaceAfter=10,
-			spaceBefore=12,
-			fontName='Helvetica-Bold'
-		)
-		
-		body_style = ParagraphStyle(
-			'CustomBody',
-			parent=styles['Normal'],
-			fontSize=10,
-			alignment=TA_JUSTIFY,
-			spaceAfter=12,
-			leading=14
-		)
-		
-		# Build PDF content
-		story_elements = []
-		
-		# Title
-		story_elements.append(Paragraph(f"{hero_name}'s Adventure", title_style))
-		story_elements.append(Spacer(1, 0.2*inch))
-		
-		# Character section
-		story_elements.append(Paragraph("Character Profile", heading_style))
-		for para in [p.strip() for p in character.split('\n\n') if p.strip()]:
-			story_elements.append(Paragraph(para, body_style))
-		story_elements.append(Spacer(1, 0.2*inch))
-		
-		# World section
-		story_elements.append(Paragraph("World Description", heading_style))
-		for para in [p.strip() for p in world.split('\n\n') if p.strip()]:
-			story_elements.append(Paragraph(para, body_style))
-		story_elements.append(Spacer(1, 0.2*inch))
-		
-		# Story section
-		story_elements.append(Paragraph("The Story", heading_style))
-		for para in [p.strip() for p in story.split('\n\n') if p.strip()]:
-			story_elements.append(Paragraph(para, body_style))
-		story_elements.append(Spacer(1, 0.3*inch))
-		
-		# Prepare optional transparent background image (15% opacity)
-		bg_image_reader = None
-		if bg_image_path:
-			try:
-				# Resolve local static paths
-				if bg_image_path.startswith('http'):
-					img_response = requests.get(bg_image_path, timeout=5)
-					img = PILImage.open(BytesIO(img_response.content))
-				else:
-					if bg_image_path.startswith('/'):
-						local_path = os.path.join(app.root_path, bg_image_path.lstrip('/'))
-					else:
-						local_path = bg_image_path
-					img = PILImage.open(local_path)
-
-				# Ensure RGBA and blend onto white at low opacity (more reliable than relying on alpha channel in ReportLab)
-				if img.mode != 'RGBA':
-					img = img.convert('RGBA')
-				opacity = 0.25  # 25% visible
-				white_bg = PILImage.new('RGBA', img.size, (255, 255, 255, 255))
-				blended = PILImage.blend(white_bg, img, opacity)
-
-				img_buffer = BytesIO()
-				blended.save(img_buffer, format='PNG')
-				img_buffer.seek(0)
-				bg_image_reader = ImageReader(img_buffer)
-				print(f"[DEBUG] Prepared background image (size={img.size}, mode={img.mode}, opacity={opacity})")
-			except Exception as e:
-				print(f"[WARNING] Could not prepare transparent background image: {e}")
-		
-		# Hero scene image (if available - use first image if it exists)
-		if images and len(images) > 0:
-			hero_img_url = images[0]
+	# Create PDF in memory
+	pdf_buffer = BytesIO()
+	doc = SimpleDocTemplate(pdf_buffer, pagesize=letter,
+		leftMargin=0.5*inch, rightMargin=0.5*inch,
+		topMargin=0.5*inch, bottomMargin=0.5*inch)
+	
+	# Custom styles with gradients simulated through colors
+	styles = getSampleStyleSheet()
+	
+	# Gradient-like title style
+	title_style = ParagraphStyle(
+		'CustomTitle',
+		parent=styles['Heading1'],
+		fontSize=28,
+		textColor=colors.HexColor("#f89945"),
+		spaceAfter=12,
+		alignment=TA_CENTER,
+		fontName='Helvetica-Bold'
+	)
+	
+	heading_style = ParagraphStyle(
+		'CustomHeading',
+		parent=styles['Heading2'],
+		fontSize=16,
+		textColor=colors.HexColor("#f6c35c"),
+		spaceAfter=10,
+		spaceBefore=12,
+		fontName='Helvetica-Bold'
+	)
+	
+	body_style = ParagraphStyle(
+		'CustomBody',
+		parent=styles['Normal'],
+		fontSize=10,
+		alignment=TA_JUSTIFY,
+		spaceAfter=12,
+		leading=14
+	)
+	
+	# Build PDF content
+	story_elements = []
+	
+	# Title
+	story_elements.append(Paragraph(f"{hero_name}'s Adventure", title_style))
+	story_elements.append(Spacer(1, 0.2*inch))
+	
+	# Section texts are Markdown; their flowables come from the same cached parse as the HTML
+	# Character section
+	story_elements.append(Paragraph("Character Profile", heading_style))
+	story_elements.extend(markdown_flowables(character, body_style, heading_style))
+	story_elements.append(Spacer(1, 0.2*inch))
+	
+	# World section
+	story_elements.append(Paragraph("World Description", heading_style))
+	story_elements.extend(markdown_flowables(world, body_style, heading_style))
+	story_elements.append(Spacer(1, 0.2*inch))
+	
+	# Story section
+	story_elements.append(Paragraph("The Story", heading_style))
+	story_elements.extend(markdown_flowables(story, body_style, heading_style))
+	story_elements.append(Spacer(1, 0.3*inch))
+	
+	# Prepare optional transparent background image (cached, already page-sized)
+	bg_image_reader = None
+	if bg_image_path:
+		try:
+			bg_image_reader = ImageReader(BytesIO(prepare_pdf_background(bg_image_path)))
+			print(f"[DEBUG] Prepared background image (opacity={PDF_BACKGROUND_OPACITY})")
+		except Exception as e:
+			print(f"[WARNING] Could not prepare transparent background image: {e}")
+	
+	# Hero scene image (if available - use first image if it exists)
+	hero_img_url = images[0] if images else None
+	if hero_img_url:
+		try:
+			hero_buffer = BytesIO(prepare_pdf_hero(hero_img_url))
+			story_elements.append(Paragraph("The Hero's Moment", heading_style))
+			story_elements.append(Image(hero_buffer, width=5*inch, height=3*inch))
+			story_elements.append(Spacer(1, 0.3*inch))
+		except Exception as e:
+			print(f"[WARNING] Could not include hero image: {e}")
+	
+	# Analogy section (renamed to "In Real Life")
+	if analogy:
+		story_elements.append(PageBreak())
+		story_elements.append(Paragraph("In Real Life", heading_style))
+		story_elements.extend(markdown_flowables(analogy, body_style, heading_style))
+	
+	# Draw semi-transparent background on each page
+	def _draw_background(canvas_obj, doc_obj):
+		if bg_image_reader:
+			page_width, page_height = letter
 			try:
-				if hero_img_url.startswith('http'):
-					img_response = requests.get(hero_img_url, timeout=5)
-					img_buffer = BytesIO(img_response.content)
-					hero_reader = ImageReader(img_buffer)
-					story_elements.append(Paragraph("The Hero's Moment", heading_style))
-					story_elements.append(Image(img_buffer, width=5*inch, height=3*inch))
-				else:
-					if hero_img_url.startswith('/'):
-						local_path = os.path.join(app.root_path, hero_img_url.lstrip('/'))
-					else:
-						local_path = hero_img_url
-					img = PILImage.open(local_path)
-					img_temp = BytesIO()
-					img.save(img_temp, format='PNG')
-					img_temp.seek(0)
-					hero_reader = ImageReader(img_temp)
-					story_elements.append(Paragraph("The Hero's Moment", heading_style))
-					story_elements.append(Image(img_temp, width=5*inch, height=3*inch))
-				story_elements.append(Spacer(1, 0.3*inch))
-			except Exception as e:
-				print(f"[WARNING] Could not include hero image: {e}")
-		
-		# Analogy section (renamed to "In Real Life")
-		if analogy:
-			story_elements.append(PageBreak())
-			story_elements.append(Paragraph("In Real Life", heading_style))
-			for para in [p.strip() for p in analogy.split('\n\n') if p.strip()]:
-				story_elements.append(Paragraph(para, body_style))
-		
-		# Draw semi-transparent background on each page
-		def _draw_background(canvas_obj, doc_obj):
-			if bg_image_reader:
-				page_width, page_height = letter
-				try:
-					canvas_obj.drawImage(bg_image_reader, 0, 0, width=page_width, height=page_height)
-				except Exception:
-					pass
-		
-		# Build the PDF with background on every page
-		doc.build(story_elements, onFirstPage=_draw_background, onLaterPages=_draw_background)
-		pdf_buffer.seek(0)
-		
-		# Return the PDF file
-		return send_file(
-			pdf_buffer,
-			mimetype='application/pdf',
-			as_attachment=True,
-			download_name=f"{hero_name.replace(' ', '_')}_Adventure.pdf"
-		)
+				canvas_obj.drawImage(bg_image_reader, 0, 0, width=page_width, height=page_height)
+			except Exception:
+				pass
 	
+	# Build the PDF with background on every page
+	doc.build(story_elements, onFirstPage=_draw_background, onLaterPages=_draw_background)
+	return pdf_buffer.getvalue()
+
+
+def pdf_job_id(data):
+	"""Content hash of everything that ends up in the PDF; identical exports share one job."""
+	fields = {k: data.get(k) for k in ('story', 'character', 'world', 'hero_name', 'analogy', 'images')}
+	canonical = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+	return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+
+
+def _pdf_path(job_id):
+	return os.path.join(app.config['PDF_OUTPUT'], f"{job_id}.pdf")
+
+
+def render_pdf_to_file(data, out_path):
+	"""Process-pool entry point: render the PDF and publish it atomically.
+	Returns its size plus the metrics this worker recorded, for the web process to merge.
+	"""
+	try:
+		with track_stage('pdf_render', 'pdf') as stage:
+			pdf_bytes = render_pdf_document(data)
+			tmp_path = f"{out_path}.{uuid.uuid4().hex[:8]}.tmp"
+			with open(tmp_path, 'wb') as f:
+				f.write(pdf_bytes)
+			os.replace(tmp_path, out_path)
+			stage.add_bytes(len(pdf_bytes), 'written')
+		return {'bytes': len(pdf_bytes), 'metrics': metrics.drain()}
+	except Exception as e:
+		# Pool exceptions are pickled by value; attach the metrics to it instead
+		e.metrics = metrics.drain()
+		raise
+
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+_pdf_jobs = {}
+_pdf_failed = OrderedDict()  # job_id -> error of recent failed renders, for pdf_job_status()
+_pdf_jobs_lock = threading.Lock()
+
+
+def _get_pdf_pool():
+	global _pdf_pool
+	with _pdf_pool_lock:
+		if _pdf_pool is None:
+			# spawn: never fork a multi-threaded Flask worker into the pool
+			_pdf_pool = concurrent.futures.ProcessPoolExecutor(
+				max_workers=PDF_POOL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+		return _pdf_pool
+
+
+def _reset_pdf_pool():
+	global _pdf_pool, _pdf_pool_lock, _pdf_jobs, _pdf_failed, _pdf_jobs_lock
+	_pdf_pool = None
+	_pdf_pool_lock = threading.Lock()
+	_pdf_jobs = {}
+	_pdf_failed = OrderedDict()
+	_pdf_jobs_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_pdf_pool)
+
+
+def submit_pdf_job(data):
+	"""Queue a PDF render unless an identical one is already finished or in flight; returns its job id."""
+	job_id = pdf_job_id(data)
+	if os.path.exists(_pdf_path(job_id)):
+		DirectorySweeper.touch(_pdf_path(job_id))
+		return job_id
+	with _pdf_jobs_lock:
+		future = _pdf_jobs.get(job_id)
+		# The file is missing: render unless a render is still running (a finished one may
+		# have failed, or its PDF may have been swept since)
+		submitted = future is None or future.done()
+		if submitted:
+			future = _pdf_jobs[job_id] = _get_pdf_pool().submit(render_pdf_to_file, data, _pdf_path(job_id))
+			_pdf_failed.pop(job_id, None)
+			metrics.inc('hero_stage_in_flight', stage='pdf_job', purpose='pdf')
+	if submitted:
+		# Outside the lock: a future that is already done runs the callback right here
+		future.add_done_callback(_pdf_job_finished(job_id, time.perf_counter()))
+	return job_id
+
+
+def _pdf_job_finished(job_id, submitted):
+	"""Done callback: record queue + render time, fold the worker's metrics into ours and
+	retire the job (its PDF on disk, or its error in _pdf_failed, answers for it from now on)."""
+	def _finished(future):
+		metrics.inc('hero_stage_in_flight', -1, stage='pdf_job', purpose='pdf')
+		error = concurrent.futures.CancelledError() if future.cancelled() else future.exception()
+		with _pdf_jobs_lock:
+			if _pdf_jobs.get(job_id) is future:
+				del _pdf_jobs[job_id]
+				if error is not None:
+					_pdf_failed[job_id] = str(error) or error.__class__.__name__
+					while len(_pdf_failed) > PDF_FAILED_KEEP:
+						_pdf_failed.popitem(last=False)
+		if error is None:
+			metrics.merge(future.result()['metrics'])
+		elif getattr(error, 'metrics', None):
+			metrics.merge(error.metrics)
+		outcome = 'ok' if error is None else ('timeout' if is_timeout_error(error) else 'error')
+		record_stage('pdf_job', 'pdf', time.perf_counter() - submitted, outcome)
+	return _finished
+
+
+def pdf_job_status(job_id):
+	"""Return {'status': 'done'|'pending'|'failed', ...} or None for an unknown job."""
+	if os.path.exists(_pdf_path(job_id)):
+		return {'status': 'done'}
+	with _pdf_jobs_lock:
+		future = _pdf_jobs.get(job_id)
+		failed = _pdf_failed.get(job_id)
+	if failed is not None:
+		return {'status': 'failed', 'error': failed}
+	if future is None:
+		return None
+	if not future.done():
+		return {'status': 'pending'}
+	# Finished, but its done callback hasn't retired it yet
+	error = future.exception()
+	return {'status': 'failed', 'error': str(error) if error else 'PDF missing after render'}
+
+
+@app.route('/generate_pdf', methods=['POST'])
+def generate_pdf():
+	"""Queue a beautifully formatted PDF of the story, character, world, and images.
+	Expects JSON: { story_id } (or the story fields themselves).
+	Returns a job id at once; poll /pdf_jobs/<id> and fetch /pdf_jobs/<id>/download when done.
+	"""
+	data = story_fields(request.json or {})
+	try:
+		job_id = submit_pdf_job(data)
 	except Exception as e:
 		print(f"[ERROR] PDF generation failed: {e}")
 		return jsonify({'error': f"PDF generation failed: {str(e)}"}), 500
+	hero_name = data.get('hero_name') or 'The Hero'
+	status = pdf_job_status(job_id) or {'status': 'pending'}
+	status.update({
+		'job_id': job_id,
+		'status_url': f"/pdf_jobs/{job_id}",
+		'download_url': f"/pdf_jobs/{job_id}/download?name={quote(hero_name)}"
+	})
+	return jsonify(status), 200 if status['status'] == 'done' else 202
+
+
+@app.route('/pdf_jobs/<job_id>', methods=['GET'])
+def pdf_job(job_id):
+	status = pdf_job_status(job_id) if PDF_JOB_ID_RE.fullmatch(job_id) else None
+	if status is None:
+		return jsonify({'error': 'job not found'}), 404
+	status['job_id'] = job_id
+	return jsonify(status)
+
+
+@app.route('/pdf_jobs/<job_id>/download', methods=['GET'])
+def download_pdf(job_id):
+	"""Serve a finished PDF as an attachment named after the hero."""
+	if not PDF_JOB_ID_RE.fullmatch(job_id) or not os.path.exists(_pdf_path(job_id)):
+		return jsonify({'error': 'file not found'}), 404
+	hero_name = request.args.get('name') or 'The Hero'
+	return send_file(
+		_pdf_path(job_id),
+		mimetype='application/pdf',
+		as_attachment=True,
+		download_name=f"{os.path.basename(hero_name).replace(' ', '_')}_Adventure.pdf"
+	)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+	"""Prometheus text exposition of stage latencies, in-flight calls, failures, bytes and pool/cache state.
+	Values are per process; with several server workers, scrape each one.
+	"""
+	return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+if multiprocessing.parent_process() is None:
+	# PDF pool workers re-import this module; only the web process needs a warm client
+	# and the artifact compactor
+	warm_up_genai_client()
+	artifact_store.adopt_legacy_files()
+	artifact_store.start_compactor(OUTPUT_COMPACT_INTERVAL, also=(pdf_image_files, pdf_files))
 
 
 if __name__ == '__main__':
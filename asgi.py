@@ -0,0 +1,786 @@
+"""ASGI entry point with asyncio-native generation endpoints.
+
+Under the threaded Flask app every in-flight Gemini or ElevenLabs call holds a
+worker thread for its whole 20-90 seconds, so concurrency is capped by the thread
+count. Here /generate_story(_stream), /generate_image, /generate_bgm,
+/stream_bgm/<id>, /generate_analogy and /api/* run as coroutines on the async Gemini client
+(client.aio) and an httpx.AsyncClient for ElevenLabs, and the story asset job
+runs as event-loop tasks. JSON contracts are the same as the Flask routes; every
+other route (pages, /jobs, /media, PDFs, /metrics) is still served by the Flask
+app in app.py. Caching, admission control, retries, hedging and metrics are
+shared with the synchronous path.
+
+	uvicorn asgi:app --port 8000
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import os
+import time
+import uuid
+
+import httpx
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from quart import Quart, Response, jsonify, request, redirect
+
+import app as core
+from app import ProviderBusy, StoryNotFound
+
+
+quart_app = Quart(__name__, static_folder=None)
+# Story streams and BGM renders outlive Quart's 60s default; our own deadlines bound them
+quart_app.config['RESPONSE_TIMEOUT'] = None
+
+_http_client = None
+
+
+@quart_app.before_serving
+async def _open_http_client():
+	global _http_client
+	_http_client = httpx.AsyncClient(limits=httpx.Limits(
+		max_connections=core.GEMINI_POOL_MAX_CONNECTIONS,
+		max_keepalive_connections=core.GEMINI_POOL_MAX_KEEPALIVE,
+		keepalive_expiry=core.GEMINI_POOL_KEEPALIVE_EXPIRY
+	))
+
+
+@quart_app.after_serving
+async def _close_http_client():
+	if _http_client is not None:
+		await _http_client.aclose()
+
+
+@quart_app.errorhandler(ProviderBusy)
+async def provider_busy(e):
+	response = jsonify({'error': str(e), 'provider': e.provider, 'retry_after': e.retry_after})
+	response.status_code = 429
+	response.headers['Retry-After'] = str(e.retry_after)
+	return response
+
+
+@quart_app.errorhandler(StoryNotFound)
+async def story_not_found(e):
+	return jsonify({'error': 'story not found'}), 404
+
+
+# ----------------------
+# Async provider calls
+# ----------------------
+def _config(deadline, **fields):
+	"""GenerateContentConfig whose HTTP timeout ends at the deadline (a time.monotonic() value)."""
+	if deadline is not None:
+		fields['http_options'] = core.types.HttpOptions(timeout=int(max(1.0, deadline - time.monotonic()) * 1000))
+	return core.types.GenerateContentConfig(**fields) if fields else None
+
+
+async def run_with_deadline(coro, deadline, label):
+	"""Await coro, raising TimeoutError once the deadline passes (the coroutine is cancelled)."""
+	try:
+		return await asyncio.wait_for(coro, timeout=max(0.0, deadline - time.monotonic()))
+	except asyncio.TimeoutError:
+		raise TimeoutError(f"{label} timed out") from None
+
+
+async def with_retries_async(attempt, provider, purpose=None, deadline=None, deposit=True):
+	"""core.with_retries() for coroutines: same classification, budget and backoff, awaited."""
+	if deposit:
+		core.retry_budget.deposit()
+	n = 0
+	while True:
+		n += 1
+		try:
+			return await attempt()
+		except Exception as e:
+			remaining = None if deadline is None else deadline - time.monotonic()
+			delay = core.next_retry_delay(e, n, remaining, provider, purpose)
+			if delay is None:
+				raise
+			await asyncio.sleep(delay)
+
+
+async def hedged_async(make_call, provider, purpose):
+	"""core.hedged_call() for coroutines: the loser is cancelled rather than abandoned."""
+	async def _timed():
+		started = time.monotonic()
+		result = await make_call()
+		core.latency_window.observe(purpose, time.monotonic() - started)
+		return result
+
+	gate = core.provider_gates[provider]
+	first = asyncio.ensure_future(_timed())
+	delay = core.latency_window.percentile(purpose, 95) or core.HEDGE_DEFAULT_DELAY
+	done, _ = await asyncio.wait({first}, timeout=delay)
+	if done:
+		return first.result()
+	stats = gate.stats()
+	if stats['waiting'] or stats['active'] >= gate.max_concurrency:
+		core.metrics.inc('hero_hedged_requests_total', purpose=purpose, outcome='skipped')
+		return await first
+	core.metrics.inc('hero_hedged_requests_total', purpose=purpose, outcome='fired')
+	second = asyncio.ensure_future(_timed())
+	pending = {first, second}
+	error = None
+	try:
+		while pending:
+			done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				if task.exception() is None:
+					if task is second:
+						core.metrics.inc('hero_hedged_requests_total', purpose=purpose, outcome='won')
+					return task.result()
+				error = error or task.exception()
+		raise error
+	finally:
+		for task in pending:
+			task.cancel()
+
+
+def route_deadline(route, deadline=None):
+	"""core.route_deadline() for coroutines: the route's budget from now, or `deadline` if sooner."""
+	own = time.monotonic() + route['timeout']
+	return own if deadline is None else min(own, deadline)
+
+
+async def call_gemini_text_async(prompt, purpose=None, deadline=None, context=None):
+	"""core.call_gemini_text() on client.aio; returns {'raw': text} (or {'raw': 'Error: ...'})."""
+	route = core.text_route(purpose)
+	model = route['model']
+	ttl = core.TEXT_CACHE_TTLS.get(purpose) if core.TEXT_CACHE_ENABLED else None
+	cache_key = core.TextResponseCache.make_key(model, prompt, f"context:{context.digest}" if context else None) if ttl else None
+	if cache_key:
+		cached = await asyncio.to_thread(core.text_cache.get, cache_key, purpose)
+		if cached is not None:
+			return {'raw': cached, 'cached': True}
+
+	async def _attempt():
+		async with core.provider_gates['gemini_text'].admit_async(deadline):
+			with core.track_stage('gemini_text', purpose, route) as stage:
+				contents, fields = context.request(prompt) if context else (prompt, {})
+				stage.add_bytes(sum(len(part.encode('utf-8')) for part in (contents if isinstance(contents, list) else [contents])), 'sent')
+				try:
+					response = await core.get_genai_client().aio.models.generate_content(
+						model=model,
+						contents=contents,
+						config=_config(deadline, **fields)
+					)
+				except Exception as e:
+					if not fields or getattr(e, 'code', None) not in (400, 403, 404):
+						raise
+					print(f"[WARNING] Story context cache rejected ({e}); sending it inline")
+					core.story_contexts.invalidate(context)
+					response = await core.get_genai_client().aio.models.generate_content(
+						model=model,
+						contents=[context.text, prompt],
+						config=_config(deadline)
+					)
+				text = response.text if response else ''
+				stage.add_bytes(len((text or '').encode('utf-8')))
+				return text
+
+	try:
+		started = time.monotonic()
+		deadline = route_deadline(route, deadline)
+		if context is not None and context.model != model:
+			context = await asyncio.to_thread(core.story_contexts.on_model, context, model)
+		if purpose in core.HEDGE_PURPOSES:
+			# One deposit for the logical call, however many copies the hedge sends
+			core.retry_budget.deposit()
+			text = await hedged_async(lambda: with_retries_async(_attempt, 'gemini_text', purpose, deadline, deposit=False),
+				'gemini_text', purpose)
+		else:
+			text = await with_retries_async(_attempt, 'gemini_text', purpose, deadline)
+		if cache_key and text and text.strip():
+			await asyncio.to_thread(core.text_cache.put, cache_key, text, ttl, time.monotonic() - started, purpose)
+		return {'raw': text}
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		print(f'Gemini text error: {e}')
+		return {'raw': f'Error: {str(e)}'}
+
+
+async def call_gemini_structured_async(prompt, schema, purpose=None, deadline=None):
+	"""core.call_gemini_structured() on client.aio; returns a validated `schema` instance."""
+	route = core.text_route(purpose)
+	ttl = core.TEXT_CACHE_TTLS.get(purpose) if core.TEXT_CACHE_ENABLED else None
+	cache_key = core.TextResponseCache.make_key(route['model'], prompt, f'schema:{schema.__name__}') if ttl else None
+	if cache_key:
+		cached = await asyncio.to_thread(core.text_cache.get, cache_key, purpose)
+		if cached is not None:
+			try:
+				return schema.model_validate_json(cached)
+			except core.ValidationError:
+				print(f"[WARNING] Discarding cached {schema.__name__} that no longer validates")
+
+	async def _attempt():
+		async with core.provider_gates['gemini_text'].admit_async(deadline):
+			with core.track_stage('gemini_structured', purpose, route) as stage:
+				stage.add_bytes(len(prompt.encode('utf-8')), 'sent')
+				response = await core.get_genai_client().aio.models.generate_content(
+					model=route['model'],
+					contents=prompt,
+					config=_config(deadline, response_mime_type='application/json', response_schema=schema)
+				)
+				stage.add_bytes(len((response.text or '').encode('utf-8')))
+				return response
+
+	started = time.monotonic()
+	deadline = route_deadline(route, deadline)
+	response = await with_retries_async(_attempt, 'gemini_text', purpose, deadline)
+	parsed = response.parsed if isinstance(response.parsed, schema) else None
+	if parsed is None:
+		if not response.text:
+			raise ValueError(f"Empty {schema.__name__} response from Gemini")
+		parsed = schema.model_validate_json(response.text)
+	if cache_key:
+		await asyncio.to_thread(core.text_cache.put, cache_key, parsed.model_dump_json(), ttl, time.monotonic() - started, purpose)
+	return parsed
+
+
+async def call_gemini_image_async(prompt, prefix='image', deadline=None):
+	"""core.call_gemini_image() on client.aio; same content-addressed store and claim files."""
+	stored, claim = await asyncio.to_thread(core.claim_image_render, prompt, prefix)
+	if stored:
+		return stored
+	filename, out_path, claim_path = claim
+	try:
+		async def _render():
+			async with core.provider_gates['gemini_image'].admit_async(deadline):
+				with core.track_stage('gemini_image', prefix) as stage:
+					response = await core.get_genai_client().aio.models.generate_content(
+						model=core.GEMINI_IMAGE_MODEL,
+						contents=[prompt],
+						config=_config(deadline)
+					)
+					await asyncio.to_thread(core.save_image_response, response, out_path, stage)
+
+		await with_retries_async(_render, 'gemini_image', prefix, deadline)
+		return await asyncio.to_thread(core.artifact_store.register, filename)
+	except Exception as e:
+		print(f"Gemini image error: {e}")
+		raise
+	finally:
+		core.release_image_claim(claim_path)
+
+
+@contextlib.asynccontextmanager
+async def _music_stream(url, headers, body, deadline):
+	"""Streamed ElevenLabs POST on the shared AsyncClient (or the offline fake)."""
+	timeout = max(1.0, min(90.0, deadline - time.monotonic()))
+	if core.MUSIC_PROVIDER == 'fake':
+		import fake_providers
+		yield await fake_providers.post_music_async(url, headers=headers, json=body, timeout=timeout)
+		return
+	async with _http_client.stream('POST', url, headers=headers, json=body, timeout=timeout) as resp:
+		yield resp
+
+
+async def generate_bgm_async(world_description, character_description, filename, deadline, on_stream=None):
+	"""core.generate_bgm_instrumental() without holding a thread; returns (path, music_prompt).
+	Tees the track through a core.BgmStream the same way, calling on_stream(stream) when audio starts."""
+	stream = core.register_bgm_stream(filename)
+	try:
+		music_prompt = ''
+		try:
+			prompt_deadline = route_deadline(core.text_route('music_prompt'), deadline)
+			gem = await run_with_deadline(call_gemini_text_async(
+				core.music_prompt_request(world_description, character_description),
+				purpose='music_prompt', deadline=prompt_deadline), prompt_deadline, 'music prompt')
+			music_prompt = (gem.get('raw') or '').strip()
+			print(f"[DEBUG] Gemini BGM raw response (truncated): {music_prompt[:400]}")
+		except Exception as e:
+			print(f"[WARNING] Gemini music prompt generation failed: {e}")
+		if not music_prompt:
+			music_prompt = core.fallback_music_prompt(world_description, character_description)
+		url, headers, body = core.elevenlabs_music_request(music_prompt)
+
+		async def _compose():
+			async with core.provider_gates['elevenlabs'].admit_async(deadline):
+				with core.track_stage('elevenlabs', 'music') as stage:
+					stage.add_bytes(len(json.dumps(body).encode('utf-8')), 'sent')
+					async with _music_stream(url, headers, body, deadline) as resp:
+						if resp.status_code != 200:
+							detail = (await resp.aread()).decode('utf-8', 'replace')
+							raise core.UpstreamHTTPError('ElevenLabs', resp.status_code, detail)
+						stream.begin()
+						if on_stream and stream.attempt == 1:
+							on_stream(stream)
+						async for chunk in resp.aiter_bytes(8192):
+							stream.write(chunk)
+							stage.add_bytes(len(chunk))
+
+		await with_retries_async(_compose, 'elevenlabs', 'music', deadline)
+		return await asyncio.to_thread(stream.finish), music_prompt
+	except Exception as e:
+		print(f"BGM generation error: {e}")
+		stream.fail(e)
+		raise
+
+
+async def stream_story_text_async(character, world, timeout=None):
+	"""core.stream_story_text() on client.aio: an async generator of Markdown chunks."""
+	route = core.text_route('story')
+	timeout = timeout or route['timeout']
+	started = time.monotonic()
+	deadline = started + timeout
+	prompt = core.story_prompt(character, world)
+	with core.track_stage('gemini_stream', 'story', route) as stage:
+		stage.add_bytes(len(prompt.encode('utf-8')), 'sent')
+
+		async def _open():
+			# Pull the first chunk so failures before any text is sent can be retried; each
+			# attempt holds its own gate slot and gives it back if it fails
+			gate = contextlib.AsyncExitStack()
+			await gate.enter_async_context(core.provider_gates['gemini_text'].admit_async(deadline))
+			try:
+				stream = await core.get_genai_client().aio.models.generate_content_stream(
+					model=route['model'],
+					contents=prompt,
+					config=_config(deadline)
+				)
+				stream = stream.__aiter__()
+				try:
+					return gate, stream, await stream.__anext__()
+				except StopAsyncIteration:
+					return gate, stream, None
+			except BaseException:
+				await gate.aclose()
+				raise
+
+		gate, stream, chunk = await with_retries_async(_open, 'gemini_text', 'story', deadline)
+		async with gate:
+			first = True
+			while chunk is not None:
+				if time.monotonic() > deadline:
+					raise TimeoutError(f"story stream timed out after {timeout} seconds")
+				if chunk.text:
+					if first:
+						core.metrics.observe('hero_stream_first_chunk_seconds', time.monotonic() - started, purpose='story')
+						first = False
+					stage.add_bytes(len(chunk.text.encode('utf-8')))
+					yield chunk.text
+				try:
+					chunk = await stream.__anext__()
+				except StopAsyncIteration:
+					chunk = None
+
+
+# ----------------------
+# Async agent helpers
+# ----------------------
+async def extract_hero_name_async(character, timeout=None):
+	deadline = time.monotonic() + (timeout or core.text_route('hero_name')['timeout'])
+	try:
+		resp = await run_with_deadline(call_gemini_text_async(
+			core.hero_name_prompt(character), purpose='hero_name', deadline=deadline), deadline, 'hero name')
+		return '' if resp.get('error') else resp.get('raw', '').strip()
+	except ProviderBusy:
+		raise
+	except Exception:
+		return ''
+
+
+async def _prompt_then_image(prompt_req, purpose, prefix, image_timeout=60, context=None):
+	"""Async generate_visual_prompt_and_image / generate_hero_scene_and_image: (prompt, url) or (None, None)."""
+	try:
+		deadline = route_deadline(core.text_route(purpose))
+		resp = await run_with_deadline(call_gemini_text_async(
+			prompt_req, purpose=purpose, deadline=deadline, context=context), deadline, purpose)
+		visual_prompt = resp.get('raw', '').strip()
+		if not visual_prompt:
+			return None, None
+		print(f"[DEBUG] {purpose} generated: {visual_prompt[:300]}")
+		deadline = time.monotonic() + image_timeout
+		img_path = await run_with_deadline(call_gemini_image_async(visual_prompt, prefix, deadline), deadline, f"{prefix} image")
+		return visual_prompt, core.output_url(img_path)
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		print(f"[WARNING] {prefix} image generation failed: {e}")
+		return None, None
+
+
+async def build_image_result_async(itype, world, character, story_excerpt, context=None):
+	"""core.build_image_result() without holding a thread."""
+	in_context = context is not None
+	if itype == 'background':
+		prompt, img_url = await _prompt_then_image(
+			core.visual_prompt_request(world, story_excerpt or '', in_context), 'visual_prompt', 'background',
+			context=context)
+	else:
+		prompt, img_url = await _prompt_then_image(
+			core.hero_prompt_request(character, story_excerpt, in_context), 'hero_prompt', 'hero_scene',
+			context=context)
+	if not img_url:
+		return None
+	result = {'image_url': img_url, 'prompt': prompt}
+	try:
+		src_path = core.artifact_store.lookup(os.path.basename(img_url))
+		result['variants'] = await asyncio.to_thread(core.build_image_variants, src_path)
+	except Exception as e:
+		print(f"[WARNING] Could not build image variants: {e}")
+	return result
+
+
+async def build_bgm_result_async(world, character, timeout=60, on_stream=None):
+	"""core.build_bgm_result() without holding a thread."""
+	audio_file = f"bgm_{uuid.uuid4().hex[:8]}.mp3"
+	deadline = time.monotonic() + timeout
+	audio_path, prompt_used = await run_with_deadline(
+		generate_bgm_async(world, character, audio_file, deadline, on_stream), deadline, 'generate_bgm')
+	return {'audio_url': core.output_url(audio_path), 'prompt': prompt_used, 'audio_filename': os.path.basename(audio_path)}
+
+
+async def build_analogy_result_async(hero_name, story, timeout=None, context=None):
+	"""core.build_analogy_result() without holding a thread."""
+	deadline = time.monotonic() + (timeout or core.text_route('analogy')['timeout'])
+	try:
+		prompt = core.analogy_prompt(hero_name or 'the hero', story, in_context=context is not None)
+		resp = await run_with_deadline(call_gemini_text_async(
+			prompt, purpose='analogy', deadline=deadline, context=context), deadline, 'analogy')
+		analogy_md = resp.get('raw', '')
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		print(f"[WARNING] Analogy generation error: {e}")
+		analogy_md = ''
+	return {'analogy_md': analogy_md, 'analogy_html': core.render_markdown_html(analogy_md)}
+
+
+async def story_context_async(story_id, character, world, story):
+	"""core.story_context() off the event loop (registering a provider cache is a blocking call)."""
+	return await asyncio.to_thread(core.story_context, story_id, character, world, story)
+
+
+def start_story_job_async(character, world, story, story_id=None, hero_name=None, session_key=None):
+	"""core.start_story_job() for the event loop: the stages run as background tasks, not pool threads.
+	The job is registered with the Flask app, so /jobs/<id> and its SSE feed work unchanged.
+	"""
+	job = core.register_story_job(story_id)
+	timeouts = {key: timeout for _, key, timeout in core.STORY_JOB_STEPS}
+	story_excerpt = (story or '')[:300]
+
+	async def _stage(name, key, make_coro):
+		job.update(name, 'in-progress')
+		try:
+			with core.track_stage('story_job', key):
+				result = await run_with_deadline(make_coro(), time.monotonic() + timeouts[key], name)
+		except Exception as e:
+			print(f"[WARNING] {name} failed: {e}")
+			job.update(name, 'skipped', error=str(e))
+			return None
+		# update() also writes the result to the story store
+		await asyncio.to_thread(job.update, name, 'complete' if result else 'skipped', result=result or None)
+		return result
+
+	async def _in_context(build, *args):
+		return await build(*args, context=await story_context_async(story_id, character, world, story))
+
+	async def _speculated_or(key, build, *args, on_stream=None):
+		# Speculations run on the deadline pool; await the claimed future rather than a thread
+		future = core.speculative_assets.claim(session_key, key, on_stream=on_stream, world=world, character=character)
+		if future is not None:
+			try:
+				result = await asyncio.shield(asyncio.wrap_future(future))
+				if result:
+					return result
+			except Exception as e:
+				print(f"[WARNING] Speculative {key} unusable, generating it now: {e}")
+		return await build(*args)
+
+	def _announce_stream(stream):
+		job.progress('Background Music', {'stream_url': core.bgm_stream_url(stream)})
+
+	async def _known_or_extracted_name():
+		return hero_name or await extract_hero_name_async(character)
+
+	async def _name_then_analogy():
+		# The analogy is the only stage that needs another stage's result
+		name = await _stage('Hero Name Extraction', 'hero_name', _known_or_extracted_name)
+		await _stage('Real-life Inspiration', 'analogy', lambda: _in_context(build_analogy_result_async, name or 'the hero', story))
+
+	quart_app.add_background_task(_name_then_analogy)
+	quart_app.add_background_task(_stage, 'Hero Scene Image', 'hero_image',
+		lambda: _in_context(build_image_result_async, 'hero', world, character, story_excerpt))
+	quart_app.add_background_task(_stage, 'Background Image', 'background_image',
+		lambda: _speculated_or('background_image', _in_context, build_image_result_async, 'background', world, character, ''))
+	quart_app.add_background_task(_stage, 'Background Music', 'bgm',
+		lambda: _speculated_or('bgm', build_bgm_result_async, world, character, 60, _announce_stream, on_stream=_announce_stream))
+	return job
+
+
+# ----------------------
+# Async routes
+# ----------------------
+async def _json_body():
+	return (await request.get_json(silent=True)) or {}
+
+
+async def _story_body():
+	"""The JSON body with any story_id resolved from the story store (core.story_fields)."""
+	return await asyncio.to_thread(core.story_fields, await _json_body())
+
+
+@quart_app.route('/api/generate-questions', methods=['POST'])
+async def api_generate_questions():
+	data = await _json_body()
+	q_prompt = core.questions_prompt(data.get('user_prompt', ''), data.get('detected_topic', 'fantasy'))
+	error = None
+	for attempt in range(2):
+		try:
+			return jsonify(core.questions_payload(await call_gemini_structured_async(q_prompt, core.BuilderQuestionSet, purpose='questions')))
+		except ProviderBusy:
+			raise
+		except Exception as e:
+			error = e
+			print(f"[ERROR] Question generation attempt {attempt + 1} failed: {e}")
+	return jsonify(core.questions_failed_payload(error)), 503, {'Retry-After': str(core.QUESTIONS_RETRY_AFTER)}
+
+
+@quart_app.route('/api/character', methods=['POST'])
+async def api_character():
+	data = await _json_body()
+	answers = data.get('answers', {})
+	if core.answers_missing(answers):
+		return jsonify({'error': 'Please build the character before continuing!'}), 400
+	prompt = core.character_prompt(answers)
+	try:
+		payload = core.character_payload(await call_gemini_structured_async(prompt, core.CharacterProfile, purpose='character'))
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		print(f"[WARNING] Structured character generation failed, falling back to text: {e}")
+		payload = core.prose_character_payload(await call_gemini_text_async(prompt, purpose='character'))
+	if 'error' not in payload:
+		# Never start paid renders from an error message
+		core.speculative_assets.offer(data.get('session_key'), character=payload['character'])
+	return jsonify(payload)
+
+
+@quart_app.route('/api/world', methods=['POST'])
+async def api_world():
+	data = await _json_body()
+	answers = data.get('answers', {})
+	if core.answers_missing(answers):
+		return jsonify({'error': 'Please build the world before continuing!'}), 400
+	prompt = core.world_prompt(answers, data.get('detected', {}))
+	try:
+		payload = core.world_payload(await call_gemini_structured_async(prompt, core.WorldProfile, purpose='world'))
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		print(f"[WARNING] Structured world generation failed, falling back to text: {e}")
+		payload = core.prose_world_payload(await call_gemini_text_async(prompt, purpose='world'))
+	if 'error' not in payload:
+		core.speculative_assets.offer(data.get('session_key'), world=payload['world'])
+	return jsonify(payload)
+
+
+@quart_app.route('/generate_story', methods=['POST'])
+async def generate_story():
+	data = await _json_body()
+	character = data.get('character', '')
+	world = data.get('world', '')
+	hero_name = (data.get('hero_name') or '').strip()
+	deadline = route_deadline(core.text_route('story'))
+	try:
+		resp = await run_with_deadline(call_gemini_text_async(
+			core.story_prompt(character, world), purpose='story', deadline=deadline), deadline, 'generate_story')
+		story_md = resp.get('raw', '')
+		if not story_md:
+			raise RuntimeError('Empty story from model')
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		print(f"[CRITICAL ERROR] Story generation failed: {e}")
+		return jsonify({'story': None, 'images': [], 'audio': None, 'analogy': None,
+			'error': f"Story generation failed: {str(e)}"}), 500
+	story_id = await asyncio.to_thread(core.story_store.create, character, world, story_md)
+	return jsonify(core.story_payload(character, world, story_md, start_job=start_story_job_async, story_id=story_id,
+		hero_name=hero_name, session_key=data.get('session_key')))
+
+
+@quart_app.route('/generate_story_stream', methods=['POST'])
+async def generate_story_stream():
+	data = await _json_body()
+	character = data.get('character', '')
+	world = data.get('world', '')
+	hero_name = (data.get('hero_name') or '').strip()
+	core.provider_gates['gemini_text'].check()
+
+	async def _stream():
+		parts = []
+		blocks = core.MarkdownBlockStream()
+		try:
+			async for delta in stream_story_text_async(character, world):
+				parts.append(delta)
+				yield core.sse_event('chunk', core.stream_chunk(blocks, delta)).encode('utf-8')
+			story_md = ''.join(parts)
+			if not story_md.strip():
+				raise RuntimeError('Empty story from model')
+		except ProviderBusy as e:
+			yield core.sse_event('error', {'error': str(e), 'retry_after': e.retry_after}).encode('utf-8')
+			return
+		except Exception as e:
+			print(f"[CRITICAL ERROR] Story streaming failed: {e}")
+			yield core.sse_event('error', {'error': f"Story generation failed: {str(e)}"}).encode('utf-8')
+			return
+		story_id = await asyncio.to_thread(core.story_store.create, character, world, story_md)
+		payload = core.story_payload(character, world, story_md, start_job=start_story_job_async, story_id=story_id,
+		hero_name=hero_name, session_key=data.get('session_key'))
+		yield core.sse_event('story', payload).encode('utf-8')
+
+	return Response(_stream(), mimetype='text/event-stream',
+		headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@quart_app.route('/generate_image', methods=['POST'])
+async def generate_image():
+	data = await _story_body()
+	itype = data.get('type')
+	if itype not in ('background', 'hero'):
+		return jsonify({'error': 'unknown image type'}), 400
+	try:
+		context = await story_context_async(data.get('story_id'), data.get('character', ''), data.get('world', ''), data.get('story', ''))
+		payload = await build_image_result_async(itype, data.get('world', ''), data.get('character', ''), data.get('story_excerpt', ''), context)
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		return jsonify({'error': str(e)}), 500
+	if not payload:
+		return jsonify({'error': 'generation_failed'}), 500
+	await asyncio.to_thread(core.save_story_asset, data, 'hero_image' if itype == 'hero' else 'background_image', payload)
+	return jsonify(payload)
+
+
+@quart_app.route('/generate_bgm', methods=['POST'])
+async def generate_bgm():
+	data = await _story_body()
+	try:
+		if data.get('stream'):
+			return jsonify(await _start_bgm_stream(data))
+		payload = await build_bgm_result_async(data.get('world', ''), data.get('character', ''))
+		await asyncio.to_thread(core.save_story_asset, data, 'bgm', payload)
+		return jsonify(payload)
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		return jsonify({'error': str(e)}), 500
+
+
+async def _start_bgm_stream(data):
+	"""core.start_bgm_stream() as a background task: the stream_url payload once audio starts
+	(the full payload if composing ended first); the result is saved on the story when done."""
+	opened = asyncio.get_running_loop().create_future()
+
+	def _on_stream(stream):
+		if not opened.done():
+			opened.set_result(stream)
+
+	async def _compose():
+		try:
+			payload = await build_bgm_result_async(data.get('world', ''), data.get('character', ''), on_stream=_on_stream)
+		except Exception as e:
+			if not opened.done():
+				opened.set_exception(e)
+			return
+		await asyncio.to_thread(core.save_story_asset, data, 'bgm', payload)
+		if not opened.done():
+			opened.set_result(payload)
+
+	quart_app.add_background_task(_compose)
+	result = await opened
+	if isinstance(result, dict):
+		return result
+	return {'stream_url': core.bgm_stream_url(result), 'audio_url': core.output_url(result.path), 'audio_filename': result.filename}
+
+
+@quart_app.route('/stream_bgm/<stream_id>', methods=['GET'])
+async def stream_bgm(stream_id):
+	"""core.stream_bgm() without holding a thread per listener: polls the BgmStream instead of waiting on it."""
+	stream = core.get_bgm_stream(stream_id)
+	if stream is None:
+		return jsonify({'error': 'stream not found'}), 404
+	opened = stream.open_reader()
+	if opened is None:
+		if stream.done and not stream.error:
+			return redirect(core.output_url(stream.path))
+		return jsonify({'error': stream.error or 'stream not started'}), 404
+	f, attempt = opened
+
+	async def _chunks(idle_timeout=30):
+		offset = 0
+		idle_since = time.monotonic()
+		try:
+			while time.monotonic() - idle_since < idle_timeout:
+				size, current, done = stream.wait(offset, attempt, 0)
+				if current != attempt:
+					return
+				if size > offset:
+					data = f.read(min(size - offset, 64 * 1024))
+					offset += len(data)
+					idle_since = time.monotonic()
+					yield data
+				elif done:
+					return
+				else:
+					await asyncio.sleep(0.1)
+		finally:
+			f.close()
+
+	return Response(_chunks(), mimetype='audio/mpeg', headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+
+@quart_app.route('/generate_analogy', methods=['POST'])
+async def generate_analogy():
+	data = await _story_body()
+	story = data.get('story', '')
+	if not story or not str(story).strip():
+		return jsonify({'error': 'No story provided'}), 400
+	try:
+		context = await story_context_async(data.get('story_id'), data.get('character', ''), data.get('world', ''), story)
+		payload = await build_analogy_result_async(data.get('hero_name', ''), story, context=context)
+		await asyncio.to_thread(core.save_story_asset, data, 'analogy', payload)
+		return jsonify(payload)
+	except ProviderBusy:
+		raise
+	except Exception as e:
+		return jsonify({'error': str(e)}), 500
+
+
+# ----------------------
+# ASGI dispatch
+# ----------------------
+ASYNC_PATHS = {rule.rule for rule in quart_app.url_map.iter_rules() if '<' not in rule.rule}
+# Routes with URL parameters, matched by prefix
+ASYNC_PREFIXES = ('/stream_bgm/',)
+# Threads for the Flask routes; /jobs/<id>/events holds one for the life of the stream
+ASGI_FLASK_THREADS = int(os.getenv('ASGI_FLASK_THREADS', '64'))
+_flask_pool = concurrent.futures.ThreadPoolExecutor(max_workers=ASGI_FLASK_THREADS, thread_name_prefix='flask')
+
+
+class _PooledWsgiInstance(WsgiToAsgiInstance):
+	# asgiref runs WSGI apps thread-sensitively, i.e. every request on one shared thread:
+	# a single open SSE stream stalls all other Flask routes and the executor breaks under load
+	run_wsgi_app = sync_to_async(WsgiToAsgiInstance.run_wsgi_app.__wrapped__, thread_sensitive=False, executor=_flask_pool)
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+	"""WsgiToAsgi that runs each request on its own pool thread, like a threaded WSGI server."""
+
+	async def __call__(self, scope, receive, send):
+		await _PooledWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+flask_app = PooledWsgiToAsgi(core.app)
+
+
+async def app(scope, receive, send):
+	"""Send the generation endpoints (and lifespan events) to Quart, everything else to Flask."""
+	path = scope.get('path') or ''
+	if scope['type'] == 'lifespan' or path in ASYNC_PATHS or path.startswith(ASYNC_PREFIXES):
+		await quart_app(scope, receive, send)
+	else:
+		await flask_app(scope, receive, send)
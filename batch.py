@@ -0,0 +1,367 @@
+"""Produce stories in bulk (classroom sets, pre-seeded demos) from a JSONL file, without the browser.
+
+Each input line is one item; only "prompt" is required:
+
+	{"id": "class-3a-01", "prompt": "a shy dragon who collects lighthouses", "topic": "fantasy",
+	 "character_answers": {"How old are they?": "barely grown"}, "world_answers": {"What rules the sky?": "two moons"}}
+
+Without "topic" the setting is detected, and missing answers are filled with the example
+answers of generated questions. Every item then goes through the web flow's stages --
+detect, questions, character, world, story, hero name, hero / background image, BGM (with
+--bgm), analogy and PDF -- by calling app.py directly. At most --limit STAGE=N items are in
+a stage at once (see STAGE_LIMITS), on top of the providers' own admission control.
+
+Every finished stage is saved to <out>/checkpoint.json, so rerunning the same command after
+an interruption skips the work already done. Each item gets <out>/<id>/ with story.md,
+story.pdf, its images (and BGM) and a manifest.json of outputs and per-stage timings. Stories
+are also kept in the story store, so /story/<story_id> shows them on the running site. The run
+ends with a throughput report, saved as <out>/report.json as well.
+
+	GEMINI_PROVIDER=fake MUSIC_PROVIDER=fake python batch.py stories.jsonl --out batch-out --concurrency 8
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import time
+from collections import defaultdict
+
+import app as core
+from app import ProviderBusy
+
+
+# Items allowed in each stage at once; override with --limit STAGE=N
+STAGE_LIMITS = {
+	'detect': 8,
+	'questions': 8,
+	'character': 8,
+	'world': 8,
+	'story': 4,
+	'hero_name': 8,
+	'hero_image': 2,
+	'background_image': 2,
+	'bgm': 1,
+	'analogy': 4,
+	'pdf': 2
+}
+BUSY_RETRIES = 5  # times a stage waits out a provider's Retry-After before the item fails
+
+
+class Checkpoint:
+	"""Every item's finished stage outputs and timings in one JSON file, rewritten atomically after each stage."""
+
+	def __init__(self, path):
+		self.path = path
+		self.items = {}
+		self._lock = threading.Lock()
+		if os.path.exists(path):
+			with open(path, encoding='utf-8') as f:
+				self.items = json.load(f).get('items', {})
+
+	def get(self, item_id, stage):
+		with self._lock:
+			return self.items.get(item_id, {}).get('stages', {}).get(stage)
+
+	def timings(self, item_id):
+		with self._lock:
+			return dict(self.items.get(item_id, {}).get('timings', {}))
+
+	def put(self, item_id, stage, output, seconds):
+		with self._lock:
+			item = self.items.setdefault(item_id, {'stages': {}, 'timings': {}})
+			item['stages'][stage] = output
+			item['timings'][stage] = round(seconds, 3)
+			tmp_path = f"{self.path}.tmp"
+			with open(tmp_path, 'w', encoding='utf-8') as f:
+				json.dump({'items': self.items}, f, ensure_ascii=False)
+			os.replace(tmp_path, self.path)
+
+
+class StageRunner:
+	"""Runs item stages under per-stage concurrency limits, reusing checkpointed outputs."""
+
+	def __init__(self, checkpoint, limits):
+		self.checkpoint = checkpoint
+		self.durations = defaultdict(list)
+		self.resumed = defaultdict(list)
+		self.ran = defaultdict(list)
+		self._slots = {stage: threading.BoundedSemaphore(limit) for stage, limit in limits.items()}
+		self._lock = threading.Lock()
+
+	def run(self, item_id, stage, fn, valid=None):
+		"""The stage's checkpointed output, or fn()'s, which must be non-empty and JSON-serializable.
+		valid(output) can reject a checkpointed output (e.g. its file is gone) so the stage runs again."""
+		output = self.checkpoint.get(item_id, stage)
+		if output is not None and (valid is None or valid(output)):
+			with self._lock:
+				self.resumed[item_id].append(stage)
+			return output
+		if output is not None:
+			print(f"[WARNING] {item_id}: checkpointed {stage} is no longer usable, running it again")
+		for attempt in range(BUSY_RETRIES + 1):
+			with self._slots[stage]:
+				started = time.monotonic()
+				try:
+					output = fn()
+					break
+				except ProviderBusy as e:
+					if attempt == BUSY_RETRIES:
+						raise
+					wait = e.retry_after
+			print(f"[WARNING] {item_id}: {stage} provider busy, retrying in {wait}s")
+			time.sleep(wait)
+		seconds = time.monotonic() - started
+		if not output:
+			raise RuntimeError(f"{stage} produced no output")
+		self.checkpoint.put(item_id, stage, output, seconds)
+		with self._lock:
+			self.durations[stage].append(seconds)
+			self.ran[item_id].append(stage)
+		return output
+
+
+def percentile(values, pct):
+	"""Nearest-rank percentile of a non-empty list."""
+	ordered = sorted(values)
+	rank = max(1, int(round(pct / 100 * len(ordered))))
+	return ordered[min(rank, len(ordered)) - 1]
+
+
+def _checked(payload):
+	if payload.get('error'):
+		raise RuntimeError(payload['error'])
+	return payload
+
+
+def _questions(prompt, topic):
+	return core.questions_payload(core.call_gemini_structured(core.questions_prompt(prompt, topic), core.BuilderQuestionSet, purpose='questions'))
+
+
+def _example_answers(questions):
+	"""Answer generated questions with their own '(e.g. ...)' examples."""
+	return {q['question']: re.sub(r'^\(?\s*e\.g\.?,?\s*|\)$', '', (q.get('example') or '').strip()) for q in questions}
+
+
+def _story(character, world):
+	resp = core.run_with_timeout(lambda: core.call_gemini_text(core.story_prompt(character, world), purpose='story'),
+		timeout=core.text_route('story')['timeout'])
+	story_md = resp.get('raw', '')
+	if resp.get('error') or not story_md.strip():
+		raise RuntimeError(resp.get('error') or 'Empty story from model')
+	return {'story_id': core.story_store.create(character, world, story_md), 'story': story_md}
+
+
+def _analogy(hero_name, story, context):
+	result = core.build_analogy_result(hero_name, story, context=context)
+	return result if result['analogy_md'].strip() else None
+
+
+def _artifact_exists(url):
+	return bool(core.artifact_store.lookup(os.path.basename(url or '')))
+
+
+def _copy_artifact(url, item_dir, stem):
+	"""Copy a generated file out of the artifact store (which evicts old files) next to the item's PDF."""
+	src = core.artifact_store.lookup(os.path.basename(url or ''))
+	if not src:
+		raise RuntimeError(f"{url} is no longer in the artifact store")
+	name = stem + os.path.splitext(src)[1]
+	shutil.copyfile(src, os.path.join(item_dir, name))
+	return name
+
+
+def produce(item, runner, out_dir, pdf_pool, with_bgm):
+	"""Run one item through every stage; returns its manifest."""
+	item_id = item['id']
+	item_dir = os.path.join(out_dir, item_id)
+	os.makedirs(item_dir, exist_ok=True)
+	started = time.monotonic()
+	manifest = {'id': item_id, 'prompt': item['prompt'], 'status': 'failed', 'files': {}}
+
+	def run(stage, fn, valid=None):
+		return runner.run(item_id, stage, fn, valid)
+
+	try:
+		prompt = item['prompt']
+		topic = item.get('topic') or run('detect', lambda: core.detect_topic(prompt))
+		char_answers = item.get('character_answers') or {}
+		world_answers = item.get('world_answers') or {}
+		if core.answers_missing(char_answers) or core.answers_missing(world_answers):
+			questions = run('questions', lambda: _questions(prompt, topic))
+			if core.answers_missing(char_answers):
+				char_answers = _example_answers(questions['character_questions'])
+			if core.answers_missing(world_answers):
+				world_answers = _example_answers(questions['world_questions'])
+		manifest['topic'] = topic
+
+		char_payload = run('character', lambda: _checked(core.generate_character(char_answers)))
+		character = char_payload['character']
+		world = run('world', lambda: _checked(core.generate_world(world_answers, {'topic': topic})))['world']
+		written = run('story', lambda: _story(character, world))
+		story_id, story = written['story_id'], written['story']
+		with open(os.path.join(item_dir, 'story.md'), 'w', encoding='utf-8') as f:
+			f.write(story)
+		manifest['files']['story'] = 'story.md'
+		manifest.update(story_id=story_id, story_url=f"/story/{story_id}")
+
+		# A structured character carries its name; prose needs the extra round-trip
+		hero_name = char_payload.get('hero_name') or run('hero_name', lambda: core.extract_hero_name(character) or 'The Hero')
+		manifest['hero_name'] = hero_name
+		core.story_store.set_asset(story_id, 'hero_name', hero_name)
+
+		def context():
+			return core.story_context(story_id, character, world, story)
+
+		stages = {
+			'hero_image': lambda: core.build_image_result('hero', world, character, story[:300], context=context()),
+			'background_image': lambda: core.build_image_result('background', world, character, '', context=context()),
+			'analogy': lambda: _analogy(hero_name, story, context())
+		}
+		if with_bgm:
+			stages['bgm'] = lambda: core.build_bgm_result(world, character)
+		# A checkpointed image or track the artifact store has since evicted is generated again
+		valid = {
+			'hero_image': lambda out: _artifact_exists(out['image_url']),
+			'background_image': lambda out: _artifact_exists(out['image_url']),
+			'bgm': lambda out: _artifact_exists(out['audio_url'])
+		}
+		# The asset stages only need the story, so they run side by side
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(stages)) as pool:
+			futures = {stage: pool.submit(run, stage, fn, valid.get(stage)) for stage, fn in stages.items()}
+		errors = {stage: future.exception() for stage, future in futures.items() if future.exception()}
+		if errors:
+			raise RuntimeError('; '.join(f"{stage}: {e}" for stage, e in errors.items()))
+		assets = {stage: future.result() for stage, future in futures.items()}
+		for stage, result in assets.items():
+			core.story_store.set_asset(story_id, stage, result)
+
+		pdf_path = os.path.join(item_dir, 'story.pdf')
+		data = {
+			'story': story,
+			'character': character,
+			'world': world,
+			'hero_name': hero_name,
+			'analogy': assets['analogy']['analogy_md'],
+			# images[0] is the hero scene, images[1] the background, as the PDF expects
+			'images': [assets['hero_image']['image_url'], assets['background_image']['image_url']]
+		}
+		# Render again if the file is gone or an asset it shows was just regenerated
+		regenerated = set(runner.ran.get(item_id, [])) & set(stages)
+		run('pdf', lambda: {'bytes': pdf_pool.submit(core.render_pdf_to_file, data, pdf_path).result()['bytes']},
+			lambda out: os.path.exists(pdf_path) and not regenerated)
+		manifest['files']['pdf'] = 'story.pdf'
+
+		for stage, stem in (('hero_image', 'hero'), ('background_image', 'background')):
+			manifest['files'][stem] = _copy_artifact(assets[stage]['image_url'], item_dir, stem)
+		if with_bgm:
+			manifest['files']['bgm'] = _copy_artifact(assets['bgm']['audio_url'], item_dir, 'bgm')
+		manifest['status'] = 'done'
+	except Exception as e:
+		print(f"[WARNING] {item_id} failed: {e}")
+		manifest['error'] = str(e)
+
+	manifest['timings'] = runner.checkpoint.timings(item_id)
+	manifest['resumed_stages'] = runner.resumed.get(item_id, [])
+	manifest['ran_stages'] = runner.ran.get(item_id, [])
+	manifest['wall_seconds'] = round(time.monotonic() - started, 3)
+	with open(os.path.join(item_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+		json.dump(manifest, f, indent=2, ensure_ascii=False)
+	return manifest
+
+
+def load_items(path, limit=None):
+	"""Parse the JSONL input; ids default to the line number and are made safe to use as directory names."""
+	items = []
+	with open(path, encoding='utf-8') as f:
+		for n, line in enumerate(f, 1):
+			if not line.strip():
+				continue
+			item = json.loads(line)
+			if not str(item.get('prompt') or '').strip():
+				raise ValueError(f"{path}:{n}: 'prompt' is required")
+			item['id'] = re.sub(r'[^A-Za-z0-9._-]+', '-', str(item.get('id') or f"item-{n:04d}")).strip('.-') or f"item-{n:04d}"
+			items.append(item)
+	ids = [item['id'] for item in items]
+	if len(set(ids)) != len(ids):
+		raise ValueError(f"{path}: item ids must be unique")
+	return items[:limit] if limit else items
+
+
+def parse_limits(values):
+	limits = dict(STAGE_LIMITS)
+	for value in values or []:
+		stage, _, limit = value.partition('=')
+		if stage not in limits or not limit.isdigit() or int(limit) < 1:
+			raise SystemExit(f"--limit expects STAGE=N with STAGE one of {', '.join(limits)}")
+		limits[stage] = int(limit)
+	return limits
+
+
+def report(manifests, runner, elapsed):
+	"""Print and return the run's throughput and per-stage latency summary. Throughput only
+	counts stories this run worked on, not ones finished entirely from the checkpoint."""
+	done = [m for m in manifests if m['status'] == 'done']
+	produced = [m for m in done if m['ran_stages']]
+	summary = {
+		'items': len(manifests),
+		'done': len(done),
+		'produced': len(produced),
+		'already_done': len(done) - len(produced),
+		'failed': len(manifests) - len(done),
+		'elapsed_seconds': round(elapsed, 3),
+		'stories_per_hour': round(len(produced) / elapsed * 3600, 2) if produced and elapsed > 0 else 0.0,
+		'stages': {}
+	}
+	print(f"\n{summary['done']} done ({summary['produced']} produced now, {summary['already_done']} already done), "
+		f"{summary['failed']} failed of {summary['items']} items in {elapsed:.1f}s ({summary['stories_per_hour']:.1f} stories/hour)\n")
+	print(f"{'stage':<18}{'run':>6}{'resumed':>9}{'mean':>9}{'p50':>9}{'p95':>9}{'max':>9}")
+	resumed = defaultdict(int)
+	for stages in runner.resumed.values():
+		for stage in stages:
+			resumed[stage] += 1
+	for stage in STAGE_LIMITS:
+		values = runner.durations.get(stage) or []
+		if not values and not resumed[stage]:
+			continue
+		stats = {'run': len(values), 'resumed': resumed[stage]}
+		if values:
+			stats.update(mean=sum(values) / len(values), p50=percentile(values, 50), p95=percentile(values, 95), max=max(values))
+		summary['stages'][stage] = {k: round(v, 3) if isinstance(v, float) else v for k, v in stats.items()}
+		timing = ''.join(f"{stats[k]:>9.2f}" if k in stats else f"{'-':>9}" for k in ('mean', 'p50', 'p95', 'max'))
+		print(f"{stage:<18}{stats['run']:>6}{stats['resumed']:>9}{timing}")
+	return summary
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('input', help='JSONL file, one item per line')
+	parser.add_argument('--out', default='batch-out', help='output directory (holds the checkpoint; reuse it to resume)')
+	parser.add_argument('--concurrency', type=int, default=4, help='items in flight at once')
+	parser.add_argument('--limit', action='append', metavar='STAGE=N', help='items allowed in one stage at once (repeatable)')
+	parser.add_argument('--items', type=int, help='only the first N items')
+	parser.add_argument('--bgm', action='store_true', help='also compose background music for each story')
+	args = parser.parse_args()
+
+	items = load_items(args.input, args.items)
+	os.makedirs(args.out, exist_ok=True)
+	limits = parse_limits(args.limit)
+	runner = StageRunner(Checkpoint(os.path.join(args.out, 'checkpoint.json')), limits)
+	# spawn, like the web app's PDF pool: never fork a process that already runs threads
+	pdf_pool = concurrent.futures.ProcessPoolExecutor(max_workers=limits['pdf'], mp_context=multiprocessing.get_context('spawn'))
+
+	started = time.monotonic()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix='batch') as pool:
+		manifests = list(pool.map(lambda item: produce(item, runner, args.out, pdf_pool, args.bgm), items))
+	pdf_pool.shutdown()
+
+	summary = report(manifests, runner, time.monotonic() - started)
+	with open(os.path.join(args.out, 'report.json'), 'w', encoding='utf-8') as f:
+		json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+	main()
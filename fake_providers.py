@@ -0,0 +1,360 @@
+"""Offline stand-ins for Gemini (text + image) and ElevenLabs music.
+
+Used for load tests and local runs with no network or quota. Enable them with
+GEMINI_PROVIDER=fake and/or MUSIC_PROVIDER=fake; each backend then reads its
+behaviour from the environment:
+
+	FAKE_TEXT_LATENCY=lognormal:1.5:0.5   # seconds; see parse_latency() for the shapes
+	FAKE_IMAGE_LATENCY=uniform:4:12
+	FAKE_MUSIC_LATENCY=fixed:20           # total time to stream the whole track
+	FAKE_TEXT_ERROR_RATE=0.02             # fraction of calls failing with a 503
+	FAKE_IMAGE_ERROR_RATE=0.02
+	FAKE_MUSIC_ERROR_RATE=0.02
+	FAKE_TEXT_WORDS=800                   # words per free-text answer
+	FAKE_IMAGE_SIZE=1024x1024             # noise PNG, so it weighs about as much as a real render
+	FAKE_MUSIC_BYTES=960000               # ~60s of 128kbps MP3
+
+Every fake honours the timeout it is called with (http_options.timeout, or timeout= for
+music): a call or stream that would outlast it is cut off with httpx.ReadTimeout, so
+deadline handling can be load-tested offline.
+"""
+import os
+import math
+import asyncio
+import random
+import threading
+import time
+import typing
+
+import httpx
+from google.genai import errors
+from PIL import Image as PILImage
+from pydantic import BaseModel
+
+
+_rng = random.Random(os.getenv('FAKE_SEED'))
+_rng_lock = threading.Lock()
+
+_WORDS = (
+	'hero world light shadow ancient quiet storm river forge memory courage lantern city '
+	'forest machine promise whisper sky ember tide crystal journey song stone wind heart'
+).split()
+
+
+def parse_latency(spec):
+	"""Turn 'fixed:S', 'uniform:A:B', 'normal:MU:SIGMA', 'lognormal:MEDIAN:SIGMA' or 'exp:MEAN'
+	into a zero-argument sampler returning seconds (never negative)."""
+	kind, *params = spec.split(':')
+	params = [float(p) for p in params]
+	if kind == 'fixed':
+		return lambda: params[0]
+	if kind == 'uniform':
+		return lambda: _sample(lambda r: r.uniform(params[0], params[1]))
+	if kind == 'normal':
+		return lambda: max(0.0, _sample(lambda r: r.gauss(params[0], params[1])))
+	if kind == 'lognormal':
+		mu = math.log(params[0])
+		return lambda: _sample(lambda r: r.lognormvariate(mu, params[1]))
+	if kind == 'exp':
+		return lambda: _sample(lambda r: r.expovariate(1.0 / params[0]))
+	raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def _sample(draw):
+	with _rng_lock:
+		return draw(_rng)
+
+
+class FakeBackend:
+	"""Latency / error / payload settings for one fake provider, read from FAKE_<NAME>_*."""
+
+	def __init__(self, name, latency, error_rate):
+		prefix = f"FAKE_{name.upper()}_"
+		self.name = name
+		self.latency = parse_latency(os.getenv(prefix + 'LATENCY', latency))
+		self.error_rate = float(os.getenv(prefix + 'ERROR_RATE', error_rate))
+
+	def should_fail(self):
+		return _sample(lambda r: r.random()) < self.error_rate
+
+	def wait(self, timeout_s=None):
+		"""Sleep for one sampled latency, raising like httpx would if it outlasts timeout_s."""
+		delay = self.latency()
+		if timeout_s is not None and delay > timeout_s:
+			time.sleep(timeout_s)
+			raise httpx.ReadTimeout(f"fake {self.name} provider timed out after {timeout_s:.1f}s")
+		time.sleep(delay)
+
+	def overload_error(self):
+		return errors.ServerError(503, {'error': {'code': 503, 'message': f'fake {self.name} overload', 'status': 'UNAVAILABLE'}})
+
+
+TEXT = FakeBackend('text', 'lognormal:1.5:0.5', '0')
+IMAGE = FakeBackend('image', 'uniform:4:12', '0')
+MUSIC = FakeBackend('music', 'fixed:20', '0')
+TEXT_WORDS = int(os.getenv('FAKE_TEXT_WORDS', '800'))
+IMAGE_SIZE = tuple(int(v) for v in os.getenv('FAKE_IMAGE_SIZE', '1024x1024').split('x'))
+MUSIC_BYTES = int(os.getenv('FAKE_MUSIC_BYTES', '960000'))
+
+
+def fake_text(words=None):
+	count = words or TEXT_WORDS
+	chosen = _sample(lambda r: [r.choice(_WORDS) for _ in range(count)])
+	sentences = [' '.join(chosen[i:i + 12]).capitalize() + '.' for i in range(0, count, 12)]
+	paragraphs = [' '.join(sentences[i:i + 6]) for i in range(0, len(sentences), 6)]
+	return '\n\n'.join(paragraphs)
+
+
+def _fake_value(annotation, name, index):
+	origin = typing.get_origin(annotation)
+	args = [a for a in typing.get_args(annotation) if a is not type(None)]
+	if origin in (list, tuple, set):
+		return [_fake_value(args[0] if args else str, name, i) for i in range(1, 4)]
+	if origin is typing.Literal:
+		return args[0]
+	if origin is not None and args:
+		# Optional[X] / Union[X, ...]: use the first concrete member
+		return _fake_value(args[0], name, index)
+	if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+		return fake_instance(annotation, index)
+	if annotation is int:
+		return index
+	if annotation is float:
+		return round(_sample(lambda r: r.random()), 3)
+	if annotation is bool:
+		return True
+	return f"{name.replace('_', ' ').capitalize()} {index}: {fake_text(8)}"
+
+
+def fake_instance(schema, index=1):
+	"""A schema-valid instance of a pydantic model, for structured-output calls."""
+	return schema(**{name: _fake_value(field.annotation, name, index) for name, field in schema.model_fields.items()})
+
+
+def _timeout_s(config):
+	http_options = getattr(config, 'http_options', None) if config is not None else None
+	timeout_ms = getattr(http_options, 'timeout', None)
+	return timeout_ms / 1000 if timeout_ms else None
+
+
+def _request_timeout_s(timeout):
+	"""Seconds from a requests / httpx timeout argument (number, (connect, read) tuple or httpx.Timeout)."""
+	if isinstance(timeout, tuple):
+		timeout = timeout[1]
+	elif isinstance(timeout, httpx.Timeout):
+		timeout = timeout.read
+	return float(timeout) if timeout else None
+
+
+class StreamClock:
+	"""Sleeps through a fake stream's gaps and raises httpx.ReadTimeout, like the real client,
+	once the stream as a whole would outlast its request timeout."""
+
+	def __init__(self, name, timeout_s):
+		self.name = name
+		self.timeout_s = timeout_s
+		self.spent = 0.0
+
+	def _step(self, seconds):
+		if self.timeout_s is not None and self.spent + seconds > self.timeout_s:
+			return max(0.0, self.timeout_s - self.spent), True
+		self.spent += seconds
+		return seconds, False
+
+	def _expired(self):
+		return httpx.ReadTimeout(f"fake {self.name} provider timed out after {self.timeout_s:.1f}s")
+
+	def sleep(self, seconds):
+		delay, expired = self._step(seconds)
+		time.sleep(delay)
+		if expired:
+			raise self._expired()
+
+	async def asleep(self, seconds):
+		delay, expired = self._step(seconds)
+		await asyncio.sleep(delay)
+		if expired:
+			raise self._expired()
+
+
+class FakePart:
+	def __init__(self, text=None, image=None):
+		self.text = text
+		self.inline_data = True if image is not None else None
+		self._image = image
+
+	def as_image(self):
+		return self._image
+
+
+class FakeResponse:
+	def __init__(self, text=None, parsed=None, image=None):
+		self.text = text
+		self.parsed = parsed
+		self.parts = [FakePart(image=image)] if image is not None else [FakePart(text=text)]
+
+
+class FakeModels:
+	"""Mirrors the subset of `client.models` the app uses."""
+
+	def get(self, model):
+		return {'name': model}
+
+	def generate_content(self, model, contents, config=None):
+		if 'image' in model:
+			IMAGE.wait(_timeout_s(config))
+			if IMAGE.should_fail():
+				raise IMAGE.overload_error()
+			noise = _sample(lambda r: r.randbytes(IMAGE_SIZE[0] * IMAGE_SIZE[1] * 3))
+			return FakeResponse(image=PILImage.frombytes('RGB', IMAGE_SIZE, noise))
+		TEXT.wait(_timeout_s(config))
+		if TEXT.should_fail():
+			raise TEXT.overload_error()
+		schema = getattr(config, 'response_schema', None) if config is not None else None
+		if isinstance(schema, type) and issubclass(schema, BaseModel):
+			parsed = fake_instance(schema)
+			return FakeResponse(text=parsed.model_dump_json(), parsed=parsed)
+		return FakeResponse(text=fake_text())
+
+	def generate_content_stream(self, model, contents, config=None):
+		# Roughly a fifth of the latency before the first token, the rest spread over the chunks
+		total = TEXT.latency()
+		clock = StreamClock(TEXT.name, _timeout_s(config))
+		clock.sleep(total * 0.2)
+		if TEXT.should_fail():
+			raise TEXT.overload_error()
+		words = fake_text().split(' ')
+		chunks = [' '.join(words[i:i + 20]) + ' ' for i in range(0, len(words), 20)]
+		for chunk in chunks:
+			clock.sleep(total * 0.8 / len(chunks))
+			yield FakeResponse(text=chunk)
+
+
+class FakeAsyncModels:
+	"""Mirrors `client.aio.models`: the same fakes, awaiting instead of sleeping."""
+
+	async def generate_content(self, model, contents, config=None):
+		backend = IMAGE if 'image' in model else TEXT
+		delay = backend.latency()
+		timeout_s = _timeout_s(config)
+		if timeout_s is not None and delay > timeout_s:
+			await asyncio.sleep(timeout_s)
+			raise httpx.ReadTimeout(f"fake {backend.name} provider timed out after {timeout_s:.1f}s")
+		await asyncio.sleep(delay)
+		if backend.should_fail():
+			raise backend.overload_error()
+		if backend is IMAGE:
+			noise = _sample(lambda r: r.randbytes(IMAGE_SIZE[0] * IMAGE_SIZE[1] * 3))
+			return FakeResponse(image=PILImage.frombytes('RGB', IMAGE_SIZE, noise))
+		schema = getattr(config, 'response_schema', None) if config is not None else None
+		if isinstance(schema, type) and issubclass(schema, BaseModel):
+			parsed = fake_instance(schema)
+			return FakeResponse(text=parsed.model_dump_json(), parsed=parsed)
+		return FakeResponse(text=fake_text())
+
+	async def generate_content_stream(self, model, contents, config=None):
+		total = TEXT.latency()
+		clock = StreamClock(TEXT.name, _timeout_s(config))
+		await clock.asleep(total * 0.2)
+		if TEXT.should_fail():
+			raise TEXT.overload_error()
+		words = fake_text().split(' ')
+		chunks = [' '.join(words[i:i + 20]) + ' ' for i in range(0, len(words), 20)]
+
+		async def _chunks():
+			for chunk in chunks:
+				await clock.asleep(total * 0.8 / len(chunks))
+				yield FakeResponse(text=chunk)
+		return _chunks()
+
+
+class FakeCachedContent:
+	def __init__(self, name, model, expire_time):
+		self.name = name
+		self.model = model
+		self.expire_time = expire_time
+
+
+class FakeCaches:
+	"""Mirrors `client.caches`: create() costs one short text round-trip and returns a named handle."""
+
+	def __init__(self):
+		self._names = set()
+		self._lock = threading.Lock()
+
+	def create(self, model, config=None):
+		time.sleep(min(TEXT.latency(), 0.5))
+		ttl = float(str(getattr(config, 'ttl', None) or '3600s').rstrip('s'))
+		cached = FakeCachedContent(f"cachedContents/fake-{_sample(lambda r: r.getrandbits(64)):016x}", model, time.time() + ttl)
+		with self._lock:
+			self._names.add(cached.name)
+		return cached
+
+	def delete(self, name, config=None):
+		with self._lock:
+			self._names.discard(name)
+
+
+class FakeAio:
+	def __init__(self):
+		self.models = FakeAsyncModels()
+
+
+class FakeGenaiClient:
+	"""Drop-in for genai.Client when GEMINI_PROVIDER=fake."""
+
+	def __init__(self):
+		self.models = FakeModels()
+		self.caches = FakeCaches()
+		self.aio = FakeAio()
+
+
+class FakeMusicResponse:
+	"""Mimics the streamed `requests` response from the ElevenLabs music endpoint."""
+
+	def __init__(self, status_code, duration, size, timeout=None):
+		self.status_code = status_code
+		self.text = '' if status_code == 200 else '{"detail": "fake music overload"}'
+		self._duration = duration
+		self._size = size
+		self._clock = StreamClock(MUSIC.name, _request_timeout_s(timeout))
+
+	def iter_content(self, chunk_size=8192):
+		chunks = max(1, self._size // chunk_size)
+		for i in range(chunks):
+			self._clock.sleep(self._duration / chunks)
+			length = chunk_size if i < chunks - 1 else self._size - chunk_size * (chunks - 1)
+			yield _sample(lambda r: r.randbytes(length))
+
+	def close(self):
+		pass
+
+
+class FakeAsyncMusicResponse(FakeMusicResponse):
+	"""The httpx.AsyncClient streaming-response counterpart of FakeMusicResponse."""
+
+	async def aiter_bytes(self, chunk_size=8192):
+		chunks = max(1, self._size // chunk_size)
+		for i in range(chunks):
+			await self._clock.asleep(self._duration / chunks)
+			length = chunk_size if i < chunks - 1 else self._size - chunk_size * (chunks - 1)
+			yield _sample(lambda r: r.randbytes(length))
+
+	async def aread(self):
+		return self.text.encode('utf-8')
+
+
+async def post_music_async(url, headers=None, json=None, timeout=None):
+	"""Stand-in for an httpx.AsyncClient streamed POST to the ElevenLabs music endpoint."""
+	if MUSIC.should_fail():
+		await asyncio.sleep(0.2)
+		return FakeAsyncMusicResponse(503, 0, 0)
+	return FakeAsyncMusicResponse(200, MUSIC.latency(), MUSIC_BYTES, timeout)
+
+
+def post_music(url, headers=None, json=None, stream=True, timeout=None):
+	"""Stand-in for requests.post() against the ElevenLabs music endpoint."""
+	if MUSIC.should_fail():
+		time.sleep(0.2)
+		return FakeMusicResponse(503, 0, 0)
+	return FakeMusicResponse(200, MUSIC.latency(), MUSIC_BYTES, timeout)
@@ -22,56 +22,53 @@ document.addEventListener('DOMContentLoaded', () => {
     const detectedTopic = document.getElementById('detected-topic')?.textContent?.trim() || 'fantasy';
     const rawPrompt = document.querySelector('[data-raw-prompt]')?.getAttribute('data-raw-prompt') || '';
     
-    // Show loading message
-    charQuestionsDiv.innerHTML = '<p>Loading character building questions...</p>';
-    worldQuestionsDiv.innerHTML = '<p>Loading world building questions...</p>';
-    
-    fetch('/api/generate-questions', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({
-        user_prompt: rawPrompt,
-        detected_topic: detectedTopic
+    // Fetch the questions; on failure show a retry button instead of an empty form
+    const loadQuestions = () => {
+      charQuestionsDiv.innerHTML = '<p>Loading character building questions...</p>';
+      worldQuestionsDiv.innerHTML = '<p>Loading world building questions...</p>';
+
+      fetch('/api/generate-questions', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          user_prompt: rawPrompt,
+          detected_topic: detectedTopic
+        })
       })
-    })
-    .then(r => r.json())
-    .then(data => {
-      // Populate character questions
-      const charQs = data.character_questions || [];
-      if (charQs.length > 0) {
-        charQuestionsDiv.innerHTML = charQs.map(q => `
+      .then(r => r.json().then(data => {
+        if (!r.ok) throw Object.assign(new Error(data.error || `HTTP ${r.status}`), { retryAfter: data.retry_after });
+        return data;
+      }))
+      .then(data => {
+        charQuestionsDiv.innerHTML = data.character_questions.map(q => `
           <label>${q.question}</label>
           <textarea name="char_q${q.number}" placeholder="${q.example}"></textarea>
         `).join('');
-      } else {
-        charQuestionsDiv.innerHTML = '<p>No character questions loaded. Please refresh.</p>';
-      }
-      
-      // Populate world questions
-      const worldQs = data.world_questions || [];
-      if (worldQs.length > 0) {
-        worldQuestionsDiv.innerHTML = worldQs.map(q => `
+        worldQuestionsDiv.innerHTML = data.world_questions.map(q => `
           <label>${q.question}</label>
           <textarea name="world_q${q.number}" placeholder="${q.example}"></textarea>
         `).join('');
-      } else {
-        worldQuestionsDiv.innerHTML = '<p>No world questions loaded. Please refresh.</p>';
-      }
-      
-      console.log(`Loaded ${charQs.length} character questions and ${worldQs.length} world questions`);
-    })
-    .catch(err => {
-      console.error('Error fetching questions:', err);
-      charQuestionsDiv.innerHTML = '<p>Error loading character questions. Please refresh.</p>';
-      worldQuestionsDiv.innerHTML = '<p>Error loading world questions. Please refresh.</p>';
-    });
+        console.log(`Loaded ${data.character_questions.length} character questions and ${data.world_questions.length} world questions`);
+      })
+      .catch(err => {
+        console.error('Error fetching questions:', err);
+        const wait = err.retryAfter ? ` Please try again in ${err.retryAfter}s.` : '';
+        charQuestionsDiv.innerHTML = `<p>We couldn't load the questions.${wait}</p><button type="button" class="retry-questions">Retry</button>`;
+        worldQuestionsDiv.innerHTML = '';
+        charQuestionsDiv.querySelector('.retry-questions').addEventListener('click', loadQuestions);
+      });
+    };
+    loadQuestions();
   }
 
   // Character and World generation
   const genCharacter = document.getElementById('gen-character');
   const genWorld = document.getElementById('gen-world');
   const doneButton = document.getElementById('done-button');
+  // Lets the server start the background image and BGM before the story exists
+  const sessionKey = document.querySelector('[data-session-key]')?.getAttribute('data-session-key') || '';
   let characterText = '';
+  let heroName = '';
   let worldText = '';
 
   function showProgressFake(el){
@@ -84,7 +81,7 @@ document.addEventListener('DOMContentLoaded', () => {
       const form = document.getElementById('character-form');
       const data = {};
       Array.from(form.elements).forEach(f=>{ if(f.name && f.value) data[f.name]=f.value });
-      const resp = await fetch('/api/character',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({answers:data})});
+      const resp = await fetch('/api/character',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({answers:data, session_key:sessionKey})});
       const j = await resp.json();
       if (!resp.ok) {
         alert(j.error || 'Please build the character before continuing!');
@@ -92,6 +89,7 @@ document.addEventListener('DOMContentLoaded', () => {
         return;
       }
       characterText = j.character;
+      heroName = j.hero_name || '';
       document.getElementById('character-output').textContent = characterText;
       checkDoneButtonState();
     });
@@ -104,7 +102,7 @@ document.addEventListener('DOMContentLoaded', () => {
       const data = {};
       Array.from(form.elements).forEach(f=>{ if(f.name && f.value) data[f.name]=f.value });
       const detected = document.getElementById('detected-topic')?.textContent || '';
-      const resp = await fetch('/api/world',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({answers:data, detected:{topic:detected}})});
+      const resp = await fetch('/api/world',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({answers:data, detected:{topic:detected}, session_key:sessionKey})});
       const j = await resp.json();
       if (!resp.ok) {
         alert(j.error || 'Please build the world before continuing!');
@@ -129,179 +127,288 @@ document.addEventListener('DOMContentLoaded', () => {
       document.getElementById('final-section').style.display = 'block';
       document.getElementById('story-text').textContent = 'Crafting your story...';
       
-      // Show progress checklist
-      const checklist = document.getElementById('progress-checklist');
-      checklist.style.display = 'block';
-      const checklistItems = document.getElementById('checklist-items');
-      checklistItems.innerHTML = '';
-      
-      const resp = await fetch('/generate_story',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({character:characterText, world:worldText})});
-      const j = await resp.json();
+      // Stream the story so the first paragraphs render while the rest is still being written:
+      // finished blocks arrive as HTML once each, the paragraph in progress is shown as text
+      const storyText = document.getElementById('story-text');
+      const streamed = document.createElement('div');
+      const tailPara = document.createElement('p');
+      let started = false;
+      const j = await streamStory({character:characterText, world:worldText, hero_name:heroName, session_key:sessionKey}, (html, tail) => {
+        if (!started) { storyText.textContent = ''; storyText.append(streamed, tailPara); started = true; }
+        if (html) streamed.insertAdjacentHTML('beforeend', html);
+        tailPara.textContent = tail;
+      });
 
       if (j.error){ 
-        document.getElementById('story-text').textContent = 'Error: '+JSON.stringify(j); 
+        document.getElementById('story-text').textContent = j.retry_after
+          ? `Our storytellers are busy right now, please try again in ${j.retry_after}s.`
+          : 'Error: '+JSON.stringify(j); 
         return;
       }
 
-      // Keep a mutable storyData object to accumulate images/audio as they arrive
-      const storyData = Object.assign({}, j);
-      storyData.images = storyData.images || [];
+      // The story is stored server-side now: a refresh reloads it from /story/<id>
+      if (j.story_url) history.replaceState(null, '', j.story_url);
+      renderStory(j);
+    });
+  }
 
-      // Helper to render checklist
-      let steps = j.steps || [];
-      function renderChecklist(){
-        checklistItems.innerHTML = steps.map(step => {
-          const icon = step.status === 'complete' ? '✓' : (step.status === 'skipped' ? '⊘' : (step.status === 'in-progress' ? '◐' : '◌'));
-          const color = step.status === 'complete' ? '#10b981' : (step.status === 'skipped' ? '#9ca3af' : (step.status === 'in-progress' ? '#f59e0b' : '#6b7280'));
-          return `<div data-step="${step.name}" style="margin: 8px 0; display: flex; align-items: center; gap: 10px;">
-            <span style="color: ${color}; font-weight: bold; font-size: 18px;">${icon}</span>
-            <span style="color: #333;">${step.name}</span>
-            <span style="color: #999; font-size: 12px;">${step.status}</span>
-          </div>`;
-        }).join('');
+  // Story page (/story/<id>): rebuild everything from the story store, no regeneration
+  const storyPage = document.querySelector('[data-story-id]');
+  if (storyPage) {
+    document.getElementById('final-section').style.display = 'block';
+    document.getElementById('story-text').textContent = 'Loading your story...';
+    fetch(`/stories/${storyPage.getAttribute('data-story-id')}`)
+    .then(r => r.ok ? r.json() : { error: 'This story is no longer available.' })
+    .then(j => {
+      if (j.error) {
+        document.getElementById('story-text').textContent = j.error;
+        return;
       }
+      renderStory(j);
+    })
+    .catch(err => {
+      console.error('Error loading story:', err);
+      document.getElementById('story-text').textContent = 'Could not load this story. Please refresh.';
+    });
+  }
 
-      function updateStep(name, status){
-        const s = steps.find(st => st.name === name);
-        if (s) s.status = status;
-        renderChecklist();
-      }
+  // Render a story payload (from /generate_story or /stories/<id>): text, checklist, any
+  // asset results already finished, then follow the asset job if it is still running.
+  function renderStory(j){
+    // Only the id and hero name are kept client-side; the PDF is built from the stored story
+    const storyData = { story_id: j.story_id, hero_name: j.hero_name };
+
+    // Show progress checklist
+    const checklist = document.getElementById('progress-checklist');
+    checklist.style.display = 'block';
+    const checklistItems = document.getElementById('checklist-items');
+    checklistItems.innerHTML = '';
 
+    // Helper to render checklist
+    let steps = j.steps || [];
+    function renderChecklist(){
+      checklistItems.innerHTML = steps.map(step => {
+        const icon = step.status === 'complete' ? '✓' : (step.status === 'skipped' ? '⊘' : (step.status === 'in-progress' ? '◐' : '◌'));
+        const color = step.status === 'complete' ? '#10b981' : (step.status === 'skipped' ? '#9ca3af' : (step.status === 'in-progress' ? '#f59e0b' : '#6b7280'));
+        return `<div data-step="${step.name}" style="margin: 8px 0; display: flex; align-items: center; gap: 10px;">
+          <span style="color: ${color}; font-weight: bold; font-size: 18px;">${icon}</span>
+          <span style="color: #333;">${step.name}</span>
+          <span style="color: #999; font-size: 12px;">${step.status}</span>
+        </div>`;
+      }).join('');
+    }
+
+    function updateStep(name, status){
+      const s = steps.find(st => st.name === name);
+      if (s) s.status = status;
       renderChecklist();
+    }
+
+    renderChecklist();
 
-      // Display story (server returns sanitized HTML from Markdown)
-      document.getElementById('story-text').innerHTML = j.story_html || '<p>Story generation failed.</p>';
+    // Display story (server returns sanitized HTML from Markdown)
+    document.getElementById('story-text').innerHTML = j.story_html || '<p>Story generation failed.</p>';
 
-      // Display analogy (real-life inspiration)
-      document.getElementById('analogy').innerHTML = j.analogy_html || '<p>Analogy generation skipped.</p>';
+    // Display analogy (real-life inspiration)
+    document.getElementById('analogy').innerHTML = j.analogy_html || '<p>Analogy generation skipped.</p>';
 
-      // Show PDF download button (will use updated storyData)
-      const pdfBtn = document.getElementById('download-pdf-btn');
-      pdfBtn.style.display = 'inline-block';
-      pdfBtn.addEventListener('click', () => generateAndDownloadPDF(storyData));
+    // Show PDF download button
+    const pdfBtn = document.getElementById('download-pdf-btn');
+    pdfBtn.style.display = 'inline-block';
+    pdfBtn.addEventListener('click', () => generateAndDownloadPDF(storyData));
 
-      // Images container and audio container
-      const imagesDiv = document.getElementById('images'); 
-      imagesDiv.innerHTML='';
-      const audioSection = document.getElementById('audio-section');
-      const audioDiv = document.getElementById('audio-player');
-      audioDiv.innerHTML='';
+    // Images container and audio container
+    const imagesDiv = document.getElementById('images'); 
+    imagesDiv.innerHTML='';
+    const audioSection = document.getElementById('audio-section');
+    const audioDiv = document.getElementById('audio-player');
+    audioDiv.innerHTML='';
 
-      // Sequentially request hero image, background image, then BGM — updating checklist each time
-      // 1) Hero scene
-      // First: extract hero name (if requested)
-      if (steps.find(s=>s.name==='Hero Name Extraction')){
-        updateStep('Hero Name Extraction','in-progress');
-        try{
-          const nresp = await fetch('/extract_hero_name',{method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({character: characterText})});
-          const nj = await nresp.json();
-          if (nresp.ok && nj.hero_name){
-            storyData.hero_name = nj.hero_name;
-            updateStep('Hero Name Extraction','complete');
-          } else {
-            storyData.hero_name = storyData.hero_name || 'the hero';
-            updateStep('Hero Name Extraction','skipped');
-          }
-        }catch(err){
-          console.error('Hero name extraction error', err);
-          storyData.hero_name = storyData.hero_name || 'the hero';
-          updateStep('Hero Name Extraction','skipped');
+    // The server runs hero name, images, BGM and analogy concurrently as one job;
+    // apply each step's result as soon as it is reported.
+    function applyStepResult(key, result){
+      if (key === 'hero_name') {
+        storyData.hero_name = result;
+      } else if (key === 'hero_image') {
+        imagesDiv.insertBefore(buildIllustration(result), imagesDiv.firstChild);
+      } else if (key === 'background_image') {
+        imagesDiv.appendChild(buildIllustration(result));
+      } else if (key === 'bgm') {
+        // Switch a live-stream player to the finished file: the stream it joined may have been
+        // cut short by a failed compose attempt whose retry produced this track
+        playBgm(result.audio_url);
+        // Enable BGM download button (exists in template)
+        const dl = document.getElementById('download-bgm-btn');
+        if (dl) {
+          try{
+            // Prefer server-side download endpoint to force attachment (works on Render)
+            const audioFilename = result.audio_filename || (result.audio_url || '').split('/').pop() || ((storyData.hero_name || 'adventure').replace(/\s+/g, '_') + '_bgm.mp3');
+            dl.href = `/download_bgm?file=${encodeURIComponent(audioFilename)}`;
+            dl.download = audioFilename;
+            dl.style.display = 'inline-block';
+          }catch(e){ console.warn('Could not enable BGM download button', e); }
         }
+      } else if (key === 'analogy') {
+        document.getElementById('analogy').innerHTML = result.analogy_html;
       }
+    }
 
-      // Now hero scene
-      if (steps.find(s=>s.name==='Hero Scene Image')){
-        updateStep('Hero Scene Image', 'in-progress');
-        try{
-          const hresp = await fetch('/generate_image', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({type:'hero', character: characterText, story_excerpt: (j.story || '').slice(0,300)})});
-          const hj = await hresp.json();
-          if (hj.image_url){
-            const img = document.createElement('img'); img.src = hj.image_url; img.className='illustration';
-            imagesDiv.insertBefore(img, imagesDiv.firstChild);
-            storyData.images = storyData.images || []; storyData.images.unshift(hj.image_url);
-            updateStep('Hero Scene Image', 'complete');
-          } else {
-            updateStep('Hero Scene Image', 'skipped');
-          }
-        }catch(err){
-          console.error('Hero image error', err);
-          updateStep('Hero Scene Image','skipped');
-        }
+    function playBgm(src){
+      audioSection.style.display = 'block';
+      const a = audioDiv.querySelector('audio');
+      if (!a) {
+        const created = document.createElement('audio'); created.controls=true; created.src=src; audioDiv.appendChild(created);
+        return;
       }
+      if (a.src === new URL(src, window.location.href).href) return;
+      // Keep the listener's place (and play state) when the source changes
+      const at = a.currentTime, playing = !a.paused;
+      a.src = src;
+      a.addEventListener('loadedmetadata', () => {
+        a.currentTime = Math.min(at, a.duration || at);
+        if (playing) a.play().catch(() => {});
+      }, { once: true });
+    }
 
-      // 2) Background image
-      if (steps.find(s=>s.name==='Background Image')){
-        updateStep('Background Image', 'in-progress');
-        try{
-          const bresp = await fetch('/generate_image', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({type:'background', world: worldText})});
-          const bj = await bresp.json();
-          if (bj.image_url){
-            const img = document.createElement('img'); img.src = bj.image_url; img.className='illustration';
-            imagesDiv.appendChild(img);
-            storyData.images = storyData.images || []; storyData.images.push(bj.image_url);
-            updateStep('Background Image', 'complete');
-          } else {
-            updateStep('Background Image','skipped');
-          }
-        }catch(err){
-          console.error('Background image error', err);
-          updateStep('Background Image','skipped');
-        }
+    function onJobStep(ev){
+      try{
+        // The BGM can be played while it is still being composed
+        if (ev.progress && ev.progress.stream_url && !audioDiv.querySelector('audio')) playBgm(ev.progress.stream_url);
+        if (ev.status === 'complete' && ev.result) applyStepResult(ev.key, ev.result);
+      }catch(err){
+        console.error(`${ev.step} error`, err);
       }
+      if (ev.error) console.warn(`${ev.step} skipped:`, ev.error);
+      updateStep(ev.step, ev.status);
+    }
+
+    // A reloaded story may already have some (or all) of its assets
+    const applied = {};
+    Object.entries(j.results || {}).forEach(([key, result]) => {
+      applied[key] = true;
+      try{ applyStepResult(key, result); }catch(err){ console.error(`${key} error`, err); }
+    });
+
+    if (j.job_id){
+      followStoryJob(j, ev => {
+        // The SSE feed replays from the start; skip results already shown
+        if (ev.status === 'complete' && applied[ev.key]) { updateStep(ev.step, ev.status); return; }
+        onJobStep(ev);
+      }, () => {
+        storyData.hero_name = storyData.hero_name || 'the hero';
+        steps.forEach(s => { if (s.status === 'pending' || s.status === 'in-progress') s.status = 'skipped'; });
+        renderChecklist();
+      });
+    }
+  }
+  
+  // Build a responsive <picture> for a generated image: WebP/JPEG srcsets sized for the
+  // illustration column, with the tiny placeholder shown until the real image arrives.
+  // The full-size original (result.image_url) is only used by the PDF export.
+  function buildIllustration(result){
+    const img = document.createElement('img');
+    img.className = 'illustration';
+    img.decoding = 'async';
+    const v = result.variants;
+    if (!v) {
+      img.src = result.image_url;
+      return img;
+    }
+    const sizes = '(max-width: 1100px) 45vw, 500px';
+    const picture = document.createElement('picture');
+    if (v.webp_srcset) {
+      const source = document.createElement('source');
+      source.type = 'image/webp';
+      source.srcset = v.webp_srcset;
+      source.sizes = sizes;
+      picture.appendChild(source);
+    }
+    if (v.jpeg_srcset) {
+      img.srcset = v.jpeg_srcset;
+      img.sizes = sizes;
+    }
+    img.src = (v.jpeg && v.jpeg.length) ? v.jpeg[v.jpeg.length - 1].url : result.image_url;
+    img.width = v.original.width;
+    img.height = v.original.height;
+    if (v.placeholder) {
+      img.style.backgroundImage = `url(${v.placeholder})`;
+      img.style.backgroundSize = 'cover';
+      img.addEventListener('load', () => { img.style.backgroundImage = ''; }, { once: true });
+    }
+    picture.appendChild(img);
+    return picture;
+  }
 
-      // 3) Background music
-      if (steps.find(s=>s.name==='Background Music')){
-        updateStep('Background Music', 'in-progress');
-        try{
-          const mresp = await fetch('/generate_bgm', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({world: worldText, character: characterText, hero_name: storyData.hero_name || j.hero_name})});
-          const mj = await mresp.json();
-          if (mj.audio_url){
-            storyData.audio = mj.audio_url;
-            audioSection.style.display = 'block';
-            const a = document.createElement('audio'); a.controls=true; a.src=mj.audio_url; audioDiv.appendChild(a);
-            // Enable BGM download button (exists in template)
-            const dl = document.getElementById('download-bgm-btn');
-            if (dl) {
-              try{
-                // Prefer server-side download endpoint to force attachment (works on Render)
-                const audioFilename = mj.audio_filename || (mj.audio_url || '').split('/').pop() || ((storyData.hero_name || 'adventure').replace(/\s+/g, '_') + '_bgm.mp3');
-                dl.href = `/download_bgm?file=${encodeURIComponent(audioFilename)}`;
-                dl.download = audioFilename;
-                dl.style.display = 'inline-block';
-              }catch(e){ console.warn('Could not enable BGM download button', e); }
-            }
-            updateStep('Background Music', 'complete');
-          } else {
-            updateStep('Background Music','skipped');
-          }
-        }catch(err){
-          console.error('BGM error', err);
-          updateStep('Background Music','skipped');
+  // Stream /generate_story_stream (Server-Sent Events over a POST), calling onChunk with the
+  // HTML of newly completed blocks ('' if none) and the unfinished Markdown after them.
+  // Resolves with the same payload /generate_story returns.
+  async function streamStory(payload, onChunk){
+    const resp = await fetch('/generate_story_stream',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify(payload)});
+    // 429: the server is at capacity; retrying on /generate_story would only add load
+    if (resp.status === 429) return resp.json();
+    if (!resp.ok || !resp.body) {
+      const fallback = await fetch('/generate_story',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify(payload)});
+      return fallback.json();
+    }
+    const reader = resp.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result = null;
+    let tail = '';
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let idx;
+      while ((idx = buffer.indexOf('\n\n')) >= 0) {
+        const frame = buffer.slice(0, idx);
+        buffer = buffer.slice(idx + 2);
+        let event = 'message';
+        let data = '';
+        frame.split('\n').forEach(line => {
+          if (line.startsWith('event: ')) event = line.slice(7);
+          else if (line.startsWith('data: ')) data += line.slice(6);
+        });
+        if (!data) continue;
+        const msg = JSON.parse(data);
+        if (event === 'chunk') {
+          tail = msg.html ? msg.tail : tail + msg.delta;
+          onChunk(msg.html, tail);
         }
+        else if (event === 'story') result = msg;
+        else if (event === 'error') result = { error: msg.error, retry_after: msg.retry_after };
       }
+    }
+    return result || { error: 'Story stream ended unexpectedly' };
+  }
 
-      // 4) Real-life analogy (deferred)
-      if (steps.find(s=>s.name==='Real-life Inspiration')){
-        updateStep('Real-life Inspiration','in-progress');
-        try{
-          const aresp = await fetch('/generate_analogy', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({hero_name: storyData.hero_name || j.hero_name, story: storyData.story})});
-          const aj = await aresp.json();
-          if (aj.analogy_html){
-            storyData.analogy = aj.analogy_md || '';
-            storyData.analogy_html = aj.analogy_html;
-            document.getElementById('analogy').innerHTML = aj.analogy_html;
-            updateStep('Real-life Inspiration','complete');
-          } else {
-            updateStep('Real-life Inspiration','skipped');
-          }
-        }catch(err){
-          console.error('Analogy error', err);
-          updateStep('Real-life Inspiration','skipped');
-        }
+  // Follow a server-side story job: Server-Sent Events when available, polling otherwise
+  function followStoryJob(job, onStep, onDone){
+    if (window.EventSource) {
+      const es = new EventSource(job.events_url);
+      es.addEventListener('step', e => onStep(JSON.parse(e.data)));
+      es.addEventListener('done', () => { es.close(); onDone(); });
+      return;
+    }
+    const seen = {};
+    const poll = async () => {
+      try{
+        const r = await fetch(job.status_url);
+        const snap = await r.json();
+        snap.steps.forEach(s => {
+          if (seen[s.name] === s.status) return;
+          seen[s.name] = s.status;
+          onStep({step: s.name, key: s.key, status: s.status, result: snap.results[s.key]});
+        });
+        if (snap.done) { onDone(); return; }
+      }catch(err){
+        console.error('Job status error', err);
       }
-    });
+      setTimeout(poll, 2000);
+    };
+    poll();
   }
-  
+
   // PDF Generation and Download
   async function generateAndDownloadPDF(storyData) {
     const btn = document.getElementById('download-pdf-btn');
@@ -310,32 +417,32 @@ document.addEventListener('DOMContentLoaded', () => {
     btn.disabled = true;
     
     try {
+      // The server renders the PDF off-request; poll its job, then download the finished file
       const response = await fetch('/generate_pdf', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          story: storyData.story,
-          character: storyData.character,
-          world: storyData.world,
-          hero_name: storyData.hero_name,
-          analogy: storyData.analogy,
-          images: storyData.images,
-          bg_image: storyData.images && storyData.images.length > 0 ? storyData.images[0] : null
-        })
+        body: JSON.stringify({ story_id: storyData.story_id })
       });
       
       if (!response.ok) {
         throw new Error('PDF generation failed');
       }
       
-      const blob = await response.blob();
-      const url = window.URL.createObjectURL(blob);
+      let job = await response.json();
+      while (job.status === 'pending') {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        const statusResp = await fetch(job.status_url);
+        job = Object.assign(job, await statusResp.json());
+      }
+      if (job.status !== 'done') {
+        throw new Error(job.error || 'PDF generation failed');
+      }
+      
       const a = document.createElement('a');
-      a.href = url;
-      a.download = `${storyData.hero_name.replace(/\s+/g, '_')}_Adventure.pdf`;
+      a.href = job.download_url;
+      a.download = `${(storyData.hero_name || 'Hero').replace(/\s+/g, '_')}_Adventure.pdf`;
       document.body.appendChild(a);
       a.click();
-      window.URL.revokeObjectURL(url);
       document.body.removeChild(a);
     } catch (err) {
       console.error('Error generating PDF:', err);
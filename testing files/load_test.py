@@ -0,0 +1,177 @@
+"""Drive the full Hero Imagined flow at a given concurrency and report latency percentiles.
+
+Each simulated session walks the same path as the browser:
+/builder -> /api/generate-questions -> /api/character + /api/world -> /generate_story
+-> follow /jobs/<id> until every asset is done -> fetch the media -> /stories/<id> -> /generate_pdf
+-> poll /pdf_jobs/<id> -> download.
+
+Run the app against the offline providers so no quota is spent, e.g.
+
+	GEMINI_PROVIDER=fake MUSIC_PROVIDER=fake FAKE_TEXT_LATENCY=lognormal:1.5:0.5 python app.py
+	python "testing files/load_test.py" --base-url http://localhost:8000 --sessions 40 --concurrency 8
+
+--levels 8,16,32,64 instead runs the same sessions at each concurrency in turn and prints
+one line per level (sessions/s, p95 of the story call and of the whole session), which is
+how the threaded Flask server and the ASGI app (asgi.py) are compared per process.
+"""
+import argparse
+import concurrent.futures
+import re
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+
+class Recorder:
+	"""Thread-safe latency samples and error counts per endpoint."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.samples = defaultdict(list)
+		self.errors = defaultdict(int)
+
+	def record(self, endpoint, seconds, ok):
+		with self._lock:
+			self.samples[endpoint].append(seconds)
+			if not ok:
+				self.errors[endpoint] += 1
+
+
+def percentile(values, pct):
+	"""Nearest-rank percentile of a non-empty list."""
+	ordered = sorted(values)
+	rank = max(1, int(round(pct / 100 * len(ordered))))
+	return ordered[min(rank, len(ordered)) - 1]
+
+
+class Session:
+	def __init__(self, base_url, recorder, hero_prompt, with_pdf, timeout):
+		self.base_url = base_url.rstrip('/')
+		self.recorder = recorder
+		self.hero_prompt = hero_prompt
+		self.with_pdf = with_pdf
+		self.timeout = timeout
+		self.http = requests.Session()
+
+	def call(self, label, method, path, **kwargs):
+		started = time.perf_counter()
+		ok = False
+		try:
+			resp = self.http.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+			ok = resp.status_code < 400
+			return resp
+		finally:
+			self.recorder.record(label, time.perf_counter() - started, ok)
+
+	def run(self):
+		resp = self.call('POST /builder', 'POST', '/builder', data={'hero_prompt': self.hero_prompt})
+		match = re.search(r'id="detected-topic">([^<]*)<', resp.text)
+		topic = match.group(1).strip() if match else 'fantasy'
+		match = re.search(r'data-session-key="([^"]*)"', resp.text)
+		session_key = match.group(1) if match else ''
+
+		questions = self.call('POST /api/generate-questions', 'POST', '/api/generate-questions',
+			json={'user_prompt': self.hero_prompt, 'detected_topic': topic}).json()
+		char_answers = {f"char_q{q['number']}": q.get('example') or 'brave' for q in questions.get('character_questions', [])}
+		world_answers = {f"world_q{q['number']}": q.get('example') or 'misty' for q in questions.get('world_questions', [])}
+		character = self.call('POST /api/character', 'POST', '/api/character',
+			json={'answers': char_answers or {'q': 'a brave hero'}, 'session_key': session_key}).json()
+		world = self.call('POST /api/world', 'POST', '/api/world',
+			json={'answers': world_answers or {'q': 'a misty world'}, 'detected': {'topic': topic}, 'session_key': session_key}).json().get('world', '')
+
+		story = self.call('POST /generate_story', 'POST', '/generate_story',
+			json={'character': character.get('character', ''), 'world': world, 'hero_name': character.get('hero_name', ''),
+				'session_key': session_key}).json()
+		if story.get('error') or not story.get('job_id'):
+			return
+
+		# The asset job runs server-side; time from story to fully populated page
+		started = time.perf_counter()
+		snapshot = {}
+		while time.perf_counter() - started < self.timeout:
+			snapshot = self.call('GET /jobs/<id>', 'GET', story['status_url']).json()
+			if snapshot.get('done'):
+				break
+			time.sleep(0.5)
+		self.recorder.record('assets (job total)', time.perf_counter() - started, bool(snapshot.get('done')))
+
+		results = snapshot.get('results', {})
+		for key in ('hero_image', 'background_image', 'bgm'):
+			url = (results.get(key) or {}).get('image_url') or (results.get(key) or {}).get('audio_url')
+			if url:
+				self.call('GET /media', 'GET', url)
+
+		# What a page refresh costs: served from the story store, no upstream calls
+		self.call('GET /stories/<id>', 'GET', f"/stories/{story['story_id']}")
+
+		if self.with_pdf:
+			job = self.call('POST /generate_pdf', 'POST', '/generate_pdf', json={'story_id': story['story_id']}).json()
+			started = time.perf_counter()
+			while job.get('status') == 'pending' and time.perf_counter() - started < self.timeout:
+				time.sleep(0.5)
+				job.update(self.call('GET /pdf_jobs/<id>', 'GET', job['status_url']).json())
+			self.recorder.record('pdf (job total)', time.perf_counter() - started, job.get('status') == 'done')
+			if job.get('status') == 'done':
+				self.call('GET /pdf_jobs/<id>/download', 'GET', job['download_url'])
+
+
+def run_sessions(args, concurrency, sessions):
+	"""Run `sessions` sessions `concurrency` at a time; returns (recorder, elapsed, failures)."""
+	recorder = Recorder()
+	failures = 0
+	started = time.perf_counter()
+
+	def _session():
+		session_started = time.perf_counter()
+		ok = False
+		try:
+			Session(args.base_url, recorder, args.hero_prompt, not args.no_pdf, args.timeout).run()
+			ok = True
+		finally:
+			recorder.record('session (total)', time.perf_counter() - session_started, ok)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+		futures = [pool.submit(_session) for _ in range(sessions)]
+		for future in concurrent.futures.as_completed(futures):
+			try:
+				future.result()
+			except Exception as e:
+				failures += 1
+				print(f"[WARNING] Session failed: {e}")
+	return recorder, time.perf_counter() - started, failures
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--base-url', default='http://localhost:8000')
+	parser.add_argument('--sessions', type=int, default=20, help='total user sessions to run')
+	parser.add_argument('--concurrency', type=int, default=4, help='sessions in flight at once')
+	parser.add_argument('--hero-prompt', default='woodland elf in a fantasy realm')
+	parser.add_argument('--no-pdf', action='store_true', help='skip the PDF export step')
+	parser.add_argument('--timeout', type=float, default=300, help='per-request / per-job timeout in seconds')
+	parser.add_argument('--levels', help='comma-separated concurrency ramp, e.g. 8,16,32,64 (at least 2 sessions per slot)')
+	args = parser.parse_args()
+
+	if args.levels:
+		print(f"{'concurrency':>11}{'sessions':>10}{'failed':>8}{'sessions/s':>12}{'story p95':>11}{'session p95':>13}")
+		for level in [int(v) for v in args.levels.split(',')]:
+			recorder, elapsed, failures = run_sessions(args, level, max(args.sessions, level * 2))
+			story = recorder.samples.get('POST /generate_story') or [0.0]
+			sessions = recorder.samples.get('session (total)') or [0.0]
+			print(f"{level:>11}{len(sessions):>10}{failures:>8}{len(sessions) / elapsed:>12.2f}"
+				f"{percentile(story, 95):>11.3f}{percentile(sessions, 95):>13.3f}")
+		return
+
+	recorder, elapsed, failures = run_sessions(args, args.concurrency, args.sessions)
+	print(f"\n{args.sessions} sessions at concurrency {args.concurrency} in {elapsed:.1f}s "
+		f"({args.sessions / elapsed:.2f} sessions/s, {failures} failed)\n")
+	print(f"{'endpoint':<32}{'count':>7}{'errors':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+	for endpoint, values in recorder.samples.items():
+		print(f"{endpoint:<32}{len(values):>7}{recorder.errors[endpoint]:>8}"
+			f"{percentile(values, 50):>9.3f}{percentile(values, 95):>9.3f}{percentile(values, 99):>9.3f}{max(values):>9.3f}")
+
+
+if __name__ == '__main__':
+	main()
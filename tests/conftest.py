@@ -0,0 +1,10 @@
+"""Run the app against the fake providers (fake_providers.py), with no artificial latency."""
+import os
+
+os.environ.update({
+	'GEMINI_PROVIDER': 'fake',
+	'MUSIC_PROVIDER': 'fake',
+	'FAKE_TEXT_LATENCY': 'fixed:0',
+	'FAKE_IMAGE_LATENCY': 'fixed:0',
+	'FAKE_IMAGE_SIZE': '64x64'
+})
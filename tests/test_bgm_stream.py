@@ -0,0 +1,21 @@
+"""/generate_bgm with stream=true answers within its deadline however busy the pool is."""
+import threading
+import time
+
+import app as core
+
+
+def test_saturated_pool_does_not_block_the_request(monkeypatch):
+	executor = core.DeadlineExecutor(1)
+	monkeypatch.setattr(core, 'deadline_executor', executor)
+	release = threading.Event()
+	executor.submit(release.wait)
+	try:
+		started = time.monotonic()
+		future, stream = core.start_bgm_stream('A coast of two moons', 'Mira', timeout=0.5)
+		assert time.monotonic() - started < 2
+		assert stream is None
+		assert future.cancelled()
+		assert executor.stats()['queue_depth'] == 0
+	finally:
+		release.set()
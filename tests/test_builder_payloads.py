@@ -0,0 +1,67 @@
+"""Builder endpoints (questions, /api/character, /api/world) answer the same JSON from the Flask and the ASGI app."""
+import asyncio
+
+import pytest
+
+import app as core
+import asgi
+
+ANSWERS = {'1': 'A lighthouse keeper', '2': 'Mira'}
+
+
+@pytest.fixture
+def models_down(monkeypatch):
+	"""Structured output fails and the prose fallback reports an error, on both front ends."""
+	def _structured(*args, **kwargs):
+		raise ValueError('schema mismatch')
+
+	async def _structured_async(*args, **kwargs):
+		_structured()
+
+	async def _text_async(*args, **kwargs):
+		return {'raw': 'Error: upstream down', 'error': 'upstream down'}
+
+	monkeypatch.setattr(core, 'call_gemini_structured', _structured)
+	monkeypatch.setattr(core, 'call_gemini_text', lambda *args, **kwargs: {'raw': 'Error: upstream down', 'error': 'upstream down'})
+	monkeypatch.setattr(asgi, 'call_gemini_structured_async', _structured_async)
+	monkeypatch.setattr(asgi, 'call_gemini_text_async', _text_async)
+
+
+@pytest.mark.parametrize('path', ['/api/character', '/api/world'])
+def test_prose_fallback_error_matches(models_down, path):
+	flask_resp = core.app.test_client().post(path, json={'answers': ANSWERS})
+
+	async def _post():
+		resp = await asgi.quart_app.test_client().post(path, json={'answers': ANSWERS})
+		return resp.status_code, await resp.get_json()
+
+	status, payload = asyncio.run(_post())
+	assert (status, payload) == (flask_resp.status_code, flask_resp.get_json())
+	assert payload['error'] == 'upstream down'
+
+
+def test_failed_generation_is_not_speculated(models_down, monkeypatch):
+	offers = []
+	monkeypatch.setattr(core.speculative_assets, 'offer', lambda *args, **kwargs: offers.append(kwargs))
+	core.app.test_client().post('/api/world', json={'answers': ANSWERS, 'session_key': 's1'})
+
+	async def _post():
+		await asgi.quart_app.test_client().post('/api/character', json={'answers': ANSWERS, 'session_key': 's1'})
+
+	asyncio.run(_post())
+	assert offers == []
+
+
+def test_failed_questions_are_an_error(models_down):
+	flask_resp = core.app.test_client().post('/api/generate-questions', json={'user_prompt': 'a lighthouse keeper'})
+	assert flask_resp.status_code == 503
+	assert flask_resp.headers['Retry-After'] == str(core.QUESTIONS_RETRY_AFTER)
+	assert flask_resp.get_json()['retry_after'] == core.QUESTIONS_RETRY_AFTER
+
+	async def _post():
+		resp = await asgi.quart_app.test_client().post('/api/generate-questions', json={'user_prompt': 'a lighthouse keeper'})
+		return resp.status_code, resp.headers['Retry-After'], await resp.get_json()
+
+	status, retry_after, payload = asyncio.run(_post())
+	assert (status, retry_after, payload) == (503, flask_resp.headers['Retry-After'], flask_resp.get_json())
+	assert 'schema mismatch' in payload['error']
@@ -0,0 +1,74 @@
+"""DeadlineExecutor: nested calls run inline under the tighter deadline; late work is abandoned, not waited for."""
+import threading
+import time
+
+import pytest
+
+import app as core
+
+
+@pytest.fixture
+def executor():
+	return core.DeadlineExecutor(2)
+
+
+def test_nested_run_is_inline_under_the_tighter_deadline(executor):
+	def _inner():
+		return threading.current_thread(), executor.remaining()
+
+	def _outer():
+		return threading.current_thread(), executor.run(_inner, timeout=60)
+
+	outer_thread, (inner_thread, remaining) = executor.run(_outer, timeout=2)
+	assert inner_thread is outer_thread
+	assert outer_thread is not threading.current_thread()
+	# The inner call asked for 60s but inherits the outer 2s budget
+	assert 0 < remaining <= 2
+
+
+def test_nested_run_times_out_on_its_own_tighter_deadline(executor):
+	def _outer():
+		with pytest.raises(TimeoutError):
+			executor.run(time.sleep, 0.3, timeout=0.1)
+		return executor.remaining()
+
+	# Inline work can't be interrupted, but it reports the missed deadline; the outer budget is intact
+	assert executor.run(_outer, timeout=5) > 4
+
+
+def test_late_call_is_abandoned(executor):
+	release = threading.Event()
+	with pytest.raises(TimeoutError):
+		executor.run(release.wait, timeout=0.1)
+	assert executor.stats()['abandoned'] == 1
+	assert executor.stats()['abandoned_total'] == 1
+
+	release.set()
+	for _ in range(100):
+		if executor.stats()['abandoned'] == 0:
+			break
+		time.sleep(0.01)
+	assert executor.stats()['abandoned'] == 0
+	assert executor.stats()['abandoned_total'] == 1
+
+
+def test_queue_depth_and_cancelled_queued_work(executor):
+	release = threading.Event()
+	running = [executor.submit(release.wait) for _ in range(2)]
+	for _ in range(100):
+		if executor.stats()['running'] == 2:
+			break
+		time.sleep(0.01)
+	queued = executor.submit(time.sleep, 0)
+	try:
+		assert executor.stats()['queue_depth'] == 1
+		assert executor.submit_if_idle(time.sleep, 0) is None
+		executor.abandon(queued)
+		assert queued.cancelled()
+		assert executor.stats()['queue_depth'] == 0
+		assert executor.stats()['abandoned_total'] == 0
+	finally:
+		release.set()
+	for future in running:
+		future.result(timeout=1)
+	assert executor.stats()['running'] == 0
@@ -0,0 +1,52 @@
+"""Short text calls listed in HEDGE_PURPOSES send a second request when the first is slow."""
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app as core
+
+
+class SlowFirstClient:
+	"""Gemini client stand-in whose first generate_content call hangs for `stall` seconds."""
+
+	def __init__(self, stall):
+		self.stall = stall
+		self.calls = 0
+		self._lock = threading.Lock()
+		self.models = self
+
+	def generate_content(self, model, contents, config=None):
+		with self._lock:
+			self.calls += 1
+			first = self.calls == 1
+		if first:
+			time.sleep(self.stall)
+			return SimpleNamespace(text='Slow Mira')
+		return SimpleNamespace(text='Mira')
+
+
+@pytest.fixture
+def slow_first(monkeypatch):
+	client = SlowFirstClient(stall=3)
+	monkeypatch.setattr(core, 'get_genai_client', lambda: client)
+	monkeypatch.setattr(core, 'TEXT_CACHE_ENABLED', False)
+	monkeypatch.setattr(core, 'HEDGE_DEFAULT_DELAY', 0.2)
+	monkeypatch.setattr(core, 'latency_window', core.LatencyWindow(200))
+	return client
+
+
+def test_slow_hero_name_is_hedged(slow_first):
+	started = time.monotonic()
+	name = core.extract_hero_name('Mira, a lighthouse keeper')
+	assert name == 'Mira'
+	assert slow_first.calls == 2
+	assert time.monotonic() - started < 2
+
+
+def test_hero_name_runs_inline_in_a_worker(slow_first):
+	# Inside a pool worker the call is already under a deadline: no second copy
+	name = core.run_with_timeout(lambda: core.extract_hero_name('Mira, a lighthouse keeper'), timeout=10)
+	assert name == 'Slow Mira'
+	assert slow_first.calls == 1
@@ -0,0 +1,71 @@
+"""PDF export jobs: finished jobs are retired, and a missing PDF is always rendered again."""
+import concurrent.futures
+import os
+import time
+
+import pytest
+
+import app as core
+
+
+@pytest.fixture
+def renders(tmp_path, monkeypatch):
+	"""Render on a thread pool into tmp_path; the returned list records every render."""
+	calls = []
+	pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+	def _render(data, out_path):
+		calls.append(data)
+		if data.get('story') == 'broken':
+			raise ValueError('bad image')
+		with open(out_path, 'wb') as f:
+			f.write(b'%PDF-1.4')
+		return {'bytes': 8, 'metrics': {}}
+
+	monkeypatch.setitem(core.app.config, 'PDF_OUTPUT', str(tmp_path))
+	monkeypatch.setattr(core, 'render_pdf_to_file', _render)
+	monkeypatch.setattr(core, '_get_pdf_pool', lambda: pool)
+	core._reset_pdf_pool()
+	yield calls
+	pool.shutdown()
+	core._reset_pdf_pool()
+
+
+def _settle(job_id):
+	for _ in range(100):
+		status = core.pdf_job_status(job_id)
+		if status is None or status['status'] != 'pending':
+			return status
+		time.sleep(0.02)
+	raise AssertionError('PDF job still pending')
+
+
+def _retired(job_id):
+	for _ in range(100):
+		if job_id not in core._pdf_jobs:
+			return True
+		time.sleep(0.02)
+	return False
+
+
+def test_swept_pdf_is_rendered_again(renders):
+	# Nobody polls this job before its PDF is swept
+	data = {'story': 'Mira lit the lamp.', 'hero_name': 'Mira'}
+	job_id = core.submit_pdf_job(data)
+	assert _retired(job_id)
+	assert os.path.exists(core._pdf_path(job_id))
+
+	os.remove(core._pdf_path(job_id))
+	assert core.submit_pdf_job(data) == job_id
+	assert _settle(job_id) == {'status': 'done'}
+	assert len(renders) == 2
+
+
+def test_failed_job_is_retired_and_retried(renders):
+	job_id = core.submit_pdf_job({'story': 'broken'})
+	assert _retired(job_id)
+	assert core.pdf_job_status(job_id) == {'status': 'failed', 'error': 'bad image'}
+
+	core.submit_pdf_job({'story': 'broken'})
+	_settle(job_id)
+	assert len(renders) == 2
@@ -0,0 +1,74 @@
+"""ProviderGate: bounded queueing, fast 429s with Retry-After, and requests-per-minute refill."""
+import threading
+import time
+
+import pytest
+
+import app as core
+
+
+def _hold(gate, entered, release):
+	with gate.admit():
+		entered.set()
+		release.wait(5)
+
+
+def test_full_queue_rejects_at_once():
+	gate = core.ProviderGate('test', max_concurrency=1, rpm=6000, max_queue=1, max_wait=5)
+	entered, release = threading.Event(), threading.Event()
+	holder = threading.Thread(target=_hold, args=(gate, entered, release))
+	holder.start()
+	assert entered.wait(1)
+	waiter = threading.Thread(target=_hold, args=(gate, threading.Event(), release))
+	waiter.start()
+	try:
+		for _ in range(100):
+			if gate.stats()['waiting'] == 1:
+				break
+			time.sleep(0.01)
+		started = time.monotonic()
+		with pytest.raises(core.ProviderBusy) as busy:
+			with gate.admit():
+				pass
+		assert time.monotonic() - started < 0.5
+		assert busy.value.retry_after >= 1
+		with pytest.raises(core.ProviderBusy):
+			gate.check()
+	finally:
+		release.set()
+		holder.join()
+		waiter.join()
+	# The queued caller got its turn once the slot freed up
+	stats = gate.stats()
+	assert (stats['active'], stats['waiting']) == (0, 0)
+
+
+def test_busy_provider_answers_429_with_retry_after(monkeypatch):
+	def _busy(*args, **kwargs):
+		raise core.ProviderBusy('gemini_text', 7, 'queue_full')
+
+	monkeypatch.setattr(core, 'call_gemini_structured', _busy)
+	resp = core.app.test_client().post('/api/generate-questions', json={'user_prompt': 'a lighthouse keeper'})
+	assert resp.status_code == 429
+	assert resp.headers['Retry-After'] == '7'
+	assert resp.get_json()['retry_after'] == 7
+	assert resp.get_json()['provider'] == 'gemini_text'
+
+
+def test_tokens_refill_at_the_configured_rate():
+	# 600 rpm = 10 tokens/s, burst capped at the concurrency of 3
+	gate = core.ProviderGate('test', max_concurrency=3, rpm=600, max_queue=4, max_wait=0.05)
+	for _ in range(3):
+		with gate.admit():
+			pass
+	with pytest.raises(core.ProviderBusy) as busy:
+		with gate.admit():
+			pass
+	assert busy.value.reason == 'deadline'
+
+	time.sleep(0.25)
+	assert 2 <= gate.stats()['tokens'] <= 3
+	with gate.admit():
+		pass
+	time.sleep(0.5)
+	assert gate.stats()['tokens'] == 3
@@ -0,0 +1,62 @@
+"""Superseded speculative assets stop spending provider time."""
+import threading
+import time
+
+import pytest
+
+import app as core
+
+
+class SlowMusic:
+	"""Streamed music response that trickles 100 chunks over ~5 seconds."""
+
+	status_code = 200
+	text = ''
+
+	def __init__(self):
+		self.streaming = threading.Event()
+		self.chunks = 0
+		self.closed = False
+
+	def iter_content(self, chunk_size=8192):
+		for _ in range(100):
+			self.streaming.set()
+			time.sleep(0.05)
+			self.chunks += 1
+			yield b'\0' * 64
+
+	def close(self):
+		self.closed = True
+
+
+@pytest.fixture
+def slow_music(tmp_path, monkeypatch):
+	responses = []
+
+	def _post(url, headers, body, timeout):
+		responses.append(SlowMusic())
+		return responses[-1]
+
+	monkeypatch.setattr(core, 'post_music_request', _post)
+	monkeypatch.setattr(core, 'artifact_store', core.ArtifactStore(str(tmp_path / 'output'), str(tmp_path / 'artifacts.sqlite3'), 10 ** 9, 3600))
+	monkeypatch.setitem(core.app.config, 'STATIC_OUTPUT', str(tmp_path / 'output'))
+	return responses
+
+
+def test_superseded_bgm_stops_composing(slow_music):
+	speculation = core.SpeculativeAssets(True, 900)
+	speculation.offer('s1', character='Mira, a lighthouse keeper', world='A coast of two moons')
+	future = speculation._sessions['s1']['assets']['bgm'][1]
+	for _ in range(100):
+		if slow_music:
+			break
+		time.sleep(0.05)
+	assert slow_music and slow_music[0].streaming.wait(5)
+
+	speculation.offer('s1', world='A desert of glass')
+	with pytest.raises(core.WorkCancelled):
+		future.result(timeout=2)
+	assert slow_music[0].closed
+	assert slow_music[0].chunks < 100
+	# Expiring the session cancels the replacement too
+	speculation._sweep(time.time() + 1000)
@@ -0,0 +1,44 @@
+"""Endpoints addressed by story_id keep the rest of their request body."""
+import asyncio
+
+import pytest
+
+import app as core
+import asgi
+
+
+@pytest.fixture
+def story_id(tmp_path, monkeypatch):
+	"""A stored story, with generated files kept out of static/output."""
+	store = core.StoryStore(str(tmp_path / 'stories.sqlite3'), 3600)
+	artifacts = core.ArtifactStore(str(tmp_path / 'output'), str(tmp_path / 'artifacts.sqlite3'), 10 ** 9, 3600)
+	monkeypatch.setattr(core, 'story_store', store)
+	monkeypatch.setattr(core, 'artifact_store', artifacts)
+	monkeypatch.setitem(core.app.config, 'STATIC_OUTPUT', str(tmp_path / 'output'))
+	return store.create('Mira, a lighthouse keeper', 'A coast of two moons', 'Mira lit the lamp.')
+
+
+def test_generate_image_with_story_id(story_id):
+	resp = core.app.test_client().post('/generate_image', json={'type': 'hero', 'story_id': story_id})
+	assert resp.status_code == 200, resp.get_json()
+	assert resp.get_json()['image_url']
+	assert core.story_store.get(story_id)['assets']['hero_image']['image_url'] == resp.get_json()['image_url']
+
+
+def test_generate_image_with_story_id_asgi(story_id):
+	async def _post():
+		resp = await asgi.quart_app.test_client().post('/generate_image', json={'type': 'background', 'story_id': story_id})
+		return resp.status_code, await resp.get_json()
+
+	status, payload = asyncio.run(_post())
+	assert status == 200, payload
+	assert payload['image_url']
+
+
+def test_story_fields_keeps_request_fields(story_id):
+	data = core.story_fields({'story_id': story_id, 'stream': True, 'analogy': 'Like a lamp.', 'images': ['/a.png', None]})
+	assert data['stream'] is True
+	assert data['story'] == 'Mira lit the lamp.'
+	# The story has no analogy or images yet, so the request's own values are kept
+	assert data['analogy'] == 'Like a lamp.'
+	assert data['images'] == ['/a.png', None]
@@ -0,0 +1,67 @@
+"""TextResponseCache: memory LRU over SQLite, per-entry TTLs, and only good answers stored."""
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app as core
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+	return str(tmp_path / 'text_responses.sqlite3')
+
+
+def test_disk_hit_is_promoted_to_memory(cache_path):
+	core.TextResponseCache(cache_path, 4, 10 ** 6).put('k', 'Mira', ttl=60, latency=1.5, purpose='hero_name')
+
+	# A fresh process starts with an empty memory tier
+	cache = core.TextResponseCache(cache_path, 4, 10 ** 6)
+	assert cache.get('k', 'hero_name') == 'Mira'
+	assert cache.get('k', 'hero_name') == 'Mira'
+	stats = cache.stats()['hero_name']
+	assert (stats['disk_hits'], stats['memory_hits'], stats['misses']) == (1, 1, 0)
+	assert stats['saved_seconds'] == 3.0
+
+
+def test_memory_lru_falls_back_to_disk(cache_path):
+	cache = core.TextResponseCache(cache_path, 1, 10 ** 6)
+	cache.put('a', 'first', ttl=60)
+	cache.put('b', 'second', ttl=60)
+	assert cache.get('a') == 'first'
+	assert cache.stats()['default']['disk_hits'] == 1
+
+
+def test_entries_expire_after_their_ttl(cache_path):
+	cache = core.TextResponseCache(cache_path, 4, 10 ** 6)
+	cache.put('short', 'gone soon', ttl=0.1)
+	cache.put('long', 'still here', ttl=60)
+	time.sleep(0.2)
+	assert cache.get('short') is None
+	assert core.TextResponseCache(cache_path, 4, 10 ** 6).get('short') is None
+	assert cache.get('long') == 'still here'
+
+
+class FlakyClient:
+	"""Gemini client stand-in that fails its first call."""
+
+	def __init__(self):
+		self.calls = 0
+		self.models = self
+
+	def generate_content(self, model, contents, config=None):
+		self.calls += 1
+		if self.calls == 1:
+			raise ValueError('upstream exploded')
+		return SimpleNamespace(text='fantasy')
+
+
+def test_errors_are_not_cached(cache_path, monkeypatch):
+	client = FlakyClient()
+	monkeypatch.setattr(core, 'get_genai_client', lambda: client)
+	monkeypatch.setattr(core, 'text_cache', core.TextResponseCache(cache_path, 4, 10 ** 6))
+
+	assert core.call_gemini_text('Which genre is a lighthouse keeper?', purpose='detector').get('error')
+	assert core.call_gemini_text('Which genre is a lighthouse keeper?', purpose='detector') == {'raw': 'fantasy'}
+	assert core.call_gemini_text('Which genre is a lighthouse keeper?', purpose='detector') == {'raw': 'fantasy', 'cached': True}
+	assert client.calls == 2